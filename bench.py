@@ -0,0 +1,414 @@
+"""
+Benchmarks for the parts of tig that dominate large repositories.
+
+    python bench.py index [--entries N]
+    python bench.py commit [--files N]
+    python bench.py checkout [--files N]
+    python bench.py log [--commits N]
+    python bench.py merge [--files N]
+    python bench.py bitmap [--commits N]
+    python bench.py refs [--refs N]
+    python bench.py objects [--commits N]
+    python bench.py trees [--entries N]
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+import tracemalloc
+import tig
+
+
+def make_entry(i, sha, name):
+    return tig.GitIndexEntry(
+        ctime = (1_700_000_000, i),
+        mtime = (1_700_000_000, i),
+        dev = 2049,
+        ino = i,
+        mode_type = 0b1000,
+        mode_perms = 0o644,
+        uid = 1000,
+        gid = 1000,
+        fsize = i % 100_000,
+        sha = sha,
+        flag_assume_valid = False,
+        flag_stage = 0,
+        name = name
+    )
+
+
+def bench_index(entries):
+    index = tig.GitIndex([
+        make_entry(i, f"{i:040x}", f"src/module_{i // 1000:04}/file_{i % 1000:04}.py") for i in range(entries)
+    ])
+
+    start = time.perf_counter()
+    data = index.write()
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parsed = tig.GitIndex()
+    parsed.read(data)
+    read_time = time.perf_counter() - start
+
+    assert len(parsed.entries) == entries
+    print(f"index: {entries} entries, {len(data) / 2**20:.1f} MiB")
+    print(f"  write: {write_time:.2f}s")
+    print(f"  read:  {read_time:.2f}s")
+
+
+def bench_commit(files):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        git = tig.Git(temp_dir, dbType="fs")
+        git.init()
+
+        # every file is the same blob; only trees and commits get written below
+        blob_sha = git._write_object(tig.GitBlob(b"print('hello')\n"))
+        names = [f"src/package_{i // 10_000:02}/module_{i // 100 % 100:02}/file_{i % 100:02}.py" for i in range(files)]
+        git._write_index(tig.GitIndex([make_entry(i, blob_sha, name) for i, name in enumerate(names)]))
+
+        start = time.perf_counter()
+        git.commit("first", author="bench <bench@example.com>")
+        first_time = time.perf_counter() - start
+
+        index = git._get_index()
+        index.add(make_entry(0, git._write_object(tig.GitBlob(b"print('changed')\n")), names[0]))
+        git._write_index(index)
+
+        start = time.perf_counter()
+        git.commit("one changed file", author="bench <bench@example.com>")
+        incremental_time = time.perf_counter() - start
+
+        # the same change again, without the cached trees
+        index = git._get_index()
+        index.add(make_entry(0, blob_sha, names[0]))
+        index.cache_tree = {}
+        git._write_index(index)
+
+        start = time.perf_counter()
+        git.commit("one changed file, no cached trees", author="bench <bench@example.com>")
+        uncached_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print(f"commit: {files} files")
+    print(f"  first commit:                 {first_time:.2f}s")
+    print(f"  one changed file:             {incremental_time:.2f}s")
+    print(f"  one changed file, no cache:   {uncached_time:.2f}s")
+
+
+def bench_checkout(files):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        git = tig.Git(temp_dir, dbType="fs")
+        git.init()
+
+        start = time.perf_counter()
+        names = [f"src/package_{i // 10_000:02}/module_{i // 100 % 100:02}/file_{i % 100:02}.py" for i in range(files)]
+        with git.session():
+            entries = []
+            for i, name in enumerate(names):
+                sha = git._write_object(tig.GitBlob(f"# file {i}\n".encode() * 64))
+                entries.append(make_entry(i, sha, name))
+            git._write_index(tig.GitIndex(entries))
+            commit_sha = git.commit("everything", author="bench <bench@example.com>")
+        setup_time = time.perf_counter() - start
+
+        git.db.set("checkout", None)
+        start = time.perf_counter()
+        git.checkout(commit_sha, "checkout")
+        checkout_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print(f"checkout: {files} files ({setup_time:.1f}s to write them as objects)")
+    print(f"  checkout: {checkout_time:.2f}s")
+
+
+def bench_log(commits):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        git = tig.Git(temp_dir, dbType="fs")
+        git.init()
+
+        start = time.perf_counter()
+        tree_sha = git._write_object(tig.GitTree())
+        with git.session():
+            parent = None
+            for i in range(commits):
+                commit = tig.GitCommit()
+                commit.data = {"tree": tree_sha}
+                if parent:
+                    commit.data["parent"] = parent
+                signature = f"bench <bench@example.com> {1_700_000_000 + i} +0000"
+                commit.data.update({"author": signature, "committer": signature, None: f"commit {i}"})
+                parent = git._write_object(commit)
+            git._update_head(parent)
+        setup_time = time.perf_counter() - start
+
+        timings = []
+        for graph in (True, False):
+            git = tig.Git(temp_dir, dbType="fs")
+            if not graph:
+                git._commit_graph = tig.CommitGraph()
+            start = time.perf_counter()
+            assert len(list(git._iter_log(max_count=20))) == 20
+            last_20 = time.perf_counter() - start
+
+            start = time.perf_counter()
+            assert len(list(git._iter_log())) == commits
+            everything = time.perf_counter() - start
+            timings.append((last_20, everything))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print(f"log: {commits} commits ({setup_time:.1f}s to write them)")
+    for name, (last_20, everything) in zip(("commit-graph", "no commit-graph"), timings):
+        print(f"  {name + ':':17} last 20: {last_20 * 1000:.1f}ms, whole history: {everything:.2f}s")
+
+
+def bench_merge(files):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        git = tig.Git(temp_dir, dbType="fs")
+        git.init()
+
+        start = time.perf_counter()
+        names = [f"src/package_{i // 10_000:02}/module_{i // 100 % 100:02}/file_{i % 100:02}.py" for i in range(files)]
+        with git.session():
+            blob_sha = git._write_object(tig.GitBlob(b"\n".join(b"line %d" % i for i in range(20)) + b"\n"))
+            git._write_index(tig.GitIndex([make_entry(i, blob_sha, name) for i, name in enumerate(names)]))
+            base_sha = git.commit("base", author="bench <bench@example.com>")
+        git.db.set("working_dir", None)
+        git.checkout(base_sha, "working_dir")
+        git.db.set(".git/HEAD", b"ref: refs/heads/main", overwrite=True)
+        git.create_branch("feature")
+
+        # each side changes its own line of the same file, and a file of its own
+        def change(paths, old, new):
+            for path in paths:
+                content = git.db.get(f"working_dir/{path}")
+                git.db.set(f"working_dir/{path}", content.replace(old, new), overwrite=True)
+            git.add([f"working_dir/{path}" for path in paths])
+            git.commit(f"change {new!r}", author="bench <bench@example.com>")
+        change([names[0], names[files // 2]], b"line 3\n", b"main\n")
+        git.switch("feature")
+        change([names[0], names[-1]], b"line 15\n", b"feature\n")
+        git.switch("main")
+        setup_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        git.merge("feature", author="bench <bench@example.com>")
+        merge_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print(f"merge: {files} files ({setup_time:.1f}s to set up)")
+    print(f"  merge of two branches touching 3 files: {merge_time * 1000:.0f}ms")
+
+
+def bench_bitmap(commits, folders=20, files_per_folder=100):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        git = tig.Git(temp_dir, dbType="fs")
+        git.init()
+
+        # every commit changes one file: a blob, its folder's tree and the root tree are new
+        start = time.perf_counter()
+        with git.session():
+            def write_tree(nodes):
+                tree = tig.GitTree()
+                tree.data = nodes
+                return git._write_object(tree)
+
+            contents = [[tig.TreeNode("100644", f"file_{j:03}", git._write_object(tig.GitBlob(f"{i} {j}\n")))
+                for j in range(files_per_folder)] for i in range(folders)]
+            folder_trees = [write_tree(nodes) for nodes in contents]
+            parent = None
+            history = []
+            for i in range(commits):
+                folder, file = i % folders, i * 7 % files_per_folder
+                contents[folder][file] = contents[folder][file]._replace(sha=git._write_object(tig.GitBlob(f"commit {i}\n")))
+                folder_trees[folder] = write_tree(contents[folder])
+                root = write_tree([tig.TreeNode("040000", f"folder_{k:02}", sha) for k, sha in enumerate(folder_trees)])
+
+                commit = tig.GitCommit()
+                commit.data = {"tree": root}
+                if parent:
+                    commit.data["parent"] = parent
+                signature = f"bench <bench@example.com> {1_700_000_000 + i} +0000"
+                commit.data.update({"author": signature, "committer": signature, None: f"commit {i}"})
+                parent = git._write_object(commit)
+                history.append(parent)
+            git._update_head(parent)
+        setup_time = time.perf_counter() - start
+
+        timings = []
+        for bitmap in (False, True):
+            start = time.perf_counter()
+            git.repack(bitmap=bitmap)
+            repack_time = time.perf_counter() - start
+
+            # a fresh repository object, so nothing is served from the object cache
+            git = tig.Git(temp_dir, dbType="fs")
+            start = time.perf_counter()
+            count = git.count_objects(["HEAD"])
+            count_time = time.perf_counter() - start
+
+            git = tig.Git(temp_dir, dbType="fs")
+            start = time.perf_counter()
+            missing = git.rev_list_objects(["HEAD"], exclude=[history[-100]])
+            send_time = time.perf_counter() - start
+            timings.append((repack_time, count_time, send_time))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print(f"bitmap: {commits} commits, {count} objects ({setup_time:.1f}s to write them)")
+    print(f"  objects missing from a clone 100 commits behind: {len(missing)}")
+    for name, (repack_time, count_time, send_time) in zip(("no bitmaps:", "bitmaps:"), timings):
+        print(f"  {name:12} repack: {repack_time:.2f}s, count reachable: {count_time:.2f}s, "
+            f"what to send: {send_time:.2f}s")
+
+
+def bench_refs(refs):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        git = tig.Git(temp_dir, dbType="fs")
+        git.init()
+
+        start = time.perf_counter()
+        with git.session():
+            sha = git._write_object(tig.GitBlob(b"tagged\n"))
+            for i in range(refs):
+                git.create_ref("tags" if i % 2 else "heads", f"group_{i // 1000:03}/ref_{i:06}", sha)
+        setup_time = time.perf_counter() - start
+
+        timings = []
+        for packed in (False, True):
+            if packed:
+                git.pack_refs()
+            git = tig.Git(temp_dir, dbType="fs")
+            start = time.perf_counter()
+            listed = {}
+            git._get_all_references(".git/refs", listed)
+            assert len(listed) == refs
+            timings.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    print(f"refs: {refs} branches and tags ({setup_time:.1f}s to write them)")
+    for name, list_time in zip(("loose:", "packed:"), timings):
+        print(f"  {name:8} list every ref: {list_time:.2f}s")
+
+
+def bench_objects(commits):
+    # signed commits, like the ones a walk over a real history reads
+    signature = "-----BEGIN PGP SIGNATURE-----\n" + "\n".join("A" * 64 for _ in range(12)) + "\n-----END PGP SIGNATURE-----"
+    raws = [(
+        f"tree {i:040x}\nparent {i + 1:040x}\nauthor bench <bench@example.com> {1_700_000_000 + i} +0000\n"
+        f"committer bench <bench@example.com> {1_700_000_000 + i} +0000\ngpgsig {signature.replace(chr(10), chr(10) + ' ')}\n"
+        f"\ncommit {i}\n\n" + "A longer description of the change.\n" * 5
+    ).encode() for i in range(commits)]
+
+    timings = []
+    for name, read in (("tree + parents", lambda c: (c.tree, c.parents)), ("whole commit", lambda c: c.data)):
+        tracemalloc.start()
+        start = time.perf_counter()
+        # kept alive, like the object cache would
+        objects = [tig.GitCommit(raw) for raw in raws]
+        for commit in objects:
+            read(commit)
+        elapsed = time.perf_counter() - start
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del objects
+        timings.append((name, elapsed, allocated))
+
+    print(f"objects: {commits} signed commits")
+    for name, elapsed, allocated in timings:
+        print(f"  {name + ':':16} {elapsed:.2f}s, {allocated / 2**20:.0f} MiB allocated")
+
+
+def bench_trees(entries):
+    raw = b"".join(
+        (b"40000" if i % 10 == 0 else b"100644") + f" file_{i:07}".encode() + b"\x00" + i.to_bytes(20, "big")
+        for i in range(entries)
+    )
+    # the same tree, with one entry changed
+    changed = raw[:-20] + b"\xff" * 20
+
+    timings = []
+    for name, read in (
+        ("TreeNodes", lambda tree: list(tree.data)),
+        # walked without being kept, like ls_tree and the reachability walk do
+        ("raw entries", lambda tree: sum(1 for _ in tree.data.entries())),
+        ("serialize", lambda tree: tree.data.serialize()),
+        ("diff", lambda tree: sum(1 for _ in set(tree.data.entry_bytes()) ^ set(tig.CompactTree(changed).entry_bytes()))),
+    ):
+        start = time.perf_counter()
+        read(tig.GitTree(raw))
+        elapsed = time.perf_counter() - start
+        # tracing every allocation would dwarf the timings: memory gets a run of its own
+        tracemalloc.start()
+        read(tig.GitTree(raw))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        timings.append((name, elapsed, peak))
+
+    print(f"trees: {entries} entries")
+    for name, elapsed, peak in timings:
+        print(f"  {name + ':':14} {elapsed:.2f}s, {peak / 2**20:.0f} MiB peak")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    index_parser = subparsers.add_parser("index", help="write and read back a large index")
+    index_parser.add_argument("--entries", type=int, default=1_000_000)
+
+    commit_parser = subparsers.add_parser("commit", help="commit one changed file in a large tree")
+    commit_parser.add_argument("--files", type=int, default=100_000)
+
+    checkout_parser = subparsers.add_parser("checkout", help="check out a commit of many files")
+    checkout_parser.add_argument("--files", type=int, default=100_000)
+
+    log_parser = subparsers.add_parser("log", help="walk a long history")
+    log_parser.add_argument("--commits", type=int, default=100_000)
+
+    merge_parser = subparsers.add_parser("merge", help="merge two branches of a large tree")
+    merge_parser.add_argument("--files", type=int, default=100_000)
+
+    bitmap_parser = subparsers.add_parser("bitmap", help="count reachable objects with and without bitmaps")
+    bitmap_parser.add_argument("--commits", type=int, default=2_000)
+
+    refs_parser = subparsers.add_parser("refs", help="list many branches and tags, loose and packed")
+    refs_parser.add_argument("--refs", type=int, default=50_000)
+
+    objects_parser = subparsers.add_parser("objects", help="read the tree and parents of many commits")
+    objects_parser.add_argument("--commits", type=int, default=100_000)
+
+    trees_parser = subparsers.add_parser("trees", help="read, serialize and diff a large tree")
+    trees_parser.add_argument("--entries", type=int, default=200_000)
+
+    args = parser.parse_args()
+    if args.benchmark == "index":
+        bench_index(args.entries)
+    elif args.benchmark == "commit":
+        bench_commit(args.files)
+    elif args.benchmark == "checkout":
+        bench_checkout(args.files)
+    elif args.benchmark == "log":
+        bench_log(args.commits)
+    elif args.benchmark == "merge":
+        bench_merge(args.files)
+    elif args.benchmark == "bitmap":
+        bench_bitmap(args.commits)
+    elif args.benchmark == "refs":
+        bench_refs(args.refs)
+    elif args.benchmark == "objects":
+        bench_objects(args.commits)
+    elif args.benchmark == "trees":
+        bench_trees(args.entries)
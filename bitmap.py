@@ -0,0 +1,182 @@
+"""
+Reachability bitmaps: for selected commits of a pack, one bit per object of the pack, set for every object the commit
+reaches. What a commit reaches is then its bitmap, OR'ed with what the commits since the nearest bitmapped ones add,
+so counting, diffing or pruning reachable objects is mostly bitwise operations instead of reading every commit and tree.
+This is git's own format, so either tool can read the other's bitmaps.
+
+Bit N stands for the Nth object of the pack in pack order (by offset), not in .idx order.
+
+BITMAP FILE (version 1), next to its pack as pack-<sha>.bitmap:
+    HEADER: "BITM", VERSION (2 bytes, = 1), FLAGS (2 bytes, 0x1 = every reachable object is in the pack),
+            NUMBER OF ENTRIES (4 bytes), PACK CHECKSUM (20 bytes)
+    TYPE BITMAPS: the commits, trees, blobs and tags of the pack (4 EWAH bitmaps)
+    ENTRIES:
+        POSITION OF THE COMMIT IN THE .IDX (4 bytes)
+        XOR OFFSET (1 byte): if not 0, the bitmap is stored XOR'ed with the one of the entry that many entries back
+        FLAGS (1 byte)
+        EWAH BITMAP
+    CHECKSUM: SHA-1 of everything above (20 bytes)
+
+EWAH BITMAP:
+    NUMBER OF BITS (4 bytes), NUMBER OF WORDS (4 bytes), WORDS (8 bytes each), POSITION OF THE LAST MARKER WORD (4 bytes)
+    The words are runs of identical all-0 or all-1 words, compressed into a marker word, each followed by the literal
+    words that don't compress: a marker holds the bit of the run (bit 0), the length of the run (bits 1-32) and the
+    number of literal words after it (bits 33-63). Bit N of the bitmap is bit N % 64 of word N // 64.
+"""
+
+import struct
+import hashlib
+
+SIGNATURE = b"BITM"
+FLAG_FULL_DAG = 0x1
+
+TYPE_ORDER = ("commit", "tree", "blob", "tag")
+
+FULL_WORD = 0xFFFFFFFFFFFFFFFF
+MAX_RUN = 0xFFFFFFFF
+MAX_LITERALS = 0x7FFFFFFF
+
+# a new commit is bitmapped once it's this many commits away from the last bitmapped one
+BITMAP_INTERVAL = 100
+
+
+"""
+EWAH
+"""
+
+def ewah_encode(bits):
+    """
+    Compresses the bitmap `bits` (a Python int, bit N set for position N).
+    """
+    bit_size = bits.bit_length()
+    word_count = (bit_size + 63) // 64
+    words = struct.unpack(f"<{word_count}Q", bits.to_bytes(8 * word_count, "little"))
+
+    out = []
+    marker = 0
+    i = 0
+    while i < word_count or not out:
+        run_bit = run_length = 0
+        if i < word_count and words[i] in (0, FULL_WORD):
+            run_word = words[i]
+            run_bit = 1 if run_word == FULL_WORD else 0
+            while i < word_count and words[i] == run_word and run_length < MAX_RUN:
+                run_length += 1
+                i += 1
+
+        start = i
+        while i < word_count and words[i] not in (0, FULL_WORD) and i - start < MAX_LITERALS:
+            i += 1
+
+        marker = len(out)
+        out.append(run_bit | (run_length << 1) | ((i - start) << 33))
+        out.extend(words[start:i])
+
+    return struct.pack(f">II{len(out)}QI", bit_size, len(out), *out, marker)
+
+def ewah_decode(data, pos=0):
+    """
+    Returns (bits, position after the bitmap) for the EWAH bitmap at `pos` in `data`.
+    """
+    bit_size, word_count = struct.unpack_from(">II", data, pos)
+    words = struct.unpack_from(f">{word_count}Q", data, pos + 8)
+
+    chunks = []
+    i = 0
+    while i < word_count:
+        marker = words[i]
+        run_length = (marker >> 1) & MAX_RUN
+        literals = marker >> 33
+        chunks.append((b"\xff" if marker & 1 else b"\x00") * (8 * run_length))
+        chunks.append(struct.pack(f"<{literals}Q", *words[(i + 1):(i + 1 + literals)]))
+        i += 1 + literals
+
+    bits = int.from_bytes(b"".join(chunks), "little")
+    # a run of ones may go past the last bit
+    return bits & ((1 << bit_size) - 1), pos + 8 + 8 * word_count + 4
+
+
+"""
+WRITING
+"""
+
+def write_bitmap(pack_checksum, type_bitmaps, entries):
+    """
+    type_bitmaps: {"commit"/"tree"/"blob"/"tag": bits of the objects of that type}
+    entries: [(position of the commit in the .idx, bits of every object it reaches)]
+
+    Returns the bytes of the .bitmap file.
+    """
+    chunks = [SIGNATURE + struct.pack(">HHI", 1, FLAG_FULL_DAG, len(entries)) + pack_checksum]
+    chunks.extend(ewah_encode(type_bitmaps.get(fmt, 0)) for fmt in TYPE_ORDER)
+    for idx_position, bits in entries:
+        chunks.append(struct.pack(">IBB", idx_position, 0, 0) + ewah_encode(bits))
+
+    data = b"".join(chunks)
+    return data + hashlib.sha1(data).digest()
+
+
+"""
+READING
+"""
+
+class PackBitmap():
+    """
+    The bitmaps of one pack. Entries are only decompressed (and un-XOR'ed) when asked for.
+    """
+    def __init__(self, data, pack_checksum):
+        self.data = memoryview(data)
+        if bytes(self.data[:4]) != SIGNATURE:
+            raise Exception("Not a bitmap: bad signature.")
+        version, flags, count = struct.unpack_from(">HHI", self.data, 4)
+        if version != 1:
+            raise Exception(f"tig only supports bitmap version 1. This bitmap is version {version}.")
+        if not flags & FLAG_FULL_DAG:
+            raise Exception("tig only supports bitmaps of packs that hold every object their commits reach.")
+        if bytes(self.data[12:32]) != pack_checksum:
+            raise Exception("The bitmap belongs to another pack.")
+
+        pos = 32
+        self.types = {}
+        for fmt in TYPE_ORDER:
+            self.types[fmt], pos = ewah_decode(self.data, pos)
+
+        # idx position -> (offset of its EWAH bitmap, xor offset, entry number)
+        self._entries = {}
+        self._offsets = []
+        for i in range(count):
+            idx_position, xor_offset, _ = struct.unpack_from(">IBB", self.data, pos)
+            self._entries[idx_position] = (pos + 6, xor_offset, i)
+            self._offsets.append((pos + 6, xor_offset))
+            bit_size, word_count = struct.unpack_from(">II", self.data, pos + 6)
+            pos += 6 + 8 + 8 * word_count + 4
+        self._decoded = {}
+
+    def __contains__(self, idx_position):
+        return idx_position in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def commits(self):
+        return list(self._entries)
+
+    def get(self, idx_position):
+        """
+        Returns the bits of every object the commit at `idx_position` (in the .idx) reaches, or None if it has no
+        bitmap.
+        """
+        entry = self._entries.get(idx_position)
+        if entry is None:
+            return None
+        return self._decode(entry[2])
+
+    def _decode(self, i):
+        bits = self._decoded.get(i)
+        if bits is None:
+            offset, xor_offset = self._offsets[i]
+            bits, _ = ewah_decode(self.data, offset)
+            if xor_offset:
+                bits ^= self._decode(i - xor_offset)
+            self._decoded[i] = bits
+        return bits
@@ -0,0 +1,300 @@
+"""
+Commit-graphs: the root tree, parents, generation number and commit time of every commit in fixed-width tables
+addressed by position, so that history walks never have to inflate and parse commit objects. This is git's own
+format, so either tool can read the other's graphs.
+
+Graphs are kept as a chain of layers, like `git commit-graph write --split`. New commits go into a new layer on
+top, which is merged with the layers below it whenever it gets at least half as large as the one under it:
+    .git/objects/info/commit-graphs/commit-graph-chain    hex checksum of every layer, the bottom one first
+    .git/objects/info/commit-graphs/graph-<checksum>.graph
+
+GRAPH FILE (version 1):
+    HEADER: "CGPH", VERSION (1 byte, = 1), HASH VERSION (1 byte, = 1 for SHA-1), NUMBER OF CHUNKS (1 byte),
+            NUMBER OF BASE LAYERS (1 byte)
+    CHUNK LOOKUP ((chunks + 1) x 12 bytes): CHUNK ID (4 bytes), OFFSET (8 bytes). The last ID is 0, and its offset
+            is where the last chunk ends
+    OIDF: FANOUT TABLE (256 x 4 bytes), as in a pack index
+    OIDL: SORTED SHA-1s (N x 20 bytes)
+    CDAT (N x 36 bytes): ROOT TREE (20 bytes), FIRST PARENT, SECOND PARENT (4 bytes each),
+          GENERATION << 2 | top 2 bits of the COMMIT TIME (4 bytes), low 32 bits of the COMMIT TIME (4 bytes)
+    EDGE: the parents after the first one of octopus merges (4 bytes each; the last one of every commit has the MSB
+          set)
+    BASE: checksums of the layers below (20 bytes each)
+    CHECKSUM: SHA-1 of everything above (20 bytes)
+
+Positions count across the whole chain, starting with the commits of the bottom layer. A missing parent is
+0x70000000, and a second parent with the MSB set is the index in EDGE of the commit's remaining parents.
+
+The generation of a commit is 1 + the largest generation of its parents (1 for a root commit), so an ancestor always
+has a smaller generation than its descendants: a walk looking for a commit can skip everything older than it.
+"""
+
+import struct
+import hashlib
+
+SIGNATURE = b"CGPH"
+CHAIN_PATH = ".git/objects/info/commit-graphs/commit-graph-chain"
+LAYERS_PATH = ".git/objects/info/commit-graphs"
+
+CHUNK_OIDF = b"OIDF"
+CHUNK_OIDL = b"OIDL"
+CHUNK_CDAT = b"CDAT"
+CHUNK_EDGE = b"EDGE"
+CHUNK_BASE = b"BASE"
+
+PARENT_NONE = 0x70000000
+PARENT_OCTOPUS = 0x80000000
+GENERATION_MAX = 0x3FFFFFFF
+CDAT_ENTRY = struct.Struct(">20sIIII")
+
+
+"""
+WRITING
+"""
+
+def write_graph_layer(commits, base=None):
+    """
+    Returns (data, checksum) of a layer holding `commits`, {sha: (tree, [parent shas], commit time)} in hex, on top of
+    the CommitGraph `base`. Every parent must be in `commits` or in `base`.
+    """
+    shas = sorted(commits)
+    base_count = len(base) if base is not None else 0
+    positions = {sha: base_count + i for i, sha in enumerate(shas)}
+
+    def position(sha):
+        pos = positions.get(sha)
+        if pos is None and base is not None:
+            pos = base.find(sha)
+        if pos is None:
+            raise Exception(f"Commit {sha} isn't in the commit-graph.")
+        return pos
+
+    generations = _generations(commits, base)
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    cdat = bytearray()
+    edges = []
+    for sha in shas:
+        tree, parents, commit_time = commits[sha]
+        parent_positions = [position(parent) for parent in parents]
+        first = parent_positions[0] if parent_positions else PARENT_NONE
+        if len(parent_positions) <= 2:
+            second = parent_positions[1] if len(parent_positions) == 2 else PARENT_NONE
+        else:
+            second = PARENT_OCTOPUS | len(edges)
+            edges.extend(parent_positions[1:])
+            edges[-1] |= PARENT_OCTOPUS
+        cdat += CDAT_ENTRY.pack(
+            bytes.fromhex(tree), first, second,
+            (generations[sha] << 2) | ((commit_time >> 32) & 0x3), commit_time & 0xFFFFFFFF
+        )
+
+    chunks = [
+        (CHUNK_OIDF, struct.pack(">256I", *fanout)),
+        (CHUNK_OIDL, b"".join(bytes.fromhex(sha) for sha in shas)),
+        (CHUNK_CDAT, bytes(cdat)),
+    ]
+    if edges:
+        chunks.append((CHUNK_EDGE, struct.pack(f">{len(edges)}I", *edges)))
+    if base is not None and base.layers:
+        chunks.append((CHUNK_BASE, b"".join(layer.checksum for layer in base.layers)))
+
+    base_layers = len(base.layers) if base is not None else 0
+    header = SIGNATURE + bytes([1, 1, len(chunks), base_layers])
+    offset = len(header) + 12 * (len(chunks) + 1)
+    lookup = []
+    for chunk_id, chunk in chunks:
+        lookup.append(chunk_id + struct.pack(">Q", offset))
+        offset += len(chunk)
+    lookup.append(b"\x00" * 4 + struct.pack(">Q", offset))
+
+    data = header + b"".join(lookup) + b"".join(chunk for _, chunk in chunks)
+    checksum = hashlib.sha1(data).digest()
+    return data + checksum, checksum.hex()
+
+def _generations(commits, base):
+    # iterative, since a long history would blow the recursion limit
+    generations = {}
+    for sha in commits:
+        stack = [sha]
+        while stack:
+            current = stack[-1]
+            if current in generations:
+                stack.pop()
+                continue
+
+            missing = [parent for parent in commits[current][1] if parent in commits and parent not in generations]
+            if missing:
+                stack.extend(missing)
+                continue
+
+            generation = 0
+            for parent in commits[current][1]:
+                if parent in generations:
+                    generation = max(generation, generations[parent])
+                else:
+                    generation = max(generation, base.generation(base.find(parent)))
+            generations[current] = min(generation + 1, GENERATION_MAX)
+            stack.pop()
+    return generations
+
+
+"""
+READING
+"""
+
+class CommitGraphLayer():
+    def __init__(self, data, base_count=0):
+        self.data = memoryview(data)
+        self.base_count = base_count
+
+        if bytes(self.data[:4]) != SIGNATURE:
+            raise Exception("Not a commit-graph: bad signature.")
+        version, hash_version, chunk_count, self.base_layers = self.data[4:8]
+        if version != 1:
+            raise Exception(f"tig only supports commit-graph version 1. This graph is version {version}.")
+        if hash_version != 1:
+            raise Exception(f"tig only supports SHA-1 commit-graphs. This graph uses hash version {hash_version}.")
+
+        self.chunks = {}
+        for i in range(chunk_count):
+            chunk_id = bytes(self.data[(8 + 12 * i):(12 + 12 * i)])
+            start = struct.unpack_from(">Q", self.data, 12 + 12 * i)[0]
+            end = struct.unpack_from(">Q", self.data, 24 + 12 * i)[0]
+            self.chunks[chunk_id] = (start, end)
+        for chunk_id in (CHUNK_OIDF, CHUNK_OIDL, CHUNK_CDAT):
+            if chunk_id not in self.chunks:
+                raise Exception(f"The commit-graph has no {chunk_id.decode()} chunk.")
+
+        self.fanout = struct.unpack_from(">256I", self.data, self.chunks[CHUNK_OIDF][0])
+        self.count = self.fanout[255]
+        self._names = self.chunks[CHUNK_OIDL][0]
+        self._cdat = self.chunks[CHUNK_CDAT][0]
+        self._edges = self.chunks.get(CHUNK_EDGE, (0, 0))[0]
+
+    @property
+    def checksum(self):
+        return bytes(self.data[-20:])
+
+    def base_checksums(self):
+        if CHUNK_BASE not in self.chunks:
+            return []
+        start, end = self.chunks[CHUNK_BASE]
+        return [bytes(self.data[pos:(pos + 20)]) for pos in range(start, end, 20)]
+
+    def sha(self, i):
+        start = self._names + 20 * i
+        return bytes(self.data[start:(start + 20)])
+
+    def find(self, sha_bytes):
+        """
+        Returns the position of `sha_bytes` in this layer (not counting the layers below) or None.
+        """
+        first = sha_bytes[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha(mid) < sha_bytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.fanout[first] and self.sha(lo) == sha_bytes:
+            return lo
+        return None
+
+    def entry(self, i):
+        """
+        Returns (tree, [parent positions], generation, commit time).
+        """
+        tree, first, second, generation, time_low = CDAT_ENTRY.unpack_from(self.data, self._cdat + 36 * i)
+        parents = []
+        if first != PARENT_NONE:
+            parents.append(first)
+        if second & PARENT_OCTOPUS:
+            pos = self._edges + 4 * (second & ~PARENT_OCTOPUS)
+            while True:
+                edge = struct.unpack_from(">I", self.data, pos)[0]
+                parents.append(edge & ~PARENT_OCTOPUS)
+                if edge & PARENT_OCTOPUS:
+                    break
+                pos += 4
+        elif second != PARENT_NONE:
+            parents.append(second)
+        return tree, parents, generation >> 2, ((generation & 0x3) << 32) | time_low
+
+
+class CommitGraph():
+    """
+    Every layer of a chain, read as one graph. Commits are addressed by their position in the chain.
+
+    `layers` are the raw layers, the bottom one first. The bottom layers of another graph can be passed as they are.
+    """
+    def __init__(self, layers=()):
+        self.layers = []
+        self.count = 0
+        for layer in layers:
+            if not isinstance(layer, CommitGraphLayer):
+                layer = CommitGraphLayer(layer, self.count)
+            if layer.base_checksums() != [l.checksum for l in self.layers]:
+                raise Exception("The commit-graph chain is inconsistent: a layer doesn't sit on the layers below it.")
+            self.layers.append(layer)
+            self.count += layer.count
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, sha):
+        return self.find(sha) is not None
+
+    def _layer(self, pos):
+        for layer in reversed(self.layers):
+            if pos >= layer.base_count:
+                return layer
+        raise Exception(f"Position {pos} is out of the commit-graph.")
+
+    def find(self, sha):
+        """
+        Returns the position of the commit `sha` (hex) or None.
+        """
+        sha_bytes = bytes.fromhex(sha)
+        for layer in self.layers:
+            i = layer.find(sha_bytes)
+            if i is not None:
+                return layer.base_count + i
+        return None
+
+    def sha(self, pos):
+        layer = self._layer(pos)
+        return layer.sha(pos - layer.base_count).hex()
+
+    def entry(self, pos):
+        """
+        Returns (tree, [parent positions], generation, commit time) of the commit at `pos`.
+        """
+        layer = self._layer(pos)
+        tree, parents, generation, commit_time = layer.entry(pos - layer.base_count)
+        return tree.hex(), parents, generation, commit_time
+
+    def parents(self, pos):
+        return self.entry(pos)[1]
+
+    def generation(self, pos):
+        return self.entry(pos)[2]
+
+    def commits(self, layers=None):
+        """
+        Returns {sha: (tree, [parent shas], commit time)} for the commits of `layers` (all of them by default), in
+        the form `write_graph_layer` takes.
+        """
+        commits = {}
+        for layer in (self.layers if layers is None else layers):
+            for i in range(layer.count):
+                tree, parents, _, commit_time = self.entry(layer.base_count + i)
+                commits[layer.sha(i).hex()] = (tree, [self.sha(parent) for parent in parents], commit_time)
+        return commits
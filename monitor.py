@@ -0,0 +1,354 @@
+"""
+An optional filesystem monitor for the working tree, on Linux (inotify, through ctypes).
+
+    python monitor.py <repository> [worktree]
+
+The monitor watches every folder of the working tree and appends each path that changes to a journal in
+.git/monitor. `Git.status` and `Git.add` then only look at the paths journaled since the token stored in the index,
+instead of stat'ing every file.
+
+The journal is a header line holding an epoch, followed by NUL-terminated records: b"P" + path for a changed path
+(relative to the working tree; a folder stands for everything under it) and b"C" + name for a cookie. A token is
+"<epoch>:<offset into the journal>". When inotify's queue overflows, or the journal grows past MAX_JOURNAL_SIZE, the
+journal starts over under a new epoch, so every older token stops being valid and its holder falls back to a full scan.
+
+Cookies make queries exact: a client creates a file in .git/monitor/cookies and waits for the monitor to journal
+it. Everything that happened in the working tree before that is then journaled too.
+"""
+
+import os
+import sys
+import time
+import struct
+import signal
+import ctypes
+import itertools
+import subprocess
+
+MAX_JOURNAL_SIZE = 16 * 1024 * 1024
+JOURNAL_MAGIC = b"TGJ1"
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+INOTIFY_EVENT = struct.Struct("iIII")
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+def available():
+    """
+    True if this platform has inotify.
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        _get_libc().inotify_init1
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+class Journal():
+    """
+    The client side: reads the journal kept by a running monitor.
+    """
+    _cookies = itertools.count()
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, "journal")
+
+    def running(self):
+        try:
+            with open(os.path.join(self.folder, "pid")) as f:
+                os.kill(int(f.read()), 0)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def sync(self, timeout=1.0):
+        """
+        Returns a token for "now", or None if no monitor is running.
+        """
+        synced = self._wait_for_cookie(None, timeout)
+        return None if synced is None else synced[1]
+
+    def changes_since(self, token, timeout=1.0):
+        """
+        Returns (paths changed since `token`, new token), or None if the journal can't account for everything since
+        `token`: no monitor is running, or it restarted or overflowed in the meantime.
+        """
+        return self._wait_for_cookie(token, timeout)
+
+    def _read_header(self, f):
+        header = f.readline()
+        if not header.startswith(JOURNAL_MAGIC + b" "):
+            return None
+        return header[len(JOURNAL_MAGIC) + 1:].strip().decode()
+
+    def _wait_for_cookie(self, token, timeout):
+        if not available() or not self.running():
+            return None
+
+        try:
+            with open(self.path, "rb") as f:
+                epoch = self._read_header(f)
+                start = f.seek(0, os.SEEK_END)
+        except OSError:
+            return None
+
+        if token is not None:
+            token_epoch, _, offset = token.partition(":")
+            if token_epoch != epoch or not offset.isdigit() or int(offset) > start:
+                return None
+            start = int(offset)
+
+        cookie = f"{os.getpid()}-{next(self._cookies)}-{os.urandom(4).hex()}"
+        cookie_path = os.path.join(self.folder, "cookies", cookie)
+        try:
+            open(cookie_path, "wb").close()
+        except OSError:
+            return None
+
+        try:
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                with open(self.path, "rb") as f:
+                    if self._read_header(f) != epoch:
+                        return None
+                    f.seek(start)
+                    data = f.read()
+
+                paths = set()
+                pos = 0
+                while True:
+                    end = data.find(b"\x00", pos)
+                    if end == -1:
+                        break
+                    kind, value = data[pos:pos + 1], data[pos + 1:end].decode("utf8", "surrogateescape")
+                    pos = end + 1
+                    if kind == b"P":
+                        paths.add(value)
+                    elif kind == b"C" and value == cookie:
+                        return paths, f"{epoch}:{start + pos}"
+                time.sleep(0.001)
+            return None
+        finally:
+            try:
+                os.unlink(cookie_path)
+            except OSError:
+                pass
+
+
+class Monitor():
+    """
+    The daemon side: watches the working tree and keeps the journal.
+    """
+    def __init__(self, repository, worktree="working_dir"):
+        self.root = os.path.abspath(os.path.join(repository, worktree))
+        self.folder = os.path.join(os.path.abspath(repository), ".git", "monitor")
+        self.cookies = os.path.join(self.folder, "cookies")
+        self.journal_path = os.path.join(self.folder, "journal")
+
+        self.fd = None
+        self.journal = None
+        self.journal_size = 0
+        self.watches = {} # wd -> folder relative to the working tree
+        self.cookie_wd = None
+
+    def _watch(self, relpath):
+        libc = _get_libc()
+        path = os.path.join(self.root, relpath) if relpath else self.root
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            # the folder may be gone already; its deletion is journaled by its parent
+            return
+        self.watches[wd] = relpath
+
+    def _watch_tree(self, relpath):
+        """
+        Watches `relpath` and every folder under it, and returns every path under it: they may have been created
+        before the watches were.
+        """
+        found = []
+        top = os.path.join(self.root, relpath) if relpath else self.root
+        for folder, dirs, files in os.walk(top):
+            folder_relpath = os.path.relpath(folder, self.root)
+            folder_relpath = "" if folder_relpath == "." else folder_relpath
+            self._watch(folder_relpath)
+            found.extend(os.path.join(folder_relpath, name) for name in dirs + files)
+        return found
+
+    def _unwatch_tree(self, relpath):
+        libc = _get_libc()
+        for wd, watched in list(self.watches.items()):
+            if watched == relpath or watched.startswith(relpath + "/"):
+                libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def _start_journal(self):
+        """
+        Starts the journal over under a new epoch, which invalidates every token handed out so far.
+        """
+        if self.journal is not None:
+            os.close(self.journal)
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(JOURNAL_MAGIC + b" " + os.urandom(8).hex().encode() + b"\n")
+        os.replace(temp_path, self.journal_path)
+        self.journal = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND)
+        self.journal_size = os.fstat(self.journal).st_size
+
+    def _append(self, records):
+        if not records:
+            return
+        data = b"".join(records)
+        if self.journal_size + len(data) > MAX_JOURNAL_SIZE:
+            self._start_journal()
+            # the new epoch still has to see the cookies, or their clients would wait for nothing
+            data = b"".join(r for r in records if r.startswith(b"C"))
+        os.write(self.journal, data)
+        self.journal_size += len(data)
+
+    def _record(self, relpath):
+        return b"P" + os.fsencode(relpath) + b"\x00"
+
+    def _handle(self, wd, mask, name):
+        if wd == self.cookie_wd:
+            return [b"C" + name + b"\x00"] if mask & IN_CREATE else []
+
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return []
+        folder = self.watches.get(wd)
+        if folder is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # reported by the parent folder
+            return []
+
+        relpath = os.path.join(folder, os.fsdecode(name)) if name else folder
+        records = [self._record(relpath)]
+        if mask & IN_ISDIR:
+            if mask & IN_MOVED_FROM:
+                # the watches would keep reporting the old paths
+                self._unwatch_tree(relpath)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                records.extend(self._record(p) for p in self._watch_tree(relpath))
+        return records
+
+    def run(self):
+        libc = _get_libc()
+        os.makedirs(self.cookies, exist_ok=True)
+        for name in os.listdir(self.cookies):
+            os.unlink(os.path.join(self.cookies, name))
+
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.cookie_wd = libc.inotify_add_watch(self.fd, os.fsencode(self.cookies), IN_CREATE | IN_ONLYDIR)
+        self._watch_tree("")
+
+        # tokens are only handed out once every folder is watched
+        self._start_journal()
+        pid_path = os.path.join(self.folder, "pid")
+        with open(pid_path, "w") as f:
+            f.write(str(os.getpid()))
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                data = os.read(self.fd, 64 * 1024)
+                records = []
+                pos = 0
+                while pos < len(data):
+                    wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, pos)
+                    name = data[pos + INOTIFY_EVENT.size:pos + INOTIFY_EVENT.size + length].rstrip(b"\x00")
+                    pos += INOTIFY_EVENT.size + length
+
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost: nobody can trust the journal up to here anymore, and folders created in
+                        # the meantime aren't watched yet
+                        self._start_journal()
+                        records = [r for r in records if r.startswith(b"C")]
+                        self._watch_tree("")
+                        continue
+                    records.extend(self._handle(wd, mask, name))
+                self._append(records)
+        finally:
+            try:
+                os.unlink(pid_path)
+            except OSError:
+                pass
+            os.close(self.fd)
+
+
+def spawn(repository, worktree="working_dir", timeout=5.0):
+    """
+    Starts a monitor for `repository` in the background and waits until it's ready to answer queries.
+    """
+    folder = os.path.join(os.path.abspath(repository), ".git", "monitor")
+    journal = Journal(folder)
+    if journal.running():
+        return
+
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), repository, worktree],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+    )
+    deadline = time.monotonic() + timeout
+    while not journal.running():
+        if process.poll() is not None or time.monotonic() > deadline:
+            raise Exception(f"The monitor for {repository} didn't start.")
+        time.sleep(0.01)
+    return process
+
+def stop(repository, timeout=5.0):
+    folder = os.path.join(os.path.abspath(repository), ".git", "monitor")
+    try:
+        with open(os.path.join(folder, "pid")) as f:
+            pid = int(f.read())
+        os.kill(pid, signal.SIGTERM)
+    except (OSError, ValueError):
+        return
+
+    deadline = time.monotonic() + timeout
+    while Journal(folder).running() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("usage: python monitor.py <repository> [worktree]")
+        sys.exit(1)
+    if not available():
+        print("tig's monitor needs inotify (Linux).")
+        sys.exit(1)
+    Monitor(*sys.argv[1:]).run()
@@ -0,0 +1,510 @@
+"""
+Packfiles: many objects stored in one file, most of them as deltas against a similar object.
+
+PACK FILE:
+    HEADER (12 bytes): "PACK", VERSION (4 bytes, = 2), NUMBER OF OBJECTS (4 bytes)
+    ENTRIES:
+        TYPE + INFLATED SIZE (variable length)
+        OFS_DELTA only: NEGATIVE OFFSET OF THE BASE (variable length)
+        REF_DELTA only: SHA-1 OF THE BASE (20 bytes)
+        ZLIB-DEFLATED CONTENT (the object itself, or the delta against its base)
+    SHA-1 OF EVERYTHING ABOVE (20 bytes)
+
+IDX FILE (version 2):
+    "\\377tOc", VERSION (4 bytes, = 2)
+    FANOUT TABLE (256 x 4 bytes): entry N = number of objects whose first byte is <= N
+    SORTED SHA-1s (N x 20 bytes)
+    CRC32s OF THE PACKED ENTRIES (N x 4 bytes)
+    PACK OFFSETS (N x 4 bytes, MSB set = index into the large offset table)
+    LARGE OFFSETS (M x 8 bytes)
+    PACK CHECKSUM, IDX CHECKSUM (20 bytes each)
+
+A pack may also have reachability bitmaps (pack-<sha>.bitmap, see bitmap.py).
+"""
+
+import struct
+import zlib
+import hashlib
+from utils import LRUCache, encode_offset, decode_offset
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_CODES = {"commit": OBJ_COMMIT, "tree": OBJ_TREE, "blob": OBJ_BLOB, "tag": OBJ_TAG}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+IDX_SIGNATURE = b"\377tOc"
+DELTA_BLOCK_SIZE = 16
+MAX_COPY_SIZE = 0xFFFFFF
+MAX_INSERT_SIZE = 0x7F
+
+
+"""
+DELTAS
+"""
+
+def _encode_size(n):
+    # little-endian groups of 7 bits, MSB set on every byte but the last
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def _decode_size(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return n, pos
+
+def _encode_copy(offset, size):
+    cmd = 0x80
+    args = bytearray()
+    for i in range(4):
+        byte = (offset >> (8 * i)) & 0xFF
+        if byte:
+            cmd |= 1 << i
+            args.append(byte)
+    for i in range(3):
+        byte = (size >> (8 * i)) & 0xFF
+        if byte:
+            cmd |= 1 << (4 + i)
+            args.append(byte)
+    return bytes([cmd]) + bytes(args)
+
+def _flush_insert(out, pending):
+    for pos in range(0, len(pending), MAX_INSERT_SIZE):
+        chunk = pending[pos:(pos + MAX_INSERT_SIZE)]
+        out.append(len(chunk))
+        out += chunk
+    pending.clear()
+
+def create_delta(base, target):
+    """
+    Encodes `target` as a git delta against `base`: a list of "copy this range of the base" and "insert these
+    literal bytes" instructions.
+
+    Every aligned 16-byte block of the base is indexed; the target is then scanned for those blocks, and each hit
+    is extended forwards (and backwards into any pending literal bytes) as far as the two buffers agree.
+    """
+    out = bytearray(_encode_size(len(base)) + _encode_size(len(target)))
+
+    blocks = {}
+    for offset in range(0, len(base) - DELTA_BLOCK_SIZE + 1, DELTA_BLOCK_SIZE):
+        blocks.setdefault(base[offset:(offset + DELTA_BLOCK_SIZE)], offset)
+
+    pending = bytearray()
+    pos = 0
+    while pos < len(target):
+        offset = blocks.get(target[pos:(pos + DELTA_BLOCK_SIZE)]) if pos + DELTA_BLOCK_SIZE <= len(target) else None
+        if offset is None:
+            pending.append(target[pos])
+            pos += 1
+            continue
+
+        # extend backwards into the literal bytes we were about to insert
+        while pending and offset > 0 and base[offset - 1] == pending[-1]:
+            offset -= 1
+            pos -= 1
+            pending.pop()
+
+        length = DELTA_BLOCK_SIZE
+        while pos + length < len(target) and offset + length < len(base) and target[pos + length] == base[offset + length]:
+            length += 1
+
+        _flush_insert(out, pending)
+        for copied in range(0, length, MAX_COPY_SIZE):
+            out += _encode_copy(offset + copied, min(MAX_COPY_SIZE, length - copied))
+        pos += length
+
+    _flush_insert(out, pending)
+    return bytes(out)
+
+def apply_delta(base, delta):
+    base_size, pos = _decode_size(delta, 0)
+    if base_size != len(base):
+        raise Exception(f"Delta expects a base of {base_size} bytes; the base is {len(base)} bytes long.")
+    target_size, pos = _decode_size(delta, pos)
+
+    out = bytearray()
+    while pos < len(delta):
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if cmd & (1 << (4 + i)):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset:(offset + (size or 0x10000))]
+        elif cmd:
+            out += delta[pos:(pos + cmd)]
+            pos += cmd
+        else:
+            raise Exception("Delta contains the reserved instruction 0.")
+
+    if len(out) != target_size:
+        raise Exception(f"Delta produced {len(out)} bytes instead of {target_size}.")
+    return bytes(out)
+
+
+"""
+WRITING
+"""
+
+def _encode_entry_header(type_code, size):
+    byte = (type_code << 4) | (size & 0x0F)
+    size >>= 4
+    out = bytearray()
+    while size:
+        out.append(byte | 0x80)
+        byte = size & 0x7F
+        size >>= 7
+    out.append(byte)
+    return bytes(out)
+
+def write_pack(objects, window=10, depth=50, ofs_delta=True, compression_level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    objects: iterable of (sha, fmt, content), with `sha` a hex string and `fmt` one of "commit", "tree", "blob", "tag"
+
+    Every object is compared against the previous `window` objects of the same type (largest first, so deltas mostly
+    delete data) and stored as a delta when that is at most half its size, with chains capped at `depth`.
+    Bases are referenced by negative offset (OFS_DELTA) or, with `ofs_delta=False`, by SHA (REF_DELTA).
+
+    Returns (pack_bytes, idx_bytes, pack_sha).
+    """
+    objects = sorted(objects, key=lambda o: (TYPE_CODES[o[1]], -len(o[2])))
+
+    chunks = [b"PACK" + struct.pack(">II", 2, len(objects))]
+    pos = len(chunks[0])
+    offsets = {}
+    crcs = {}
+    chain_depth = {}
+    candidates = []
+
+    for sha, fmt, content in objects:
+        best = None
+        for base_sha, base_fmt, base_content in candidates:
+            if base_fmt != fmt or chain_depth[base_sha] >= depth:
+                continue
+            # a delta can't be smaller than the difference in sizes, so don't bother with very different objects
+            if abs(len(base_content) - len(content)) >= len(content) // 2:
+                continue
+            delta = create_delta(base_content, content)
+            if len(delta) <= len(content) // 2 and (best is None or len(delta) < len(best[1])):
+                best = (base_sha, delta)
+
+        if best is None:
+            header = _encode_entry_header(TYPE_CODES[fmt], len(content))
+            payload = content
+            chain_depth[sha] = 0
+        else:
+            base_sha, payload = best
+            if ofs_delta:
+                header = _encode_entry_header(OBJ_OFS_DELTA, len(payload)) + encode_offset(pos - offsets[base_sha])
+            else:
+                header = _encode_entry_header(OBJ_REF_DELTA, len(payload)) + bytes.fromhex(base_sha)
+            chain_depth[sha] = chain_depth[base_sha] + 1
+
+        entry = header + zlib.compress(payload, compression_level)
+        offsets[sha] = pos
+        crcs[sha] = zlib.crc32(entry)
+        chunks.append(entry)
+        pos += len(entry)
+
+        candidates.append((sha, fmt, content))
+        if len(candidates) > window:
+            candidates.pop(0)
+
+    pack_sha = hashlib.sha1()
+    for chunk in chunks:
+        pack_sha.update(chunk)
+    pack_checksum = pack_sha.digest()
+    chunks.append(pack_checksum)
+
+    idx = write_index(offsets, crcs, pack_checksum)
+    return b"".join(chunks), idx, pack_checksum.hex()
+
+def write_index(offsets, crcs, pack_checksum):
+    shas = sorted(offsets)
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    small_offsets = []
+    large_offsets = []
+    for sha in shas:
+        offset = offsets[sha]
+        if offset < 0x80000000:
+            small_offsets.append(offset)
+        else:
+            small_offsets.append(0x80000000 | len(large_offsets))
+            large_offsets.append(offset)
+
+    idx = b"".join([
+        IDX_SIGNATURE,
+        struct.pack(">I", 2),
+        struct.pack(">256I", *fanout),
+        b"".join(bytes.fromhex(sha) for sha in shas),
+        struct.pack(f">{len(shas)}I", *(crcs[sha] for sha in shas)),
+        struct.pack(f">{len(shas)}I", *small_offsets),
+        struct.pack(f">{len(large_offsets)}Q", *large_offsets),
+        pack_checksum,
+    ])
+    return idx + hashlib.sha1(idx).digest()
+
+
+"""
+READING
+"""
+
+class PackIndex():
+    """
+    Binary search over the sorted SHA-1 table of a version 2 `.idx` file. The fanout table narrows every lookup
+    down to the objects sharing the first byte, so a lookup costs O(log n) 20-byte comparisons.
+    """
+    def __init__(self, data):
+        self.data = memoryview(data)
+        if bytes(self.data[:4]) != IDX_SIGNATURE:
+            raise Exception("Not a pack index: bad signature.")
+        version = struct.unpack_from(">I", self.data, 4)[0]
+        if version != 2:
+            raise Exception(f"tig only supports pack index version 2. This index is version {version}.")
+
+        self.fanout = struct.unpack_from(">256I", self.data, 8)
+        self.count = self.fanout[255]
+        self._names = 8 + 256 * 4
+        self._crcs = self._names + 20 * self.count
+        self._offsets = self._crcs + 4 * self.count
+        self._large_offsets = self._offsets + 4 * self.count
+        self._pack_order = None
+        self._pack_positions = None
+
+    def __len__(self):
+        return self.count
+
+    def sha(self, i):
+        start = self._names + 20 * i
+        return bytes(self.data[start:(start + 20)])
+
+    def offset(self, i):
+        offset = struct.unpack_from(">I", self.data, self._offsets + 4 * i)[0]
+        if offset & 0x80000000:
+            offset = struct.unpack_from(">Q", self.data, self._large_offsets + 8 * (offset & 0x7FFFFFFF))[0]
+        return offset
+
+    def bisect(self, sha_bytes):
+        """
+        Returns the position of the first SHA >= `sha_bytes` (which may be a prefix of a SHA).
+        """
+        first = sha_bytes[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha(mid) < sha_bytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, sha):
+        """
+        Returns the pack offset of `sha` (hex) or None.
+        """
+        sha_bytes = bytes.fromhex(sha)
+        i = self.bisect(sha_bytes)
+        if i < self.count and self.sha(i) == sha_bytes:
+            return self.offset(i)
+        return None
+
+    def find_prefix(self, prefix):
+        """
+        Returns the hex SHAs starting with the hex string `prefix`.
+        """
+        lo = bytes.fromhex(prefix.ljust(40, "0"))
+        hi = bytes.fromhex(prefix.ljust(40, "f"))
+        found = []
+        i = self.bisect(lo)
+        while i < self.count and self.sha(i) <= hi:
+            found.append(self.sha(i).hex())
+            i += 1
+        return found
+
+    def shas(self):
+        for i in range(self.count):
+            yield self.sha(i).hex()
+
+    def pack_order(self):
+        """
+        Returns the positions in this index of the objects, in the order they sit in the pack (the order of the bits
+        of a reachability bitmap).
+        """
+        if self._pack_order is None:
+            self._pack_order = sorted(range(self.count), key=self.offset)
+        return self._pack_order
+
+    def pack_positions(self):
+        """
+        The reverse of `pack_order`: position in this index -> position in the pack.
+        """
+        if self._pack_positions is None:
+            positions = [0] * self.count
+            for pack_position, i in enumerate(self.pack_order()):
+                positions[i] = pack_position
+            self._pack_positions = positions
+        return self._pack_positions
+
+
+class Pack():
+    """
+    A packfile together with its index.
+
+    Deltified objects are rebuilt by walking the chain down to its base and applying the deltas back up.
+    Recently rebuilt objects are kept in a byte-bounded LRU cache keyed by pack offset, since neighbouring objects
+    tend to share the same bases.
+
+    `bitmap` holds the reachability bitmaps of the pack (a bitmap.PackBitmap), if it has a .bitmap.
+    """
+    def __init__(self, name, pack_data, idx_data, delta_cache_size=16 * 1024 * 1024):
+        self.name = name
+        self.data = memoryview(pack_data)
+        self.index = PackIndex(idx_data)
+        self.delta_cache = LRUCache(delta_cache_size)
+
+        if bytes(self.data[:4]) != b"PACK":
+            raise Exception(f"{name} is not a packfile: bad signature.")
+        version, count = struct.unpack_from(">II", self.data, 4)
+        if version != 2:
+            raise Exception(f"tig only supports pack version 2. {name} is version {version}.")
+        if count != self.index.count:
+            raise Exception(f"{name} holds {count} objects but its index lists {self.index.count}.")
+        self.bitmap = None
+
+    @property
+    def checksum(self):
+        return bytes(self.data[-20:])
+
+    def __contains__(self, sha):
+        return self.index.find(sha) is not None
+
+    def positions(self, sha):
+        """
+        Returns (position in the index, position in the pack) of `sha` (hex), or None if it isn't in this pack.
+        """
+        sha_bytes = bytes.fromhex(sha)
+        i = self.index.bisect(sha_bytes)
+        if i < self.index.count and self.index.sha(i) == sha_bytes:
+            return i, self.index.pack_positions()[i]
+        return None
+
+    def shas_of(self, bits):
+        """
+        Yields the hex SHAs of the objects whose bit (by position in the pack) is set in `bits`.
+        """
+        order = self.index.pack_order()
+        for byte_pos, byte in enumerate(bits.to_bytes((bits.bit_length() + 7) // 8, "little")):
+            while byte:
+                low = byte & -byte
+                yield self.index.sha(order[8 * byte_pos + low.bit_length() - 1]).hex()
+                byte ^= low
+
+    def read(self, sha):
+        """
+        Returns (fmt, content) or None if `sha` isn't in this pack.
+        """
+        offset = self.index.find(sha)
+        if offset is None:
+            return None
+        type_code, content = self._read_at(offset)
+        return TYPE_NAMES[type_code], content
+
+    def _read_entry(self, offset):
+        """
+        Returns (type_code, base, inflated payload) for the entry at `offset`, where `base` is the base offset for
+        OFS_DELTA, the base SHA for REF_DELTA and None otherwise.
+        """
+        byte = self.data[offset]
+        pos = offset + 1
+        type_code = (byte >> 4) & 0x07
+        size = byte & 0x0F
+        shift = 4
+        while byte & 0x80:
+            byte = self.data[pos]
+            pos += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+
+        base = None
+        if type_code == OBJ_OFS_DELTA:
+            distance, pos = decode_offset(self.data, pos)
+            base = offset - distance
+        elif type_code == OBJ_REF_DELTA:
+            base = bytes(self.data[pos:(pos + 20)]).hex()
+            pos += 20
+
+        return type_code, base, self._inflate(pos, size)
+
+    def _inflate(self, pos, size):
+        decompressor = zlib.decompressobj()
+        out = []
+        while not decompressor.eof:
+            chunk = self.data[pos:(pos + 64 * 1024)]
+            if not chunk:
+                raise Exception(f"{self.name} is truncated.")
+            out.append(decompressor.decompress(chunk))
+            pos += len(chunk) - len(decompressor.unused_data)
+        content = b"".join(out)
+        if len(content) != size:
+            raise Exception(f"{self.name} is corrupt: expected {size} inflated bytes, found {len(content)}.")
+        return content
+
+    def _read_at(self, offset):
+        # walk down the delta chain until we hit a full object (or one we've already rebuilt)
+        chain = []
+        while True:
+            cached = self.delta_cache.get(offset)
+            if cached is not None:
+                type_code, content = cached
+                break
+
+            type_code, base, payload = self._read_entry(offset)
+            if type_code not in (OBJ_OFS_DELTA, OBJ_REF_DELTA):
+                content = payload
+                break
+
+            chain.append((offset, payload))
+            if type_code == OBJ_REF_DELTA:
+                base_offset = self.index.find(base)
+                if base_offset is None:
+                    raise Exception(f"{self.name} refers to base {base}, which it doesn't contain.")
+                offset = base_offset
+            else:
+                offset = base
+
+        # then apply the deltas back up, remembering every intermediate base
+        self.delta_cache.put(offset, (type_code, content), len(content))
+        for delta_offset, delta in reversed(chain):
+            content = apply_delta(content, delta)
+            self.delta_cache.put(delta_offset, (type_code, content), len(content))
+
+        return type_code, content
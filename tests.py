@@ -1,9 +1,17 @@
+import io
 import os
+import contextlib
 import tig
 import unittest
 import utils
 import shutil
+import zlib
 import tempfile
+import pack
+import monitor
+import commitgraph
+import bitmap
+from connectors.database import JsonDatabase
 
 class TestSuite:
     def test_round_trip_blob(self):
@@ -47,6 +55,39 @@ class TestSuite:
         returned_sha = self.git._resolve_reference(".git/refs/anon", "salutation")
         self.assertEqual(returned_sha, original_sha)
 
+    def test_symbolic_ref_cycle(self):
+        self.git.create_ref("", "ping", "ref: refs/pong")
+        self.git.create_ref("", "pong", "ref: refs/ping")
+        with self.assertRaises(Exception):
+            self.git._resolve_reference(".git/refs", "ping")
+        self.assertIsNone(self.git._resolve_reference(".git/refs", "nowhere"))
+
+    def test_packed_refs(self):
+        first, _ = self._commit_tree({"a.txt": ("100644", b"a")})
+        second, _ = self._commit_tree({"a.txt": ("100644", b"b")}, parents=[first])
+        self.git.create_ref("heads", "main", first)
+        self.git.create_ref("heads/feature", "x", second)
+        self.git.create_ref("tags", "v1", first)
+        self.git.create_ref("", "current", "ref: refs/heads/main")
+
+        self.git.pack_refs()
+        self.assertEqual(self.git.db.list(".git/refs/heads"), [])
+        self.assertEqual(self.git.db.get(".git/packed-refs"), (
+            f"# pack-refs with: sorted \n{second} refs/heads/feature/x\n{first} refs/heads/main\n{first} refs/tags/v1\n"
+        ).encode())
+        self.assertEqual(self.git._resolve_reference(".git/refs/heads/feature", "x"), second)
+        self.assertEqual(self.git._resolve_reference(".git/refs", "current"), first)
+        self.assertEqual(self.git._resolve_commit("v1"), first)
+
+        # a loose ref overrides the packed one
+        self.git.create_ref("heads", "main", second)
+        refs = {}
+        self.git._get_all_references(".git/refs", refs)
+        self.assertEqual(refs, {
+            ".git/refs/current": second, ".git/refs/heads/feature/x": second, ".git/refs/heads/main": second,
+            ".git/refs/tags/v1": first,
+        })
+
     def test_create_simple_tag(self):
         blob = tig.GitBlob("hello world")
         original_sha = self.git._write_object(blob)
@@ -92,6 +133,257 @@ class TestSuite:
         self.git.checkout(commit_sha, "working_dir")
 
             
+    def _commit_tree(self, files, parents=()):
+        """
+        Writes a commit of `files` ({path: (mode, content)}) straight into the object store.
+        """
+        folders = {"": []}
+        for path in sorted(files):
+            mode, content = files[path]
+            folder, _, name = path.rpartition("/")
+            while folder not in folders:
+                folders[folder] = []
+                folder = folder.rpartition("/")[0]
+            folders[path.rpartition("/")[0]].append(utils.TreeNode(mode, name, self.git._write_object(tig.GitBlob(content))))
+
+        shas = {}
+        for folder in sorted(folders, key=lambda f: f.count("/") + bool(f), reverse=True):
+            tree = tig.GitTree()
+            tree.data = folders[folder] + [
+                utils.TreeNode("040000", sub.rpartition("/")[2], shas[sub]) for sub in shas if sub and sub.rpartition("/")[0] == folder
+            ]
+            shas[folder] = self.git._write_object(tree)
+        parent_lines = "".join(f"parent {parent}\n" for parent in parents)
+        commit = tig.GitCommit(f"tree {shas['']}\n{parent_lines}author Alex Jeon\n\nsome message".encode())
+        return self.git._write_object(commit), shas[""]
+
+    def test_ls_tree(self):
+        commit_sha, tree_sha = self._commit_tree({
+            "a.txt": ("100644", b"a"),
+            "bin/run.sh": ("100755", b"#!/bin/sh\n"),
+            "bin/deep/er.txt": ("100644", b"deeper"),
+        })
+        tree = self.git._read_object(tree_sha).data
+        blob, bin_tree = tree[0].sha, tree[1].sha
+        deep_tree, run = self.git._read_object(bin_tree).data[0].sha, self.git._read_object(bin_tree).data[1].sha
+        deeper = self.git._read_object(deep_tree).data[0].sha
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.git.ls_tree(commit_sha)
+            self.git.ls_tree(tree_sha, recursive=True)
+        self.assertEqual(output.getvalue(), (
+            f"100644 blob {blob}\ta.txt\n"
+            f"040000 tree {bin_tree}\tbin\n"
+            f"100644 blob {blob}\ta.txt\n"
+            f"100644 blob {deeper}\tbin/deep/er.txt\n"
+            f"100755 blob {run}\tbin/run.sh\n"
+        ))
+
+    def test_checkout_binary_files(self):
+        data = bytes(range(256)) * 4
+        commit_sha, tree_sha = self._commit_tree({
+            "data.bin": ("100644", data),
+            "bin/run.sh": ("100755", b"#!/bin/sh\n"),
+            "bin/deep/er.txt": ("100644", b"deeper"),
+        })
+        self.git.db.set("working_dir", None)
+        self.git.checkout(commit_sha, "working_dir")
+
+        self.assertEqual(self.git.db.get("working_dir/data.bin"), data)
+        self.assertEqual(self.git.db.get("working_dir/bin/deep/er.txt"), b"deeper")
+        index = self.git._get_index()
+        self.assertEqual([(e.name, e.mode_perms) for e in index], [("bin/deep/er.txt", 0o644), ("bin/run.sh", 0o755), ("data.bin", 0o644)])
+
+        # the index came with the commit's trees cached, and they are right
+        self.assertEqual(index.cache_tree[""], (3, tree_sha))
+        self.assertEqual(self.git._build_index_trees(list(index))[""][0], tree_sha)
+
+    def test_checkout_non_canonical_mode(self):
+        commit_sha, tree_sha = self._commit_tree({
+            "sub/odd.txt": ("100664", b"odd"),
+            "other/b.txt": ("100644", b"b"),
+            "root.txt": ("100644", b"root"),
+        })
+        other_sha = [n.sha for n in self.git._read_object(tree_sha).data if n.path == "other"][0]
+        self.git.db.set("working_dir", None)
+        self.git.checkout(commit_sha, "working_dir")
+
+        # the index could be written and read back: the fixed-up folders are invalid, their sibling still cached
+        index = self.git._get_index()
+        self.assertEqual([(e.name, e.mode_perms) for e in index], [("other/b.txt", 0o644), ("root.txt", 0o644), ("sub/odd.txt", 0o644)])
+        self.assertEqual(index.cache_tree, {"": (-1, None), "other": (1, other_sha), "sub": (-1, None)})
+        self.assertNotEqual(self.git.write_tree(), tree_sha)
+
+    def test_switch(self):
+        old_commit, _ = self._commit_tree({
+            "keep/a.txt": ("100644", b"same"),
+            "change.txt": ("100644", b"old"),
+            "gone/x.txt": ("100644", b"x"),
+            "becomes_dir": ("100644", b"file"),
+        })
+        new_commit, new_tree = self._commit_tree({
+            "keep/a.txt": ("100644", b"same"),
+            "change.txt": ("100644", b"new"),
+            "new/y.txt": ("100644", b"y"),
+            "becomes_dir/z.txt": ("100644", b"z"),
+        })
+        self.git.db.set("working_dir", None)
+        self.git.checkout(old_commit, "working_dir")
+
+        read = []
+        read_object = self.git._read_object
+        self.git._read_object = lambda sha: read.append(sha) or read_object(sha)
+        self.git.switch(new_commit)
+
+        self.assertNotIn(self.git._read_object(new_tree).data[2].sha, read) # "keep" is the same on both sides
+        self.assertEqual(self.git.db.get("working_dir/change.txt"), b"new")
+        self.assertEqual(self.git.db.get("working_dir/becomes_dir/z.txt"), b"z")
+        self.assertEqual(self.git.db.list("working_dir"), ["becomes_dir", "change.txt", "keep", "new"])
+        self.assertEqual([e.name for e in self.git._get_index()], ["becomes_dir/z.txt", "change.txt", "keep/a.txt", "new/y.txt"])
+        self.assertEqual(self.git.write_tree(), new_tree)
+        self.assertEqual(self.git._get_current_branch(), new_commit)
+
+    def _checkout_branch(self, commit):
+        self.git.db.set("working_dir", None)
+        self.git.checkout(commit, "working_dir")
+        self.git.create_ref("heads", "main", commit)
+        self.git.db.set(".git/HEAD", b"ref: refs/heads/main", overwrite=True)
+
+    def test_merge(self):
+        lines = b"".join(b"line %d\n" % i for i in range(10))
+        base, base_tree = self._commit_tree({
+            "a.txt": ("100644", lines), "same/b.txt": ("100644", b"b"), "gone.txt": ("100644", b"x"),
+        })
+        ours, _ = self._commit_tree({
+            "a.txt": ("100644", lines.replace(b"line 1\n", b"ours\n")), "same/b.txt": ("100644", b"b"),
+        }, parents=[base])
+        theirs, _ = self._commit_tree({
+            "a.txt": ("100644", lines.replace(b"line 8\n", b"theirs\n")), "same/b.txt": ("100644", b"b"),
+            "gone.txt": ("100644", b"x"), "new/c.txt": ("100644", b"c"),
+        }, parents=[base])
+        self._checkout_branch(ours)
+        self.assertEqual(self.git.merge_base(ours, theirs), [base])
+
+        read = []
+        read_object = self.git._read_object
+        self.git._read_object = lambda sha: read.append(sha) or read_object(sha)
+        merged = self.git.merge(theirs, author="Alex Jeon <alex@example.com>")
+        self.git._read_object = read_object
+
+        self.assertNotIn(read_object(base_tree).data[2].sha, read) # "same" is the same on all three sides
+        commit = self.git._read_object(merged)
+        self.assertEqual(commit.data["parent"], [ours, theirs])
+        self.assertEqual(self.git.db.get("working_dir/a.txt"), lines.replace(b"line 1\n", b"ours\n").replace(b"line 8\n", b"theirs\n"))
+        self.assertEqual(self.git.db.get("working_dir/new/c.txt"), b"c")
+        self.assertFalse(self.git._worktree_exists("gone.txt"))
+        self.assertEqual(self.git.write_tree(), commit.data["tree"][0])
+        self.assertEqual(self.git._get_current_branch(), merged)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(self.git.merge(theirs), merged)
+
+    def test_merge_conflicts(self):
+        base, _ = self._commit_tree({"a.txt": ("100644", b"1\n2\n3\n"), "b.txt": ("100644", b"b\n")})
+        ours, _ = self._commit_tree({"a.txt": ("100644", b"1\nours\n3\n")}, parents=[base])
+        theirs, _ = self._commit_tree({"a.txt": ("100644", b"1\ntheirs\n3\n"), "b.txt": ("100644", b"b, theirs\n")}, parents=[base])
+        self._checkout_branch(ours)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(self.git.merge(theirs), ours)
+        self.assertIn("Automatic merge failed", output.getvalue())
+
+        self.assertEqual(self.git.db.get("working_dir/a.txt"), f"1\n<<<<<<< HEAD\nours\n=======\ntheirs\n>>>>>>> {theirs}\n3\n".encode())
+        self.assertEqual(self.git.db.get("working_dir/b.txt"), b"b, theirs\n")
+        self.assertEqual([(e.name, e.stage) for e in self.git._get_index()], [("a.txt", 1), ("a.txt", 2), ("a.txt", 3), ("b.txt", 1), ("b.txt", 3)])
+        self.assertEqual([(category, change, path) for category, change, path in self.git._iter_status()], [
+            ("unmerged", "both modified", "a.txt"), ("unmerged", "deleted by us", "b.txt"),
+        ])
+        with self.assertRaises(Exception):
+            self.git.commit("too early")
+
+        self.git.db.set("working_dir/a.txt", b"1\nboth\n3\n", overwrite=True)
+        self.git.add(["working_dir/a.txt", "working_dir/b.txt"])
+        merged = self.git.commit("merged", author="Alex Jeon <alex@example.com>")
+        self.assertEqual(self.git._read_object(merged).data["parent"], [ours, theirs])
+        self.assertIsNone(self.git._get_merge_head())
+
+    def test_merge_file_and_folder(self):
+        base, _ = self._commit_tree({"p": ("100644", b"base\n"), "keep.txt": ("100644", b"k\n")})
+        ours, _ = self._commit_tree({"p": ("100644", b"ours\n"), "keep.txt": ("100644", b"k\n")}, parents=[base])
+        theirs, _ = self._commit_tree({"p/x.txt": ("100644", b"x\n"), "keep.txt": ("100644", b"k\n")}, parents=[base])
+        self._checkout_branch(ours)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(self.git.merge(theirs), ours)
+        self.assertIn("CONFLICT (file/directory): directory in the way of p from HEAD; moving it to p~HEAD instead.", output.getvalue())
+
+        self.assertEqual([(e.name, e.stage) for e in self.git._get_index()], [
+            ("keep.txt", 0), ("p/x.txt", 0), ("p~HEAD", 1), ("p~HEAD", 2),
+        ])
+        self.assertEqual(self.git.db.get("working_dir/p/x.txt"), b"x\n")
+        self.assertEqual(self.git.db.get("working_dir/p~HEAD"), b"ours\n")
+
+        self.git.add(["working_dir/p~HEAD"])
+        merged = self.git.commit("merged", author="Alex Jeon <alex@example.com>")
+        self.assertEqual(self.git._read_object(merged).data["parent"], [ours, theirs])
+
+    def test_switch_refuses_local_changes(self):
+        old_commit, _ = self._commit_tree({"a.txt": ("100644", b"old")})
+        new_commit, _ = self._commit_tree({"a.txt": ("100644", b"new")})
+        self.git.db.set("working_dir", None)
+        self.git.checkout(old_commit, "working_dir")
+        self.git.db.set("working_dir/a.txt", b"mine", overwrite=True)
+
+        with self.assertRaises(Exception):
+            self.git.switch(new_commit)
+        self.assertEqual(self.git.db.get("working_dir/a.txt"), b"mine")
+        self.assertEqual(self.git._get_current_branch(), old_commit)
+
+    def test_diff(self):
+        lines = b"".join(f"line {i}\n".encode() for i in range(40))
+        old_commit, _ = self._commit_tree({
+            "same/a.txt": ("100644", b"same"),
+            "changed.txt": ("100644", b"old"),
+            "deleted.txt": ("100644", b"gone"),
+            "moved.txt": ("100644", b"moved as is"),
+            "edited.txt": ("100644", lines),
+        })
+        new_commit, new_tree = self._commit_tree({
+            "same/a.txt": ("100644", b"same"),
+            "changed.txt": ("100644", b"new"),
+            "added.txt": ("100644", b"brand new"),
+            "dir/moved.txt": ("100644", b"moved as is"),
+            "dir/edited.txt": ("100644", lines.replace(b"line 7\n", b"line seven\n")),
+        })
+
+        read = []
+        read_object = self.git._read_object
+        self.git._read_object = lambda sha: read.append(sha) or read_object(sha)
+        changes = [(e.change, e.old and e.old.path, e.new and e.new.path) for e in self.git.diff(old_commit, new_commit)]
+        self.assertEqual(changes, [
+            ("added", None, "added.txt"),
+            ("modified", "changed.txt", "changed.txt"),
+            ("deleted", "deleted.txt", None),
+            ("added", None, "dir/edited.txt"),
+            ("added", None, "dir/moved.txt"),
+            ("deleted", "edited.txt", None),
+            ("deleted", "moved.txt", None),
+        ])
+        self.assertNotIn(self.git._read_object(new_tree).data[-1].sha, read) # "same" is the same on both sides
+
+        renamed = [(e.change, e.old and e.old.path, e.new and e.new.path, e.similarity)
+                   for e in self.git.diff(old_commit, new_commit, detect_renames=True)]
+        self.assertEqual(renamed, [
+            ("added", None, "added.txt", None),
+            ("modified", "changed.txt", "changed.txt", None),
+            ("deleted", "deleted.txt", None, None),
+            ("renamed", "edited.txt", "dir/edited.txt", 96), # what `git diff -M` says too
+            ("renamed", "moved.txt", "dir/moved.txt", 100),
+        ])
+
     def test_find_object_no_tag(self):
         blob = tig.GitBlob("hello world")
         sha = self.git._write_object(blob)
@@ -165,7 +457,7 @@ class TestSuite:
 
     def test_git_add(self):
         self.git.db.set("working_dir", None)
-        self.git.db.set("working_dir/salutation.txt", "hello world", no_encoding=True) # bytes
+        self.git.db.set("working_dir/salutation.txt", "hello world".encode())
         self.git.add(["working_dir/salutation.txt"])
 
         index = self.git._get_index()
@@ -173,6 +465,172 @@ class TestSuite:
         self.assertEqual(index.entries[0].name, "salutation.txt")
 
 
+    def test_git_add_many(self):
+        self.git.db.set("working_dir", None)
+        paths = []
+        for i in range(80):
+            paths.append(f"working_dir/file_{i:02}.bin")
+            self.git.db.set(paths[-1], bytes([i, 0, 255]) * (i + 1))
+        self.git.add(paths, workers=2)
+
+        index = self.git._get_index()
+        self.assertEqual([e.name for e in index.entries], [f"file_{i:02}.bin" for i in range(80)])
+        for i, e in enumerate(index.entries):
+            self.assertEqual(self.git._read_object(e.sha).data, bytes([i, 0, 255]) * (i + 1))
+
+    def test_status(self):
+        self.git.db.set("working_dir", None)
+        self.git.db.set("working_dir/dir", None)
+        for path, content in [("a.txt", b"a"), ("dir/b.txt", b"b"), ("dir/c.txt", b"c"), ("untracked.txt", b"u")]:
+            self.git.db.set(f"working_dir/{path}", content)
+        self.git.add(["working_dir/a.txt", "working_dir/dir/b.txt", "working_dir/dir/c.txt"])
+
+        self.assertEqual(list(self.git._iter_status()), [
+            ("staged", "added", "a.txt"),
+            ("staged", "added", "dir/b.txt"),
+            ("staged", "added", "dir/c.txt"),
+            ("untracked", None, "untracked.txt"),
+        ])
+
+        # point HEAD at a commit of exactly what's in the index
+        for _, nodes in self.git._build_index_trees(self.git._get_index().entries).values():
+            tree = tig.GitTree()
+            tree.data = nodes
+            tree_sha = self.git._write_object(tree)
+        commit_sha = self.git._write_object(tig.GitCommit(f"tree {tree_sha}\nauthor Alex Jeon\n\nsome message".encode()))
+        self.git.db.set(".git/HEAD", commit_sha.encode())
+
+        self.git.db.set("working_dir/a.txt", b"aa", overwrite=True)
+        self.git.db.delete("working_dir/dir/c.txt")
+        self.assertEqual(list(self.git._iter_status()), [
+            ("unstaged", "modified", "a.txt"),
+            ("unstaged", "deleted", "dir/c.txt"),
+            ("untracked", None, "untracked.txt"),
+        ])
+
+        # a path both staged and changed since gets a single line
+        self.git.db.set("working_dir/dir/d.txt", b"d")
+        self.git.add(["working_dir/dir/d.txt"])
+        self.git.db.set("working_dir/dir/d.txt", b"dd", overwrite=True)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.git.status()
+        self.assertEqual(out.getvalue().splitlines(), [" M a.txt", " D dir/c.txt", "AM dir/d.txt", "?? untracked.txt"])
+
+    def test_index_version_sticks(self):
+        self.git.set_index_version(4)
+        self.git.db.set("working_dir", None)
+        self.git.db.set("working_dir/salutation.txt", b"hello world")
+        self.git.add(["working_dir/salutation.txt"])
+
+        index = self.git._get_index()
+        self.assertEqual(index.version, 4)
+        self.assertEqual([e.name for e in index], ["salutation.txt"])
+
+    def test_write_tree_reuses_cached_trees(self):
+        for folder in ["working_dir", "working_dir/dir", "working_dir/other"]:
+            self.git.db.set(folder, None)
+        for path in ["a.txt", "dir/b.txt", "other/c.txt"]:
+            self.git.db.set(f"working_dir/{path}", path.encode())
+        self.git.add(["working_dir/a.txt", "working_dir/dir/b.txt", "working_dir/other/c.txt"])
+        root = self.git.write_tree()
+        self.assertEqual(self.git._get_index().cache_tree[""], (3, root))
+
+        self.git.db.set("working_dir/dir/b.txt", b"changed", overwrite=True)
+        self.git.add(["working_dir/dir/b.txt"])
+        cache_tree = self.git._get_index().cache_tree
+        self.assertEqual(cache_tree["dir"], (-1, None))
+        self.assertEqual(cache_tree["other"][0], 1)
+
+        written = []
+        write_object = self.git._write_object
+        self.git._write_object = lambda obj: written.append(obj.fmt) or write_object(obj)
+        new_root = self.git.write_tree()
+        self.assertEqual(written, ["tree", "tree"]) # "dir" and the root; "other" came out of the cache
+        self.assertEqual(new_root, self.git._build_index_trees(self.git._get_index().entries)[""][0])
+
+    def test_commit(self):
+        for folder in ["working_dir", "working_dir/dir", "working_dir/dir/sub"]:
+            self.git.db.set(folder, None)
+        self.git.db.set("working_dir/a.txt", b"a")
+        self.git.db.set("working_dir/dir/b.txt", b"b")
+        self.git.db.set("working_dir/dir/sub/c.txt", b"c")
+        self.git.add(["working_dir/a.txt", "working_dir/dir/b.txt", "working_dir/dir/sub/c.txt"])
+        first = self.git.commit("first", author="Alex Jeon <alex@example.com>")
+
+        self.assertEqual(self.git.db.get(".git/HEAD"), b"ref: refs/heads/main")
+        self.assertEqual(self.git._get_current_branch(), first)
+        with self.assertRaises(Exception):
+            self.git.commit("nothing changed")
+
+        self.git.db.set("working_dir/dir/b.txt", b"bb", overwrite=True)
+        self.git.add(["working_dir/dir/b.txt"])
+        second = self.git.commit("second")
+
+        commit = self.git._read_object(second)
+        self.assertEqual(commit.data["parent"], [first])
+        self.assertEqual(commit.data[None], "second\n")
+        self.assertEqual(commit.message, "second")
+        tree = self.git._read_object(commit.data["tree"][0])
+        self.assertEqual(sorted(node.path for node in tree.data), ["a.txt", "dir"])
+        self.assertEqual(self.git._get_current_branch(), second)
+
+    def test_commit_graph(self):
+        self.git.db.set("working_dir", None)
+        commits = []
+        for i in range(5):
+            self.git.db.set("working_dir/a.txt", str(i).encode(), overwrite=True)
+            self.git.add(["working_dir/a.txt"])
+            commits.append(self.git.commit(f"commit {i}", author="Alex Jeon <alex@example.com>"))
+
+        # a fresh Git reads everything back from the chain of layers
+        git = tig.Git(self.git.db.main, dbType=self.dbType)
+        graph = git._get_commit_graph()
+        self.assertEqual(len(graph), 5)
+        self.assertLess(len(graph.layers), 5)
+        for i, sha in enumerate(commits):
+            tree, parents, generation, _ = graph.entry(graph.find(sha))
+            self.assertEqual(tree, self.git._read_object(sha).data["tree"][0])
+            self.assertEqual([graph.sha(p) for p in parents], commits[i - 1:i])
+            self.assertEqual(generation, i + 1)
+
+        self.assertTrue(git.is_ancestor(commits[1], commits[4]))
+        self.assertTrue(git.is_ancestor(commits[4], "main"))
+        self.assertFalse(git.is_ancestor(commits[4], commits[1]))
+
+    def test_log(self):
+        tree_sha = self.git._write_object(tig.GitTree())
+        def commit(parents, timestamp, msg):
+            commit = tig.GitCommit()
+            commit.data = {"tree": tree_sha}
+            if parents:
+                commit.data["parent"] = parents
+            signature = f"Alex Jeon <alex@example.com> {timestamp} +0100"
+            commit.data.update({"author": signature, "committer": signature, None: msg})
+            return self.git._write_object(commit)
+
+        # "side" is older than its parent, as if its author's clock were wrong: it still comes after it
+        root = commit(None, 1_700_000_000, "root")
+        side = commit(root, 1_699_000_000, "side")
+        main = commit(side, 1_700_000_200, "main")
+        self.git._update_head(main)
+
+        self.assertEqual([e.sha for e in self.git._iter_log()], [main, side, root])
+        self.assertEqual(list(self.git._iter_log(max_count=1)), [utils.LogEntry(main, tree_sha, [side], 1_700_000_200)])
+        self.assertEqual([e.sha for e in self.git._iter_log(skip=1, max_count=1)], [side])
+        self.assertEqual([e.sha for e in self.git._iter_log("main", since=1_699_500_000)], [main])
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.git.log(max_count=1)
+        self.assertEqual(output.getvalue(), (
+            f"commit {main}\n"
+            "Author: Alex Jeon <alex@example.com>\n"
+            "Date:   Tue Nov 14 23:16:40 2023 +0100\n"
+            "\n"
+            "    main\n"
+        ))
+
     def test_git_rm(self):
         self.git.db.set("working_dir", None)
         self.git.db.set("working_dir/salutation.txt", "hello world".encode())
@@ -182,24 +640,579 @@ class TestSuite:
         index = self.git._get_index()
         self.assertEqual(len(index.entries), 0)
 
+    def test_loose_objects_are_compressed(self):
+        sha = self.git._write_object(tig.GitBlob("hello world"))
+        stored = self.git.db.get(f".git/objects/{sha[:2]}/{sha[2:]}")
+        self.assertEqual(zlib.decompress(stored), b"blob 11\x00hello world")
+        self.assertEqual(self.git._read_object_header(sha), ("blob", 11))
+
+    def test_read_object_written_by_git(self):
+        sha = "95d09f2b10159347eece71399a7e2e907ea3df4f"
+        self.git.db.set(".git/objects/95/", None)
+        self.git.db.set(f".git/objects/95/{sha[2:]}", zlib.compress(b"blob 11\x00hello world"))
+        self.assertEqual(self.git._read_object(sha).data, b"hello world")
+
+    def test_stream_large_blob(self):
+        content = os.urandom(256 * 1024).hex()
+        sha = self.git._write_object(tig.GitBlob(content))
+        fmt, size, body = self.git._open_object(sha, chunk_size=4096)
+        chunks = list(body)
+        self.assertEqual((fmt, size), (b"blob", len(content)))
+        self.assertTrue(all(len(c) <= 4096 for c in chunks))
+        self.assertEqual(b"".join(chunks), content.encode())
+
+    def test_repack(self):
+        base = "\n".join(f"line {i}" for i in range(2000))
+        similar = base.replace("line 1000", "line one thousand")
+        shas = [self.git._write_object(tig.GitBlob(content)) for content in (base, similar, "hello world")]
+
+        self.git.repack()
+
+        self.assertEqual(self.git._loose_object_shas(), [])
+        [packed] = self.git._get_packs()
+        self.assertLess(len(packed.data), len(base))
+        for sha, content in zip(shas, (base, similar, "hello world")):
+            self.assertEqual(self.git._read_object(sha).data, content.encode())
+
+    def test_bitmaps(self):
+        first, _ = self._commit_tree({"a.txt": ("100644", b"a"), "docs/b.txt": ("100644", b"b")})
+        second, _ = self._commit_tree({"a.txt": ("100644", b"a2"), "docs/b.txt": ("100644", b"b")}, parents=[first])
+        side, _ = self._commit_tree({"docs/b.txt": ("100644", b"side")}, parents=[first])
+        dangling = self.git._write_object(tig.GitBlob("nobody points here"))
+        self.git.create_ref("heads", "main", second)
+        self.git.create_ref("heads", "side", side)
+        self.git.db.set(".git/HEAD", b"ref: refs/heads/main", overwrite=True)
+
+        everything = self.git.rev_list_objects(["main", "side"])
+        only_main = self.git.rev_list_objects(["main"], exclude=["side"])
+        self.assertEqual(len(everything), 12)
+        self.assertEqual(len(only_main), 3) # the second commit, its root tree and a2
+        self.git.repack(bitmap=True)
+
+        [packed] = self.git._get_packs()
+        self.assertEqual(sorted(packed.bitmap.commits()), sorted(packed.positions(sha)[0] for sha in (second, side)))
+        self.assertEqual(self.git.rev_list_objects(["main", "side"]), everything)
+        self.assertEqual(self.git.rev_list_objects(["main"], exclude=["side"]), only_main)
+        self.assertEqual(self.git.count_objects(["main", "side"]), 12)
+
+        # a dangling object is only deleted once it's old enough
+        recent = self.git._write_object(tig.GitBlob("nobody points here either"))
+        self.git.gc()
+        [packed] = self.git._get_packs()
+        self.assertEqual(set(packed.index.shas()), everything)
+        self.assertEqual(self.git._loose_object_shas(), [recent])
+        self.assertEqual(self.git._read_object(recent).data, b"nobody points here either")
+        self.assertNotIn(dangling, self.git.rev_list_objects(["main", "side"]))
+        with self.assertRaises(Exception):
+            self.git._read_object(dangling)
+
+        self.git.gc(expire=0)
+        self.assertEqual(self.git._loose_object_shas(), [])
+        with self.assertRaises(Exception):
+            self.git._read_object(recent)
+
+    def test_bitmaps_missing_objects(self):
+        commit, tree = self._commit_tree({"a.txt": ("100644", b"a")})
+        self.git.create_ref("heads", "main", commit)
+        self.git.db.delete(f".git/objects/{tree[:2]}/{tree[2:]}")
+        self.git.repack(bitmap=True)
+        [packed] = self.git._get_packs()
+        self.assertIsNone(packed.bitmap)
+
+        # any other failure is a bug, not a reason to skip the bitmap
+        self.git._write_bitmap = lambda pack, objects: None + 1
+        with self.assertRaises(TypeError):
+            self.git.repack(bitmap=True)
+
+    def test_object_cache(self):
+        sha = self.git._write_object(tig.GitBlob("hello world"))
+        hits, misses = self.git.object_cache.hits, self.git.object_cache.misses
+        first = self.git._read_object(sha)
+        self.assertEqual((self.git.object_cache.hits - hits, self.git.object_cache.misses - misses), (0, 1))
+        second = self.git._read_object(sha)
+        self.assertIs(first, second)
+        self.assertEqual((self.git.object_cache.hits - hits, self.git.object_cache.misses - misses), (1, 1))
+
+        uncached = tig.Git(self.git.db.main, dbType=self.dbType, cache_size=0)
+        self.assertIsNot(uncached._read_object(sha), uncached._read_object(sha))
+        self.assertEqual(uncached.object_cache.hits, 0)
+
+    def test_loose_index_merges_added_shas(self):
+        index = self.git.loose_index
+        with self.git.session():
+            base = len(index._load())
+            shas = [self.git._write_object(tig.GitBlob(f"pending {i}")) for i in range(5)]
+            self.assertEqual(len(index._shas), base) # buffered, not inserted one by one
+            self.assertEqual(index.find_prefix(shas[0][:8]), [shas[0]])
+            self.assertEqual(len(index._shas), base + 5)
+            shas.append(self.git._write_object(tig.GitBlob("pending 5")))
+        # merged when the session flushes
+        self.assertEqual(index._shas, sorted(index._shas))
+        self.assertEqual(len(index._shas), base + 6)
+        self.assertEqual(tig.Git(self.git.db.main, dbType=self.dbType).loose_index.find_prefix(shas[5]), [shas[5]])
+
+    def test_find_object_uses_loose_index(self):
+        shas = [self.git._write_object(tig.GitBlob(f"blob {i}")) for i in range(20)]
+        reopened = tig.Git(self.git.db.main, dbType=self.dbType)
+        for sha in shas:
+            self.assertEqual(reopened._find_hashes(sha[:7]), [sha])
+        self.assertEqual(reopened.loose_index._load(), sorted(bytes.fromhex(sha) for sha in shas))
+
+    def test_find_object_written_behind_our_back(self):
+        self.git._write_object(tig.GitBlob("something else"))
+        sha = "95d09f2b10159347eece71399a7e2e907ea3df4f"
+        self.git.db.set(".git/objects/95/", None)
+        self.git.db.set(f".git/objects/95/{sha[2:]}", zlib.compress(b"blob 11\x00hello world"))
+        self.assertEqual(self.git._find_hashes("95d09f"), [sha])
+
+    def test_find_packed_object(self):
+        sha = self.git._write_object(tig.GitBlob("hello world"))
+        self.git.repack()
+        self.assertEqual(self.git._find_hashes(sha[:6]), [sha])
+        self.assertEqual(self.git._find_object(sha[:6]), sha)
+
+    def test_session_round_trip(self):
+        with self.git.session():
+            sha = self.git._write_object(tig.GitBlob("hello world"))
+            self.assertEqual(self.git._read_object(sha).data, b"hello world")
+        self.assertEqual(self.git._read_object(sha).data, b"hello world")
+
 
 class TestGitFile(TestSuite, unittest.TestCase):
     def setUp(self):
         self.temp_dir = tempfile.mkdtemp()
 
-        self.git = tig.Git(self.temp_dir, dbType="fs")
+        self.dbType = "fs"
+        self.git = tig.Git(self.temp_dir, dbType=self.dbType)
         self.git.init()
         print("\nTesting FileDatabase:", self._testMethodName)
 
     def tearDown(self):
         shutil.rmtree(self.temp_dir)
 
+    def _add_old_file(self, content):
+        path = os.path.join(self.temp_dir, "working_dir", "salutation.txt")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+        os.utime(path, (0, 1_000_000_000))
+        self.git.add(["working_dir/salutation.txt"])
+        return path
+
+    def test_read_object_packed_by_another_process(self):
+        first = self.git._write_object(tig.GitBlob("first"))
+        self.git.repack()
+        self.assertEqual(self.git._read_object(first).data, b"first") # the pack list is now cached
+        sha = self.git._write_object(tig.GitBlob("hello world"))
+
+        # another process moves the loose object into a new pack
+        tig.Git(self.temp_dir, dbType=self.dbType).repack(prune=False)
+        self.git.db.delete(f".git/objects/{sha[:2]}/{sha[2:]}")
+        self.assertEqual(self.git._read_object(sha).data, b"hello world")
+        self.assertEqual(len(self.git._get_packs()), 2)
+
+    def test_git_add_skips_unchanged_files(self):
+        self._add_old_file("hello world")
+        hashed = []
+        hash_files = self.git._hash_files
+        self.git._hash_files = lambda abspaths, workers=None: hashed.extend(abspaths) or hash_files(abspaths, workers)
+
+        self.git.add(["working_dir/salutation.txt"])
+        self.assertEqual(hashed, [])
+        self.assertEqual(len(self.git._get_index().entries), 1)
+
+    def test_git_add_rehashes_racy_files(self):
+        path = self._add_old_file("hello world")
+        with open(path, "w") as f:
+            f.write("hello there")
+
+        self.git.add(["working_dir/salutation.txt"])
+        [entry] = self.git._get_index().entries
+        self.assertEqual(self.git._read_object(entry.sha).data, b"hello there")
+        # written in the same second as the index: smudged, so the next command can't trust its stat data
+        self.assertEqual(entry.fsize, 0)
+
+    def test_ref_cache(self):
+        sha = self.git._write_object(tig.GitBlob("hello world"))
+        self.git.create_ref("tags", "v1", sha)
+        self.git.pack_refs()
+        packed_path = os.path.join(self.temp_dir, ".git", "packed-refs")
+        os.utime(packed_path, (0, 1_000_000_000))
+
+        reads = []
+        get = self.git.db.get
+        self.git.db.get = lambda path, *args: reads.append(path) or get(path, *args)
+        for _ in range(3):
+            self.assertEqual(self.git._resolve_reference(".git/refs/tags", "v1"), sha)
+        self.assertEqual(reads.count(".git/packed-refs"), 1)
+
+        # written behind our back: the new mtime gives it away
+        other = self.git._write_object(tig.GitBlob("bye"))
+        with open(packed_path, "w") as f:
+            f.write(f"{other} refs/tags/v1\n")
+        self.assertEqual(self.git._resolve_reference(".git/refs/tags", "v1"), other)
+
+    def test_checkout_many_files(self):
+        files = {f"dir_{i % 7}/file_{i:03}.txt": ("100644", f"file {i}".encode()) for i in range(300)}
+        files["tool"] = ("100755", b"#!/bin/sh\n")
+        commit_sha, _ = self._commit_tree(files)
+        os.makedirs(os.path.join(self.temp_dir, "working_dir"))
+        self.git.checkout(commit_sha, "working_dir")
+
+        self.assertTrue(os.access(os.path.join(self.temp_dir, "working_dir", "tool"), os.X_OK))
+        with open(os.path.join(self.temp_dir, "working_dir", "dir_3", "file_010.txt"), "rb") as f:
+            self.assertEqual(f.read(), b"file 10")
+        # the index recorded at checkout matches the files
+        self.assertEqual([c for c in self.git._iter_status() if c[0] != "staged"], [])
+
+    def test_switch_only_chmods(self):
+        old_commit, _ = self._commit_tree({"tool": ("100644", b"#!/bin/sh\n")})
+        new_commit, _ = self._commit_tree({"tool": ("100755", b"#!/bin/sh\n")})
+        os.makedirs(os.path.join(self.temp_dir, "working_dir"))
+        self.git.checkout(old_commit, "working_dir")
+        path = os.path.join(self.temp_dir, "working_dir", "tool")
+        inode = os.stat(path).st_ino
+
+        self.git.switch(new_commit)
+        self.assertTrue(os.access(path, os.X_OK))
+        self.assertEqual(os.stat(path).st_ino, inode)
+        self.assertEqual(self.git._get_index().get("tool").mode_perms, 0o755)
+
+    @unittest.skipUnless(monitor.available(), "the monitor needs inotify")
+    def test_status_with_monitor(self):
+        path = self._add_old_file("hello world")
+        process = monitor.spawn(self.temp_dir)
+        try:
+            # the first status scans everything and records the monitor's token in the index
+            self.assertEqual(list(self.git._iter_status()), [("staged", "added", "salutation.txt")])
+            self.assertIsNotNone(self.git._get_index().fsmonitor_token)
+
+            with open(path, "w") as f:
+                f.write("hello there")
+            with open(os.path.join(self.temp_dir, "working_dir", "new.txt"), "w") as f:
+                f.write("new")
+
+            stat_calls = []
+            get_metadata = self.git.db.get_metadata
+            self.git.db.get_metadata = lambda p: stat_calls.append(p) or get_metadata(p)
+            expected = [("staged", "added", "salutation.txt"), ("unstaged", "modified", "salutation.txt"), ("untracked", None, "new.txt")]
+            self.assertEqual(list(self.git._iter_status()), expected)
+            self.assertEqual([p for p in stat_calls if "working_dir" in p], [path])
+
+            # the paths still dirty are remembered along with the new token
+            self.assertEqual(self.git._get_index().fsmonitor_dirty, {"salutation.txt", "new.txt"})
+            self.assertEqual(list(self.git._iter_status()), expected)
+        finally:
+            monitor.stop(self.temp_dir)
+            process.wait()
+
+        # without the monitor, it's back to a full scan
+        self.assertEqual(list(self.git._iter_status()), expected)
+
+class TestGitSQLite(TestSuite, unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        self.dbType = "sqlite"
+        self.git = tig.Git(os.path.join(self.temp_dir, "git.db"), dbType=self.dbType)
+        self.git.init()
+        print("\nTesting SqliteDatabase:", self._testMethodName)
+
+    def tearDown(self):
+        self.git.db.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_session_rolls_back_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.git.session():
+                self.git._write_object(tig.GitBlob("hello world"))
+                raise ValueError()
+        self.assertFalse(self.git.db.is_folder(".git/objects/95"))
+
+    def test_reader_sees_committed_objects(self):
+        sha = self.git._write_object(tig.GitBlob("hello world"))
+        reader = tig.Git(self.git.db.main, dbType="sqlite")
+        self.assertEqual(reader._read_object(sha).data, b"hello world")
+        reader.db.close()
+
+    def test_delete_folder(self):
+        db = self.git.db
+        for folder in ("docs", "docs/sub", "docs_old"):
+            db.set(folder, None)
+        db.set("docs/a.txt", b"a")
+        db.set("docs/sub/b.txt", b"b")
+        db.set("docs_old/c.txt", b"c")
+        db.set("docs.txt", b"d")
+
+        db.delete("docs")
+        self.assertFalse(db.is_folder("docs"))
+        self.assertEqual(db.conn.execute("SELECT path FROM files WHERE path LIKE 'docs%' ORDER BY path").fetchall(),
+                         [("docs.txt",), ("docs_old",), ("docs_old/c.txt",)])
+
+        sha = self.git._write_object(tig.GitBlob("hello world"))
+        db.delete(f".git/objects/{sha[:2]}")
+        self.assertFalse(db.is_file(f".git/objects/{sha[:2]}/{sha[2:]}"))
+
 class TestGitJSON(TestSuite, unittest.TestCase):
     def setUp(self):
+        self.dbType = "json"
         self.git = tig.Git("/Users/hwjeon/Documents/PROJECTS/tig/tests/git_db.json")
         self.git.init()
         print("\nTesting JSONDatabase:", self._testMethodName)
 
     def tearDown(self):
         self.git.db.clear()
-        self.git.init()
\ No newline at end of file
+        self.git.init()
+
+class TestJsonSession(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "git_db.json")
+        self.db = JsonDatabase(self.path)
+        self.db.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_session_flushes_once_on_exit(self):
+        with self.db.session():
+            self.db.set("folder", None)
+            self.db.set("folder/file", b"hello world")
+            self.assertEqual(self.db.get("folder/file"), b"hello world")
+            self.assertEqual(JsonDatabase(self.path).show(), {})
+        self.assertEqual(JsonDatabase(self.path).get("folder/file"), b"hello world")
+
+    def test_session_discards_on_error(self):
+        with self.assertRaises(ValueError):
+            with self.db.session():
+                self.db.set("folder", None)
+                raise ValueError()
+        self.assertEqual(self.db.show(), {})
+        self.assertEqual(os.listdir(self.temp_dir), ["git_db.json"])
+
+    def test_write_keeps_permissions(self):
+        self.db.set("file", b"hello")
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o666 & ~umask)
+
+        os.chmod(self.path, 0o664)
+        self.db.set("file", b"hello world", overwrite=True)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o664)
+
+    def test_paths_and_metadata(self):
+        self.db.set("folder", None)
+        self.db.set("folder/file", b"hello")
+        path = self.db.abspath("folder/file")
+        self.assertEqual(path, os.path.join(os.path.abspath(self.path), "folder", "file"))
+        self.assertEqual(self.db.get(path), b"hello")
+        self.assertEqual(self.db.relpath(path, self.db.abspath("folder")), "file")
+
+        before = self.db.get_metadata(path)
+        self.assertEqual(before["fsize"], 5)
+        self.db.set("folder/file", b"hello world", overwrite=True)
+        after = self.db.get_metadata("folder/file")
+        self.assertEqual((after["fsize"], after["ctime"]), (11, before["ctime"]))
+        self.assertGreater(after["mtime"], before["mtime"])
+
+        self.db.delete("folder")
+        self.assertEqual(self.db.show(), {".metadata": {}})
+
+
+class TestPack(unittest.TestCase):
+    def setUp(self):
+        self.base = os.urandom(8192)
+        self.target = self.base[:3000] + b"something new" + self.base[3000:7000] + self.base[:500]
+
+    def test_delta_round_trip(self):
+        delta = pack.create_delta(self.base, self.target)
+        self.assertLess(len(delta), 100)
+        self.assertEqual(pack.apply_delta(self.base, delta), self.target)
+
+    def test_ref_delta_pack(self):
+        objects = [("a" * 40, "blob", self.base), ("b" * 40, "blob", self.target)]
+        pack_data, idx_data, _ = pack.write_pack(objects, ofs_delta=False)
+        packed = pack.Pack("pack-test", pack_data, idx_data)
+
+        self.assertLess(len(pack_data), len(self.base) + 1000)
+        self.assertEqual(packed.read("b" * 40), ("blob", self.target))
+        self.assertEqual(packed.read("a" * 40), ("blob", self.base))
+        self.assertIsNone(packed.read("c" * 40))
+
+
+class TestObjects(unittest.TestCase):
+    def test_lazy_commit(self):
+        signature = "-----BEGIN PGP SIGNATURE-----\n" + "\n".join("A" * 64 for _ in range(2000)) + "\n-----END PGP SIGNATURE-----"
+        raw = (
+            f"tree {'a' * 40}\nparent {'b' * 40}\nparent {'c' * 40}\nauthor Alex Jeon <a@b> 1 +0000\n"
+            f"committer Alex Jeon <a@b> 1 +0000\ngpgsig {signature.replace(chr(10), chr(10) + ' ')}\n\nsubject\n\nbody\n"
+        ).encode()
+        commit = tig.GitCommit(raw)
+        self.assertEqual(commit.tree, "a" * 40)
+        self.assertEqual(commit.parents, ["b" * 40, "c" * 40])
+        self.assertEqual(commit.message, "subject\n\nbody")
+        self.assertIsNone(commit._data)
+        self.assertEqual(commit.serialize(), raw)
+        self.assertFalse(hasattr(commit, "__dict__"))
+
+        self.assertEqual(commit.data["gpgsig"], [signature])
+        self.assertEqual(commit.data["parent"], ["b" * 40, "c" * 40])
+        self.assertEqual(commit.data[None], "subject\n\nbody\n")
+
+        # parsed, then serialized again: the same bytes, so the same sha
+        rebuilt = tig.GitCommit()
+        rebuilt.data = commit.data
+        self.assertEqual(rebuilt.serialize(), raw)
+        self.assertEqual(rebuilt.message, "subject\n\nbody")
+        tag = f"object {'a' * 40}\ntype commit\ntag v1\ntagger Alex Jeon <a@b> 1 +0000\n\nrelease\n\n  notes\n".encode()
+        self.assertEqual(utils.kvlm_write(utils.kvlm_read(tag)), tag)
+        self.assertEqual(utils.kvlm_write(utils.kvlm_read(b"\nno header\n")), b"\nno header\n")
+
+    def test_built_commit(self):
+        commit = tig.GitCommit()
+        commit.data = {"tree": "a" * 40, "parent": "b" * 40, None: "message"}
+        self.assertEqual((commit.tree, commit.parents, commit.message), ("a" * 40, ["b" * 40], "message"))
+        tag = tig.GitTag(f"object {'a' * 40}\ntype commit\ntag v1\n\nreleased".encode())
+        self.assertEqual(tag.object, "a" * 40)
+
+
+    def test_compact_tree(self):
+        raw = b"100644 file.txt\x00" + b"\x01" * 20 + b"40000 sub\x00" + b"\x02" * 20
+        tree = utils.CompactTree(raw)
+        self.assertEqual(len(tree), 2)
+        self.assertEqual(list(tree.entries()), [(b"100644", b"file.txt", b"\x01" * 20), (b"40000", b"sub", b"\x02" * 20)])
+        self.assertEqual(list(tree), [utils.TreeNode("100644", "file.txt", "01" * 20), utils.TreeNode("040000", "sub", "02" * 20)])
+        self.assertEqual(tree[-1], utils.TreeNode("040000", "sub", "02" * 20))
+        self.assertEqual(tree, utils.read_tree(raw))
+        self.assertEqual(set(tree.entry_bytes()) - set(utils.CompactTree(raw[:36]).entry_bytes()), {raw[36:]})
+
+        git_tree = tig.GitTree(raw)
+        self.assertEqual(git_tree.data, tree)
+        self.assertEqual(git_tree.serialize(), raw)
+        git_tree.data = list(tree)
+        self.assertEqual(git_tree.serialize(), raw)
+
+        with self.assertRaises(Exception):
+            utils.CompactTree(raw[:-1])
+
+
+class TestBitmap(unittest.TestCase):
+    def test_ewah_round_trip(self):
+        for bits in (0, 1, 1 << 63, (1 << 64) - 1, (1 << 10_000) - 1, 0b1011 << 5000 | 1, int("10" * 300, 2) << 200):
+            data = bitmap.ewah_encode(bits)
+            self.assertEqual(bitmap.ewah_decode(data), (bits, len(data)))
+        # runs compress: ten thousand ones then ten thousand zeros then a one
+        self.assertLess(len(bitmap.ewah_encode(1 << 20_000 | (1 << 10_000) - 1)), 64)
+
+    def test_xor_entries(self):
+        checksum = b"\x01" * 20
+        data = bitmap.write_bitmap(checksum, {"commit": 0b11, "blob": 0b100}, [(0, 0b101), (1, 0b111)])
+        # store the second entry XOR'ed with the first, like git does
+        entry = data.rindex(b"\x00\x00\x00\x01\x00\x00")
+        xored = bitmap.ewah_encode(0b010)
+        data = data[:entry] + b"\x00\x00\x00\x01\x01\x00" + xored + bitmap.ewah_encode(0)[len(xored):]
+
+        parsed = bitmap.PackBitmap(data[:entry + 6 + len(xored)] + b"\x00" * 20, checksum)
+        self.assertEqual(parsed.types["commit"], 0b11)
+        self.assertEqual(parsed.get(1), 0b111)
+        self.assertEqual(parsed.get(0), 0b101)
+        self.assertIsNone(parsed.get(2))
+        with self.assertRaises(Exception):
+            bitmap.PackBitmap(data, b"\x02" * 20)
+
+
+class TestCommitGraph(unittest.TestCase):
+    def test_layers_and_octopus_merges(self):
+        tree = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+        root, a, b, c = "a1" * 20, "b2" * 20, "03" * 20, "ff" * 20
+        bottom, _ = commitgraph.write_graph_layer({root: (tree, [], 1), a: (tree, [root], 2), b: (tree, [root], 3)})
+        base = commitgraph.CommitGraph([bottom])
+        top, _ = commitgraph.write_graph_layer({c: (tree, [a, b, root], 2**33 + 4)}, base)
+        graph = commitgraph.CommitGraph([bottom, top])
+
+        self.assertEqual(len(graph), 4)
+        self.assertIsNone(graph.find("00" * 20))
+        self.assertEqual(graph.find(c), 3)
+        _, parents, generation, commit_time = graph.entry(3)
+        self.assertEqual([graph.sha(p) for p in parents], [a, b, root])
+        self.assertEqual((generation, commit_time), (3, 2**33 + 4))
+        self.assertEqual(graph.commits(), {root: (tree, [], 1), a: (tree, [root], 2), b: (tree, [root], 3), c: (tree, [a, b, root], 2**33 + 4)})
+
+        with self.assertRaises(Exception):
+            commitgraph.CommitGraph([top])
+
+
+class TestGitIndex(unittest.TestCase):
+    def _entry(self, name):
+        return tig.GitIndexEntry(
+            ctime=(1, 2), mtime=(3, 4), dev=5, ino=6, mode_type=0b1000, mode_perms=0o644, uid=7, gid=8,
+            fsize=9, sha="95d09f2b10159347eece71399a7e2e907ea3df4f", flag_assume_valid=False, flag_stage=0, name=name
+        )
+
+    def test_round_trip(self):
+        # names of every length modulo 8, so every amount of padding shows up
+        names = ["a" * n for n in range(1, 17)] + ["dir/" + "b" * 5000]
+        data = tig.GitIndex([self._entry(name) for name in names]).write()
+
+        index = tig.GitIndex()
+        index.read(data)
+        self.assertEqual([e.name for e in index.entries], names)
+        self.assertEqual(index.entries[-1].mtime, (3, 4))
+        self.assertEqual(index.entries[-1].sha, "95d09f2b10159347eece71399a7e2e907ea3df4f")
+
+    def test_sorted_by_path_and_stage(self):
+        index = tig.GitIndex()
+        for name in ["dir/b.txt", "dir.x/d", "a.txt"]:
+            index.add(self._entry(name))
+        conflicted = self._entry("a.txt")
+        conflicted.flag_stage = 2 << 12
+        index.add(conflicted)
+        self.assertEqual([(e.name, e.stage) for e in index], [("a.txt", 0), ("a.txt", 2), ("dir.x/d", 0), ("dir/b.txt", 0)])
+
+        index.remove("a.txt")
+        self.assertNotIn("a.txt", index)
+        self.assertIs(index.get("dir.x/d"), index.entries[0])
+
+    def test_bulk_update(self):
+        index = tig.GitIndex([self._entry(f"file_{i:04}") for i in range(0, 1000, 2)])
+        index.update([self._entry(f"file_{i:04}") for i in range(1, 1000, 2)])
+        index.remove_many(f"file_{i:04}" for i in range(0, 1000, 3))
+        expected = [f"file_{i:04}" for i in range(1000) if i % 3]
+        self.assertEqual([e.name for e in index], expected)
+
+        parsed = tig.GitIndex()
+        parsed.read(index.write())
+        self.assertEqual([e.name for e in parsed], expected)
+
+    def test_version_4_round_trip(self):
+        names = ["a.txt", "deep/path/to/module/a.py", "deep/path/to/module/b.py", "deep/path/to/other.py", "z" * 5000]
+        index = tig.GitIndex([self._entry(name) for name in names])
+        v2 = index.write()
+        index.version = 4
+        v4 = index.write()
+        self.assertLess(len(v4), len(v2))
+
+        parsed = tig.GitIndex()
+        parsed.read(v4)
+        self.assertEqual(parsed.version, 4)
+        self.assertEqual([e.name for e in parsed], names)
+        self.assertEqual(parsed.write(), v4)
+
+    def test_cache_tree_round_trip(self):
+        index = tig.GitIndex([self._entry(name) for name in ["a.txt", "dir/b.txt", "dir/sub/c.txt", "zz/d.txt"]])
+        index.cache_tree = {
+            "": (4, "1" * 40), "dir": (2, "2" * 40), "dir/sub": (1, "3" * 40), "zz": (1, "4" * 40)
+        }
+        index.add(self._entry("dir/sub/e.txt"))
+        self.assertEqual(index.cache_tree["dir/sub"], (-1, None))
+        self.assertEqual(index.cache_tree["zz"], (1, "4" * 40))
+
+        parsed = tig.GitIndex()
+        parsed.read(index.write())
+        self.assertEqual(parsed.cache_tree, index.cache_tree)
+
+    def test_checksum(self):
+        data = bytearray(tig.GitIndex([self._entry("a.txt")]).write())
+        data[20] ^= 0xFF
+        with self.assertRaises(Exception):
+            tig.GitIndex().read(bytes(data))
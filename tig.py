@@ -18,26 +18,172 @@ The features that I don't care about:
 1. ignore rules
 """
 
-import math
 import re
 import os
+import zlib
+import collections
+import heapq
+import itertools
+import struct
+import bisect
 import hashlib
-from utils import kvlm_read, kvlm_write, read_tree, tree_order_fn
-from connectors.database import JsonDatabase, FileDatabase
+import time
+import tempfile
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from utils import kvlm_read, kvlm_write, CompactTree, tree_order_fn, iter_inflate, is_tree_mode, LRUCache, TreeNode
+from utils import encode_offset, decode_offset, fingerprint, DiffEntry, LogEntry, read_commit_header, format_signature
+from utils import merge_lines, read_kvlm_header, read_tree_node
+from connectors.database import JsonDatabase, FileDatabase, SqliteDatabase, stat_metadata
+from pack import Pack, write_pack
+from commitgraph import CommitGraph, write_graph_layer, CHAIN_PATH, LAYERS_PATH
+from bitmap import PackBitmap, write_bitmap, TYPE_ORDER, BITMAP_INTERVAL
+from monitor import Journal
 
 """
 b"" means that the string is stored as a sequence of bytes. 
 "" means that the string is stored as a sequence of Unicode code points. 
 """
 
+EMPTY_BLOB_SHA = "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"
+
+TREE_MODE = "040000"
+
+# the generation of a commit the commit-graph doesn't hold yet: it could be anything, so nothing can be pruned by it
+GENERATION_INFINITY = float("inf")
+
+# index header: signature, version, number of entries
+INDEX_HEADER = struct.Struct(">4sII")
+# index entry: ctime s/ns, mtime s/ns, dev, ino, mode, uid, gid, size, sha, flags (62 bytes); the name follows
+INDEX_ENTRY = struct.Struct(">10I20sH")
+NUL_PADDING = [b"\x00" * n for n in range(9)]
+
+# porcelain status codes, keyed by (category, change)
+STATUS_CODES = {
+    ("staged", "added"): "A ",
+    ("staged", "modified"): "M ",
+    ("staged", "deleted"): "D ",
+    ("unstaged", "modified"): " M",
+    ("unstaged", "deleted"): " D",
+    ("untracked", None): "??",
+    ("unmerged", "both modified"): "UU",
+    ("unmerged", "both added"): "AA",
+    ("unmerged", "deleted by us"): "DU",
+    ("unmerged", "deleted by them"): "UD",
+}
+
+# which sides of a conflict have the path, by the stages in the index (1: base, 2: ours, 3: theirs)
+UNMERGED_CHANGES = {
+    (1, 2, 3): "both modified",
+    (2, 3): "both added",
+    (1, 3): "deleted by us",
+    (1, 2): "deleted by them",
+}
+
+# the first lines of a commit as git writes it: its tree, then its parents
+COMMIT_START = re.compile(rb"tree ([0-9a-f]{40})\n((?:parent [0-9a-f]{40}\n)*)")
+
+# like git, a symbolic ref may only lead to another one so many times
+MAX_SYMREF_DEPTH = 5
+
+# a ref file modified this recently isn't cached: another write within the same mtime tick wouldn't show
+REF_CACHE_RACY_SECONDS = 2
+
+# below this many files, starting worker processes costs more than it saves
+PARALLEL_ADD_THRESHOLD = 64
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def hash_file_to_object(args):
+    """
+    Stats a file, then hashes and deflates it into a temporary loose object in `tmp_dir`, reading it in chunks so
+    memory stays flat however large the file is.
+
+    Runs in worker processes, so it only deals in plain paths. Returns (sha, temporary object path, stat data).
+    """
+    path, tmp_dir, compression_level = args
+    while True:
+        stat = os.stat(path)
+        sha = hashlib.sha1()
+        compressor = zlib.compressobj(compression_level)
+        header = f"blob {stat.st_size}\x00".encode()
+        sha.update(header)
+
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, prefix="tmp_obj_")
+        read = 0
+        with os.fdopen(fd, "wb") as out, open(path, "rb") as f:
+            out.write(compressor.compress(header))
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                read += len(chunk)
+                sha.update(chunk)
+                out.write(compressor.compress(chunk))
+            out.write(compressor.flush())
+
+        if read == stat.st_size:
+            return sha.hexdigest(), tmp_path, stat_metadata(stat)
+
+        # the file changed size while we were reading it; the header is wrong, so start over
+        os.remove(tmp_path)
+
+def hash_file(path):
+    """
+    SHA-1 of the blob a file would become, read in chunks without writing anything.
+    """
+    sha = hashlib.sha1(f"blob {os.path.getsize(path)}\x00".encode())
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def in_session(method):
+    """
+    Runs a `Git` operation inside one database session, so that a whole `add`/`checkout`/... reads and writes
+    the underlying store once instead of once per object touched.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.session():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class Git():
     """
     Anything that deals with anything external should deal with BYTES.
     """
-    def __init__(self, homeDir, dbType="json"):
-        self.db = JsonDatabase(homeDir) if dbType == "json" else FileDatabase(homeDir)
+    def __init__(self, homeDir, dbType="json", compression_level=1, cache_size=32 * 1024 * 1024):
+        if dbType == "json":
+            self.db = JsonDatabase(homeDir)
+        elif dbType == "sqlite":
+            self.db = SqliteDatabase(homeDir)
+        else:
+            self.db = FileDatabase(homeDir)
         self.worktree = "working_dir"
 
+        # zlib level for loose objects; git's `core.loosecompression` defaults to 1 (fastest)
+        self.compression_level = compression_level
+
+        # loaded lazily from .git/objects/pack, and dropped whenever the set of packs changes
+        self._packs = None
+
+        # objects are immutable, so (fmt, content, parsed object) can be cached by SHA for as long as we like.
+        # bounded by the size of the raw contents; `cache_size=0` turns it off
+        self.object_cache = LRUCache(cache_size)
+
+        # sorted SHAs of every loose object, so abbreviated hashes resolve by bisection
+        self.loose_index = LooseObjectIndex(self)
+
+        # loose and packed refs, cached until their files change
+        self.refs = RefStore(self)
+        self._session_depth = 0
+
+        # loaded lazily from .git/objects/info/commit-graphs, and dropped whenever a layer is written. Commits written
+        # during a session go into a new layer when the outermost session exits
+        self._commit_graph = None
+        self._new_commits = {}
+
+        # journal of a `monitor.py` watching the working tree, if one is running; only files on disk can be watched
+        self.monitor = Journal(os.path.join(self.db.main, ".git", "monitor")) if self.db.on_disk else None
+
         # BYTES because converts external -> internal rep
         self.obj_mapping = {
             b"commit": GitCommit,
@@ -54,6 +200,32 @@ class Git():
             b"16": "commit"
         }
 
+    @contextmanager
+    def session(self):
+        """
+        Groups several operations into a single database session. Sessions nest.
+
+        State that is cheaper to write once (like the loose object index) is flushed when the outermost session exits.
+        """
+        with self.db.session():
+            self._session_depth += 1
+            try:
+                yield self
+            except BaseException:
+                # whatever the database just rolled back may still be sitting in our in-memory state
+                self.loose_index.reset()
+                self.refs.reset()
+                self._new_commits = {}
+                self._commit_graph = None
+                raise
+            finally:
+                self._session_depth -= 1
+
+            if not self._session_depth:
+                self.loose_index.flush()
+                self._flush_commit_graph()
+
+    @in_session
     def init(self):
         self.db.set(".git", None)
         self.db.set(".git/objects", None)
@@ -61,12 +233,70 @@ class Git():
         self.db.set(".git/refs/heads", None)
         self.db.set(".git/refs/tags", None)
         self.db.set(".git/objects/pack", None)
+        self.db.set(".git/objects/info", None)
         self._create_index()
 
-    def commit(self, msg):
-        pass
+    @in_session
+    def commit(self, msg, author=None):
+        """
+        Commits the index on top of HEAD and advances the branch HEAD points to (or HEAD itself, if it's detached).
+        While a merge is waiting for its conflicts to be resolved (.git/MERGE_HEAD), the commit concludes it.
+
+        Trees come from `write_tree`, so only the directories changed since the last commit are hashed and written.
+        """
+        return self._commit(self._get_index(), msg, author)
+
+    def _commit(self, index, msg, author=None):
+        tree_sha = self._write_tree(index)
+        parent_sha = self._get_current_branch()
+        merge_head = self._get_merge_head()
+        if not merge_head and parent_sha and self._read_object(parent_sha).tree == tree_sha:
+            raise Exception("Nothing to commit: the index matches HEAD.")
+
+        if author is None:
+            author = f"{os.environ.get('GIT_AUTHOR_NAME', 'tig')} <{os.environ.get('GIT_AUTHOR_EMAIL', '')}>"
+        offset = time.localtime().tm_gmtoff // 60
+        signature = f"{author} {int(time.time())} {'-' if offset < 0 else '+'}{abs(offset) // 60:02}{abs(offset) % 60:02}"
+
+        commit = GitCommit()
+        commit.data = {"tree": tree_sha}
+        if parent_sha:
+            commit.data["parent"] = [parent_sha] + ([merge_head] if merge_head else [])
+        commit.data.update({"author": signature, "committer": signature, None: msg.strip() + "\n"})
+        commit_sha = self._write_object(commit)
+
+        self._update_head(commit_sha)
+        if merge_head:
+            self.db.delete(".git/MERGE_HEAD")
+        return commit_sha
+
+    def _get_merge_head(self):
+        try:
+            return self.db.get(".git/MERGE_HEAD").strip().decode()
+        except Exception:
+            return None
 
-    def add(self, paths):
+    def _update_head(self, sha):
+        """
+        Points the branch HEAD refers to at `sha`. A repository without a HEAD gets one on "main" first.
+        """
+        head = self.refs.read("HEAD")
+        if head is None:
+            head = "ref: refs/heads/main"
+            self.refs.write("HEAD", head)
+
+        if not head.startswith("ref: "):
+            self.refs.write("HEAD", sha)
+            return
+        self.refs.write(head[5:], sha)
+
+    @in_session
+    def add(self, paths, workers=None):
+        """
+        Stages `paths`. On disk, files are stat'ed, hashed and deflated across `workers` processes (all CPUs by
+        default; 1 means in-process), and every resulting blob is moved into place in one batch before the index is
+        written once.
+        """
         index = self._get_index()
 
         # normalize paths
@@ -74,18 +304,24 @@ class Git():
         for p in paths_to_add:
             if not self.db.is_file(p):
                 raise Exception(f"{p} is not a file.")
-            
-        # remove index entries that are already in the index
-        index.entries = [e for e in index.entries if self.db.abspath(e.name) not in paths_to_add]
 
         # construct relative path equivalents    
         paths_to_add = [(p, self.db.relpath(p, os.path.join(self.db.main, self.worktree))) for p in paths_to_add]
 
+        # files whose stat data still matches their index entry are unchanged: keep the entry, skip the hashing.
+        # with a monitor running, files it hasn't seen change aren't even stat'ed
+        changed = self._monitor_changes(index)
+        paths_to_hash = []
         for abspath, relpath in paths_to_add:
-            blob = GitBlob(self.db.get(abspath, no_encoding=True))
-            blob_sha = self._write_object(blob)
-
-            stat = self.db.get_metadata(abspath)
+            entry = index.get(relpath)
+            if entry is not None and changed is not None and self._monitor_trusts(entry, changed[0], index.timestamp):
+                continue
+            if entry is None or not self._is_stat_clean(entry, self.db.get_metadata(abspath), index.timestamp):
+                paths_to_hash.append((abspath, relpath))
+
+        hashed = self._hash_files([abspath for abspath, _ in paths_to_hash], workers=workers)
+        new_entries = []
+        for (abspath, relpath), (blob_sha, stat) in zip(paths_to_hash, hashed):
             entry = GitIndexEntry(
                 ctime = stat["ctime"],
                 mtime = stat["mtime"],
@@ -102,12 +338,129 @@ class Git():
                 name = relpath
             )
 
-            index.entries.append(entry)
+            new_entries.append(entry)
+
+        # replace whatever was staged for those paths (including conflict stages)
+        index.remove_many(relpath for _, relpath in paths_to_hash)
+        index.update(new_entries)
+        self._write_index(index)
+
+    def _stat_matches(self, entry, stat):
+        """
+        Compares an index entry against fresh stat data, the way git's `ce_match_stat` does.
+        """
+        if entry.mtime != stat["mtime"] or entry.ctime != stat["ctime"]:
+            return False
+        if (entry.ino & 0xFFFFFFFF) != (stat["ino"] & 0xFFFFFFFF) or (entry.dev & 0xFFFFFFFF) != (stat["dev"] & 0xFFFFFFFF):
+            return False
+        if entry.uid != stat["uid"] or entry.gid != stat["gid"]:
+            return False
+        if (entry.mode_type, entry.mode_perms) != (stat["mode_type"], stat["mode_perms"]):
+            return False
+        if entry.fsize != (stat["fsize"] & 0xFFFFFFFF):
+            return False
+        # a size of 0 means the entry was smudged (see `_write_index`), unless the file really is empty
+        if entry.fsize == 0 and entry.sha != EMPTY_BLOB_SHA:
+            return False
+        return True
+
+    def _is_stat_clean(self, entry, stat, index_timestamp):
+        """
+        True if the file behind `entry` is known to be unchanged without reading it.
+
+        A file modified in the same timestamp tick as the index was written could have changed after it was hashed
+        while keeping identical stat data ("racy git"), so those are never trusted.
+        """
+        if not self._stat_matches(entry, stat):
+            return False
+        return index_timestamp is not None and tuple(entry.mtime) < tuple(index_timestamp)
+
+    def _monitor_changes(self, index):
+        """
+        Returns (paths that may have changed since `index` was written, monitor token for now), from the monitor's
+        journal and the paths the index already knew to be dirty. None without a running monitor, or if the journal
+        can't account for everything since the index's token (it overflowed or restarted): then only a full scan will do.
+        """
+        if self.monitor is None or index.fsmonitor_token is None:
+            return None
+        changes = self.monitor.changes_since(index.fsmonitor_token)
+        if changes is None:
+            return None
+        paths, token = changes
+        return paths | index.fsmonitor_dirty, token
+
+    def _monitor_trusts(self, entry, changed, index_timestamp):
+        """
+        True if `entry` is clean without stat'ing it: the monitor saw nothing happen to it (or to a folder above it), and
+        its stat data was trustworthy when the index was written (see `_is_stat_clean`).
+        """
+        if entry.fsize == 0 and entry.sha != EMPTY_BLOB_SHA:
+            return False
+        if index_timestamp is None or tuple(entry.mtime) >= tuple(index_timestamp):
+            return False
+        path = entry.name
+        while path:
+            if path in changed:
+                return False
+            path = path.rpartition("/")[0]
+        return True
+
+    def _write_index(self, index):
+        """
+        Before writing, entries modified no earlier than the second we are writing in get their size zeroed ("smudged"),
+        like git does. Otherwise a file changed again within that second, keeping its size and mtime, would look clean
+        to every later command, once the index itself has a newer timestamp.
+
+        The monitor token moves forward too; whatever changed since the old one is kept as dirty.
+        """
+        now = int(time.time())
+        for e in index:
+            if e.mtime[0] >= now:
+                e.fsize = 0
+
+        if index.fsmonitor_token is not None:
+            changes = self._monitor_changes(index)
+            if changes is None:
+                index.fsmonitor_token, index.fsmonitor_dirty = None, set()
+            else:
+                index.fsmonitor_dirty, index.fsmonitor_token = changes
 
-        new_index = index.write()
-        self.db.set(".git/index", new_index, overwrite=True)
+        self.db.set(".git/index", index.write(), overwrite=True)
 
+    def _hash_files(self, abspaths, workers=None):
+        """
+        Writes every file in `abspaths` as a blob and returns a list of (sha, stat data) in the same order.
+        """
+        if not self.db.on_disk:
+            hashed = []
+            for abspath in abspaths:
+                stat = self.db.get_metadata(abspath)
+                hashed.append((self._write_object(GitBlob(self.db.get(abspath))), stat))
+            return hashed
+
+        tmp_dir = os.path.join(self.db.main, ".git", "objects")
+        jobs = [(abspath, tmp_dir, self.compression_level) for abspath in abspaths]
+        workers = workers or os.cpu_count() or 1
+        if workers > 1 and len(jobs) >= PARALLEL_ADD_THRESHOLD:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(hash_file_to_object, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+        else:
+            results = [hash_file_to_object(job) for job in jobs]
+
+        # one batch: move every new object into place, and throw away the ones we already had
+        hashed = []
+        for sha, tmp_path, stat in results:
+            object_path = f".git/objects/{sha[:2]}/{sha[2:]}"
+            if self.db.is_file(object_path):
+                os.remove(tmp_path)
+            else:
+                self.db.set(f".git/objects/{sha[:2]}/", None)
+                self.db.move(os.path.relpath(tmp_path, self.db.main), object_path)
+                self.loose_index.add(sha)
+            hashed.append((sha, stat))
+        return hashed
 
+    @in_session
     def rm(self, paths):
         """
         Remember that the paths in the index file are relative paths.
@@ -127,28 +480,36 @@ class Git():
         """
         index = self._get_index()
 
-        # normalize paths
-        paths_to_remove = [self.db.abspath(p) for p in paths]
+        # normalize paths (relative to the database, once per path rather than once per index entry)
+        root = self.db.abspath("")
+        index.remove_many(self.db.relpath(self.db.abspath(p), root) for p in paths)
 
-        new_index_entries = [e for e in index.entries if self.db.abspath(e.name) not in paths_to_remove]
-
-        index.entries = new_index_entries
-        new_index = index.write()
-        self.db.set(".git/index", new_index, overwrite=True)
+        self._write_index(index)
 
 
+    @in_session
     def ls_tree(self, ref, recursive=False, prefix_path=""):
-        sha = self._resolve_reference(".git/refs", ref)
-        tree_obj = self._read_object(sha)
-
-        for node in tree_obj.data:
-            mode, path, sha = node
+        """
+        Prints the entries of the tree `ref` (a tree, a commit, a branch, a tag or HEAD) refers to, as
+        `git ls-tree` does: "<mode> <type> <sha>\t<path>". With `recursive`, subtrees are listed instead of shown.
+        """
+        sha = self._resolve_object(ref)
+        while self._read_object_header(sha)[0] == "tag":
+            sha = self._read_object(sha).object
+        self._ls_tree(self._as_tree(sha), recursive, prefix_path)
+
+    def _ls_tree(self, tree_sha, recursive, prefix_path):
+        for mode, name, sha in self._read_tree(tree_sha).entries():
+            # git writes "40000" for trees, but shows "040000"
+            mode = mode.rjust(6, b"0")
             obj_type = self.mode_mapping[mode[:2]]
-            print(f"{mode} {obj_type} {sha} {os.path.join(prefix_path, path)}")
-
+            path = os.path.join(prefix_path, name.decode())
             if recursive and obj_type == "tree":
-                self.ls_tree(sha, recursive=recursive, prefix_path=path)
+                self._ls_tree(sha.hex(), recursive, path)
+            else:
+                print(f"{mode.decode()} {obj_type} {sha.hex()}\t{path}")
 
+    @in_session
     def ls_files(self):
         index = self._get_index()
         for e in index.entries:
@@ -160,37 +521,627 @@ class Git():
             parsed_index = GitIndex()
             parsed_index.read(index)
 
+            # the index's own mtime tells which entries are too recent for their stat data to be trusted
+            try:
+                parsed_index.timestamp = self.db.get_metadata(self.db.abspath(".git/index"))["mtime"]
+            except Exception:
+                parsed_index.timestamp = None
+
             return parsed_index
         except Exception as e:
             print(e)
             return GitIndex()
     
+    @in_session
+    def set_index_version(self, version):
+        """
+        Rewrites the index in `version` (2, 3 or 4). The version sticks: every later write keeps the one it read.
+        Version 4 prefix-compresses each path against the previous one, which shrinks deep trees several times.
+        """
+        if version not in (2, 3, 4):
+            raise Exception(f"tig only supports index versions 2, 3 and 4, not {version}.")
+        index = self._get_index()
+        index.version = version
+        self._write_index(index)
+
     def _create_index(self):
         index = GitIndex()
         bytes_index = index.write()
         self.db.set(".git/index", bytes_index)
 
-    def commit(self):
-        pass
+    def is_ancestor(self, ancestor, commit):
+        """
+        True if `ancestor` is `commit` or one of its ancestors (like `git merge-base --is-ancestor`). The walk reads
+        parents from the commit-graph and never goes below the generation of `ancestor`, so asking about a recent
+        commit only visits the commits between the two.
+        """
+        graph = self._get_commit_graph()
+        target = self._commit_key(graph, self._resolve_commit(ancestor))
+        start = self._commit_key(graph, self._resolve_commit(commit))
+        return self._is_ancestor(graph, target, start)
+
+    def _is_ancestor(self, graph, target, start):
+        min_generation = self._read_commit(graph, target)[3]
+
+        seen = {start}
+        stack = [start]
+        while stack:
+            key = stack.pop()
+            if key == target:
+                return True
+            _, _, parents, generation, _ = self._read_commit(graph, key)
+            if generation != GENERATION_INFINITY and generation <= min_generation:
+                continue
+            for parent in parents:
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+        return False
+
+    @in_session
+    def log(self, rev="HEAD", max_count=None, skip=0, since=None):
+        """
+        Prints the history of `rev` like `git log`, newest first, as soon as each commit is found.
+        """
+        for i, entry in enumerate(self._iter_log(rev, max_count, skip, since)):
+            _, _, body = self._open_object(entry.sha)
+            header, _, message = b"".join(body).partition(b"\n\n")
+            author = next(line[7:] for line in header.split(b"\n") if line.startswith(b"author "))
+            identity, date = format_signature(author.decode("utf-8", "replace"))
+
+            if i:
+                print()
+            print(f"commit {entry.sha}")
+            if len(entry.parents) > 1:
+                print(f"Merge: {' '.join(parent[:7] for parent in entry.parents)}")
+            print(f"Author: {identity}")
+            print(f"Date:   {date}")
+            print()
+            for line in message.decode("utf-8", "replace").rstrip("\n").split("\n"):
+                print(f"    {line}")
+
+    def _iter_log(self, rev="HEAD", max_count=None, skip=0, since=None):
+        """
+        Yields a LogEntry for every commit reachable from `rev`, newest commit date first like `git log`, leaving out
+        the first `skip` and stopping after `max_count`. Commits older than `since` (a unix timestamp) are left out,
+        and so are the parents they lead to.
 
-    def log(self):
-        pass
+        Commits come off a heap ordered by commit date, and only the commits popped so far have had their parents
+        read: the last 20 commits of any history cost about 20 commits. Parents and dates come from the commit-graph,
+        or from the header of a commit it doesn't hold yet; messages are never parsed.
+        """
+        if rev == "HEAD":
+            sha = self._get_current_branch()
+            if not sha:
+                raise Exception("HEAD doesn't point to a commit yet.")
+        else:
+            sha = self._resolve_commit(rev)
+
+        graph = self._get_commit_graph()
+        heap = []
+        order = itertools.count() # ties go to the commit queued first, like git
+        def push(key):
+            commit_sha, tree, parents, _, commit_time = self._read_commit(graph, key)
+            heapq.heappush(heap, (-commit_time, next(order), commit_sha, tree, parents))
+
+        start = self._commit_key(graph, sha)
+        seen = {start}
+        push(start)
+        shown = 0
+        while heap and (max_count is None or shown < max_count):
+            negative_time, _, sha, tree, parents = heapq.heappop(heap)
+            if since is not None and -negative_time < since:
+                continue
+
+            for parent in parents:
+                if parent not in seen:
+                    seen.add(parent)
+                    push(parent)
+
+            if skip:
+                skip -= 1
+                continue
+            parent_shas = [graph.sha(parent) if isinstance(parent, int) else parent for parent in parents]
+            yield LogEntry(sha, tree, parent_shas, -negative_time)
+            shown += 1
+
+    def merge_base(self, one, two):
+        """
+        Returns the best common ancestors of `one` and `two`, like `git merge-base --all`: usually one commit, more
+        after criss-cross merges.
+        """
+        graph = self._get_commit_graph()
+        one = self._commit_key(graph, self._resolve_commit(one))
+        two = self._commit_key(graph, self._resolve_commit(two))
+        return [self._read_commit(graph, key)[0] for key in self._merge_bases(graph, one, two)]
 
-    def merge(self):
-        pass
+    def _merge_bases(self, graph, one, two):
+        """
+        Git's paint-down-to-common: both histories are walked together, highest generation first (then newest), each
+        commit painted with the sides that reach it. A commit reached from both sides is a common ancestor, and
+        everything below it is painted stale. The walk stops once only stale commits are left, so two branches
+        forked recently only visit the commits since the fork.
+        """
+        if one == two:
+            return [one]
+
+        PARENT1, PARENT2, STALE = 1, 2, 4
+        flags = {one: PARENT1, two: PARENT2}
+        heap = []
+        order = itertools.count()
+        # how many times each commit is queued, and how many queued entries aren't stale: the walk runs while any is
+        queued = collections.Counter()
+        active = 0
+        def push(key):
+            nonlocal active
+            _, _, parents, generation, commit_time = self._read_commit(graph, key)
+            heapq.heappush(heap, (-generation, -commit_time, next(order), key, parents))
+            queued[key] += 1
+            if not flags[key] & STALE:
+                active += 1
+        def paint(key, new_flags):
+            nonlocal active
+            if new_flags & STALE and not flags.get(key, 0) & STALE:
+                active -= queued[key]
+            flags[key] = new_flags
+        push(one)
+        push(two)
+
+        bases = []
+        while active:
+            _, _, _, key, parents = heapq.heappop(heap)
+            key_flags = flags[key]
+            queued[key] -= 1
+            if not key_flags & STALE:
+                active -= 1
+            if key_flags & (PARENT1 | PARENT2 | STALE) == PARENT1 | PARENT2:
+                bases.append(key)
+                key_flags |= STALE
+                paint(key, key_flags)
+            for parent in parents:
+                if flags.get(parent, 0) & key_flags == key_flags:
+                    continue
+                paint(parent, flags.get(parent, 0) | key_flags)
+                push(parent)
+
+        # a common ancestor found before the walk knew it was below another one
+        return [
+            base for base in bases
+            if not any(other != base and self._is_ancestor(graph, base, other) for other in bases)
+        ]
+
+    @in_session
+    def merge(self, commit, msg=None, author=None):
+        """
+        Merges `commit` (a sha, branch or tag) into HEAD and returns the new HEAD.
+
+        Fast-forwards when HEAD is an ancestor of `commit`. Otherwise the three trees (merge base, HEAD, `commit`) are
+        merged: a subtree (or blob) that two of the three share is resolved without being read, and only blobs both
+        sides changed are merged line by line. A clean merge is committed. Conflicts are left in the working tree
+        between markers, and in the index as stages 1 (base), 2 (HEAD) and 3 (`commit`); resolving them with `add` and
+        then calling `commit` concludes the merge. A file that one side has where the other has a folder is moved to
+        "<path>~<label>" (HEAD or `commit`), and conflicts there.
+
+        With several merge bases (after criss-cross merges), the newest one is used.
+        """
+        if self._get_merge_head():
+            raise Exception("A merge is already in progress: resolve its conflicts and commit first.")
+        ours = self._get_current_branch()
+        if not ours:
+            raise Exception("HEAD doesn't point to a commit yet.")
+        theirs = self._resolve_commit(commit)
+
+        graph = self._get_commit_graph()
+        bases = self._merge_bases(graph, self._commit_key(graph, ours), self._commit_key(graph, theirs))
+        base = self._read_commit(graph, bases[0])[0] if bases else None
+
+        index = self._get_index()
+        if any(e.flag_stage for e in index):
+            raise Exception("The index has unresolved conflicts: resolve them and commit first.")
+        ours_tree, theirs_tree = self._as_tree(ours), self._as_tree(theirs)
+
+        if base == theirs:
+            print("Already up to date.")
+            return ours
+        if base == ours:
+            changes = list(self._diff_trees(ours_tree, theirs_tree))
+            self._refuse_local_changes(index, changes, "merging")
+            self._apply_tree_changes(index, changes)
+            self._write_index(index)
+            self._update_head(theirs)
+            print("Fast-forward")
+            return theirs
+
+        changes, conflicts = [], []
+        labels = ("HEAD", commit)
+        self._merge_trees(self._as_tree(base), ours_tree, theirs_tree, "", changes, conflicts, labels)
+        self._refuse_local_changes(index, changes + [
+            # a file moved out of a folder's way lands on a new path: nothing may be there yet
+            (path, None, nodes[1] or nodes[2]) if kind == "file/directory" else (path, nodes[1], nodes[2] or nodes[1])
+            for path, nodes, _, kind in conflicts
+        ], "merging")
+        self._apply_tree_changes(index, changes)
+
+        for path, nodes, content, kind in conflicts:
+            if content is not None:
+                for folder in self._folders_above(path):
+                    self.db.set(os.path.join(self.worktree, folder), None)
+                self.db.set(os.path.join(self.worktree, path), content, overwrite=True)
+            elif nodes[1] is None or kind == "file/directory":
+                # deleted by us: theirs' version goes back in the working tree for whoever resolves it. A file moved
+                # out of a folder's way is written under its new path
+                node = nodes[1] or nodes[2]
+                for folder in self._folders_above(path):
+                    self.db.set(os.path.join(self.worktree, folder), None)
+                self._write_checkout_files(self.worktree, [(path, node.mode, node.sha)])
+
+            index.remove(path)
+            for stage, node in enumerate(nodes, 1):
+                if node is not None:
+                    index.add(GitIndexEntry(
+                        ctime = (0, 0), mtime = (0, 0), dev = 0, ino = 0,
+                        mode_type = int(node.mode, 8) >> 12,
+                        mode_perms = int(node.mode, 8) & 0o777,
+                        uid = 0, gid = 0, fsize = 0,
+                        sha = node.sha,
+                        flag_assume_valid = False,
+                        flag_stage = stage << 12,
+                        name = path
+                    ))
+
+        # `commit` makes MERGE_HEAD the second parent, whether it's called now or once the conflicts are resolved
+        self.db.set(".git/MERGE_HEAD", theirs.encode(), overwrite=True)
+        if conflicts:
+            self._write_index(index)
+            for path, nodes, _, kind in conflicts:
+                if kind == "file/directory":
+                    label = labels[0 if nodes[1] is not None else 1]
+                    moved_from = path[:-len(f"~{label.replace('/', '_')}")]
+                    print(f"CONFLICT ({kind}): directory in the way of {moved_from} from {label}; moving it to {path} instead.")
+                else:
+                    print(f"CONFLICT ({kind}): Merge conflict in {path}")
+            print("Automatic merge failed; fix conflicts and then commit the result.")
+            return ours
+
+        if msg is None:
+            msg = f"Merge {'commit' if re.fullmatch(r'[0-9a-f]{4,40}', commit) else 'branch'} '{commit}'"
+        # (the index is only written once, by the commit)
+        return self._commit(index, msg, author)
+
+    def _merge_trees(self, base, ours, theirs, prefix, changes, conflicts, labels):
+        """
+        Three-way merge of the trees `base`, `ours` and `theirs` (shas or None) at `prefix`. Appends to `changes` what
+        the merge changes in `ours` ((path, our node, merged node) for blobs, as `_diff_trees` yields) and to
+        `conflicts` (path, (base, ours, theirs nodes), working tree content or None, kind) for what it can't resolve,
+        kind being "content", "modify/delete" or "file/directory".
+        """
+        if ours == theirs or base == theirs:
+            return
+        if base == ours:
+            changes.extend(self._diff_trees(ours, theirs, prefix))
+            return
+
+        base_nodes, ours_nodes, theirs_nodes = (
+            {} if tree is None else {n.path: n for n in self._read_object(tree).data} for tree in (base, ours, theirs)
+        )
+        def key(node):
+            return None if node is None else (node.mode, node.sha)
+
+        for name in sorted(base_nodes.keys() | ours_nodes.keys() | theirs_nodes.keys()):
+            b, o, t = base_nodes.get(name), ours_nodes.get(name), theirs_nodes.get(name)
+            path = os.path.join(prefix, name)
+            if key(o) == key(t) or key(b) == key(t):
+                continue
+            if key(b) == key(o):
+                changes.extend(self._diff_nodes(path, o, t))
+                continue
+
+            trees = [node is not None and is_tree_mode(node.mode) for node in (b, o, t)]
+            if (trees[1] or trees[2]) and all(tree or node is None for tree, node in zip(trees[1:], (o, t))):
+                # (a file in base that neither side kept is just gone)
+                self._merge_trees(
+                    b.sha if trees[0] else None, o.sha if trees[1] else None, t.sha if trees[2] else None,
+                    path, changes, conflicts, labels
+                )
+            elif any(trees):
+                self._merge_file_and_folder(path, (b, o, t), trees, changes, conflicts, labels)
+            else:
+                self._merge_blobs(path, b, o, t, changes, conflicts, labels)
+
+    def _merge_file_and_folder(self, path, nodes, trees, changes, conflicts, labels):
+        """
+        `path` is a folder on some side and a file on another. The files are merged as if no side had a folder, and
+        the folders as if no side had a file. A file that runs into the other side's folder moves out of its way, to
+        "<path>~<label of its side>", where it is left as a "file/directory" conflict, as git does.
+        """
+        b, o, t = (None if tree else node for tree, node in zip(trees, nodes))
+        def key(node):
+            return None if node is None else (node.mode, node.sha)
+
+        if (o is not None and trees[2]) or (t is not None and trees[1]):
+            side = 1 if o is not None else 2
+            label = labels[side - 1].replace("/", "_")
+            if side == 1:
+                # our file makes way for their folder (deletions are applied first)
+                changes.append((path, o, None))
+            conflicts.append((f"{path}~{label}", (b, o, t), None, "file/directory"))
+        elif not (key(o) == key(t) or key(b) == key(t)):
+            if key(b) == key(o):
+                changes.extend(self._diff_nodes(path, o, t))
+            else:
+                self._merge_blobs(path, b, o, t, changes, conflicts, labels)
+
+        folders = [node.sha if tree else None for tree, node in zip(trees, nodes)]
+        self._merge_trees(*folders, path, changes, conflicts, labels)
+
+    def _merge_blobs(self, path, b, o, t, changes, conflicts, labels):
+        if o is None or t is None:
+            # modified on one side, deleted on the other
+            conflicts.append((path, (b, o, t), None, "modify/delete"))
+            return
+
+        modes = [node.mode if node is not None else None for node in (b, o, t)]
+        mode = modes[1] if modes[1] == modes[2] or modes[0] == modes[2] else modes[2] if modes[0] == modes[1] else None
+        if o.sha == t.sha:
+            if mode is None:
+                conflicts.append((path, (b, o, t), None, "content"))
+            else:
+                changes.append((path, o, TreeNode(mode, o.path, o.sha)))
+            return
+
+        text_modes = ("100644", "100755")
+        base_content = self._read_object(b.sha).data if b is not None else b""
+        ours_content, theirs_content = self._read_object(o.sha).data, self._read_object(t.sha).data
+        if (
+            o.mode not in text_modes or t.mode not in text_modes
+            or any(b"\x00" in content[:8000] for content in (base_content, ours_content, theirs_content))
+        ):
+            # binaries, symlinks and submodules aren't merged line by line: ours stays in the working tree
+            conflicts.append((path, (b, o, t), None, "content"))
+            return
+
+        merged, conflict_count = merge_lines(base_content, ours_content, theirs_content, *labels)
+        if conflict_count or mode is None:
+            conflicts.append((path, (b, o, t), merged, "content"))
+            return
+        changes.append((path, o, TreeNode(mode, o.path, self._write_object(GitBlob(merged)))))
 
     def pull(self):
         pass
 
+    @in_session
     def status(self):
-        pass
+        """
+        Prints staged, unstaged and untracked paths in git's porcelain format. A tracked path gets one line whose XY code
+        combines HEAD vs the index (X) and the index vs the working tree (Y), so those are printed once both diffs are
+        done, sorted by path; untracked paths come last, as soon as each one is found.
+        """
+        codes = {}
+        def print_tracked():
+            for path in sorted(codes, key=lambda path: path.encode()):
+                print(f"{codes[path]} {path}")
+            codes.clear()
+
+        for category, change, path in self._iter_status():
+            code = STATUS_CODES[(category, change)]
+            if category == "untracked":
+                print_tracked()
+                print(f"{code} {path}")
+            else:
+                # "A " and " M" make "AM"
+                codes[path] = "".join(y if x == " " else x for x, y in zip(codes.get(path, "  "), code))
+        print_tracked()
+
+    def _iter_status(self):
+        """
+        Yields (category, change, path) tuples: first HEAD vs the index ("staged") and the paths a merge left in
+        conflict ("unmerged"), then the index vs the working tree ("unstaged"), then files that aren't in the index at
+        all ("untracked").
+        """
+        index = self._get_index()
+        entries = [e for e in index.entries if not e.flag_stage]
+
+        # with a monitor running, only the paths it journaled since the index was written need looking at
+        changes = self._monitor_changes(index)
+        if changes is not None:
+            changed, token = changes
+        else:
+            changed, token = None, self.monitor.sync() if self.monitor is not None else None
+
+        head_sha = self._get_current_branch()
+        head_tree = self._read_object(head_sha).tree if head_sha else None
+        # the index's trees are only hashed: the diff reads them from here. Directories taken from the index's cached
+        # tree aren't in it, but their trees were written, so the object store has them
+        index_trees = self._build_index_trees(entries, index.cache_tree)
+        index_tree = index_trees[""][0]
+        unmerged = {}
+        for e in index.entries:
+            if e.flag_stage:
+                unmerged.setdefault(e.name, []).append(e.stage)
+        for path, old, new in self._diff_trees(head_tree, index_tree, trees=dict(index_trees.values())):
+            if path not in unmerged:
+                yield "staged", "added" if old is None else "deleted" if new is None else "modified", path
+        for path, stages in unmerged.items():
+            yield "unmerged", UNMERGED_CHANGES.get(tuple(stages), "both modified"), path
+
+        dirty = set()
+        if changed is not None:
+            entries = [e for e in entries if not self._monitor_trusts(e, changed, index.timestamp)]
+        for change, path in self._diff_index_worktree(entries, index.timestamp):
+            dirty.add(path)
+            yield "unstaged", change, path
+
+        tracked = {e.name for e in index.entries}
+        if changed is not None:
+            untracked = self._untracked_changed_files(changed, tracked)
+        else:
+            untracked = self._untracked_files("", tracked)
+        for path in untracked:
+            dirty.add(path)
+            yield "untracked", None, path
+
+        if token is not None:
+            # everything is accounted for as of `token`: what's still dirty has to be looked at again next time
+            index.fsmonitor_token, index.fsmonitor_dirty = token, dirty
+            self._write_index(index)
+
+    def _diff_index_worktree(self, entries, index_timestamp):
+        """
+        Yields (change, path) for index entries whose working tree file is gone or differs. Files whose stat data
+        matches their entry are never read; on disk, the stat calls run from a thread pool.
+        """
+        root = os.path.join(self.db.main, self.worktree)
+
+        def check(entry):
+            abspath = os.path.join(root, entry.name)
+            try:
+                stat = self.db.get_metadata(abspath)
+            except Exception:
+                return "deleted"
+
+            if self._is_stat_clean(entry, stat, index_timestamp):
+                return None
+            return "modified" if self._hash_worktree_file(abspath) != entry.sha else None
+
+        if self.db.on_disk:
+            with ThreadPoolExecutor(max_workers=min(32, 4 * (os.cpu_count() or 1))) as executor:
+                for entry, change in zip(entries, executor.map(check, entries)):
+                    if change:
+                        yield change, entry.name
+        else:
+            for entry in entries:
+                change = check(entry)
+                if change:
+                    yield change, entry.name
+
+    def _hash_worktree_file(self, abspath):
+        if self.db.on_disk:
+            return hash_file(abspath)
+        return self._hash_object(GitBlob(self.db.get(abspath)))[0]
+
+    def _untracked_changed_files(self, changed, tracked):
+        untracked = set()
+        for path in changed:
+            if path in tracked:
+                continue
+            folder = os.path.join(self.worktree, path)
+            if self.db.is_folder(folder):
+                untracked.update(self._untracked_files(path, tracked))
+            elif os.path.lexists(os.path.join(self.db.main, folder)):
+                untracked.add(path)
+        return sorted(untracked)
+
+    def _untracked_files(self, prefix, tracked):
+        folder = os.path.join(self.worktree, prefix)
+        try:
+            names = self.db.list(folder)
+        except Exception:
+            return
+
+        for name in names:
+            path = os.path.join(prefix, name)
+            if self.db.is_folder(os.path.join(folder, name)):
+                yield from self._untracked_files(path, tracked)
+            elif path not in tracked:
+                yield path
+
+    def _build_index_trees(self, entries, cache_tree=None, write=False):
+        """
+        Hashes the tree objects made by the (sorted, stage 0) index entries, bottom-up. A directory with a valid sha in
+        `cache_tree` is skipped over whole: its entries are contiguous, and the cache knows how many there are.
+
+        With `write`, the new tree objects are written and `cache_tree` is refreshed to match `entries`.
+
+        Returns {directory: (tree sha, [TreeNode])} for every directory that was visited, with "" being the root.
+        """
+        if cache_tree is None:
+            cache_tree = {}
+        trees = {}
+        num_entries = len(entries)
+
+        def cached_sha(directory, start):
+            count, sha = cache_tree.get(directory, (-1, None))
+            if count < 0 or start + count > num_entries:
+                return None
+            # make sure the cached count still lines up with where the directory ends
+            prefix = directory + "/" if directory else ""
+            if count and not entries[start + count - 1].name.startswith(prefix):
+                return None
+            if start + count < num_entries and entries[start + count].name.startswith(prefix):
+                return None
+            return count, sha
+
+        def build(directory, start):
+            prefix = directory + "/" if directory else ""
+            nodes = []
+            i = start
+            while i < num_entries:
+                e = entries[i]
+                if not e.name.startswith(prefix):
+                    break
+                name, is_subtree, _ = e.name[len(prefix):].partition("/")
+                if not is_subtree:
+                    nodes.append(TreeNode(f"{(e.mode_type << 12) | e.mode_perms:o}", name, e.sha))
+                    i += 1
+                    continue
+
+                subtree = prefix + name
+                cached = cached_sha(subtree, i)
+                if cached is not None:
+                    sha = cached[1]
+                    i += cached[0]
+                else:
+                    sha, i = build(subtree, i)
+                nodes.append(TreeNode(TREE_MODE, name, sha))
+
+            tree = GitTree()
+            tree.data = nodes
+            sha = self._write_object(tree) if write else self._hash_object(tree)[0]
+            trees[directory] = (sha, nodes)
+            if write:
+                cache_tree[directory] = (i - start, sha)
+            return sha, i
+
+        cached = cached_sha("", 0)
+        if cached is not None:
+            trees[""] = (cached[1], self._read_object(cached[1]).data)
+        else:
+            build("", 0)
 
+        if write:
+            # every directory that still exists got revalidated by the walk; the invalid ones left are gone
+            for directory in [d for d, (count, _) in cache_tree.items() if count < 0]:
+                del cache_tree[directory]
+        return trees
+
+    @in_session
+    def write_tree(self):
+        """
+        Writes the trees of the index and returns the sha of the root tree. Only the directories whose entries changed
+        since the last write are rehashed; the others come out of the index's cached tree.
+        """
+        return self._write_tree(self._get_index())
+
+    def _write_tree(self, index):
+        entries = [e for e in index if not e.flag_stage]
+        if len(entries) != len(index):
+            raise Exception("Cannot write a tree from an index with unmerged entries.")
+
+        trees = self._build_index_trees(entries, index.cache_tree, write=True)
+        self._write_index(index)
+        return trees[""][0]
+
+    @in_session
     def checkout(self, commit, working_dir_path):
         """
         Updates working directory with information inside the commit
 
         commit: sha-1 hash
         working_dir: path to an EMPTY directory 
+
+        The trees are read first, to plan every folder and file; folders are created parents first, then the blobs are
+        streamed into their files in batches (from a thread pool, when on disk). The index is replaced by one holding
+        the stat data of the files just written, with the commit's trees as its cached trees.
         """
 
         """
@@ -207,31 +1158,451 @@ class Git():
         commit_obj = self._read_object(commit)
         if commit_obj.fmt != "commit":
             raise Exception(f"The chosen git object is not a commit; it is a {commit_obj.fmt}. Please choose a git object that is a commit.")
-        
-        working_dir = self.db.get(working_dir_path)
-        if (not isinstance(working_dir, dict)) or (working_dir):
+
+        if not self.db.is_folder(working_dir_path) or self.db.list(working_dir_path):
             raise Exception(f"The working directory located at {working_dir_path} is not empty.")
-        
-        tree_obj = self._read_object(commit_obj.data["tree"][0])
-        traversal_queue = []
-        traversal_queue.extend(tree_obj.data)
-
-        # needs to be DFS, otherwise there might not be a folder to add to
-        while traversal_queue:
-            curr_node = traversal_queue.pop()
-            obj = self._read_object(curr_node.sha)
-            dest = os.path.join(working_dir_path, curr_node.path)
-
-            if obj.fmt == "tree":
-                self.db.set(dest, None)
-                traversal_queue.extend(obj.data)
+
+        folders, files, cache_tree = self._plan_checkout(commit_obj.tree)
+        for folder in folders:
+            self.db.set(os.path.join(working_dir_path, folder), None)
+
+        entries = []
+        for (path, mode, sha), stat in zip(files, self._write_checkout_files(working_dir_path, files)):
+            entries.append(GitIndexEntry(
+                ctime = stat["ctime"],
+                mtime = stat["mtime"],
+                dev = stat["dev"],
+                ino = stat["ino"],
+                mode_type = int(mode, 8) >> 12,
+                mode_perms = int(mode, 8) & 0o777,
+                uid = stat["uid"],
+                gid = stat["gid"],
+                fsize = stat["fsize"],
+                sha = sha,
+                flag_assume_valid = False,
+                flag_stage = 0,
+                name = path
+            ))
+
+        index = self._get_index()
+        index.entries = entries
+        index.cache_tree = cache_tree
+        self._write_index(index)
+
+        if os.path.normpath(working_dir_path) == os.path.normpath(self.worktree):
+            # like `git checkout <commit>`, HEAD is left detached at what's now checked out
+            self.refs.write("HEAD", commit)
+
+    @in_session
+    def switch(self, commit):
+        """
+        Moves the working tree and the index from HEAD's commit to `commit` (a sha, or the name of a branch, which
+        HEAD then points to). Only the paths that differ are written, deleted or chmod'ed: subtrees with the same
+        sha on both sides are never even read.
+
+        Refuses, before touching anything, if a path it would change has changes of its own (staged or not), or if
+        an untracked file is in the way. Changes to other paths are carried over.
+        """
+        branch = None
+        if re.fullmatch(r"[0-9a-f]{40}", commit) is None:
+            branch = commit
+            commit = self.refs.resolve(f"refs/heads/{branch}")
+            if commit is None:
+                raise Exception(f"There is no branch named {branch}.")
+        target = self._read_object(commit)
+        if target.fmt != "commit":
+            raise Exception(f"The chosen git object is not a commit; it is a {target.fmt}. Please choose a git object that is a commit.")
+
+        head_sha = self._get_current_branch()
+        if not head_sha:
+            raise Exception("HEAD doesn't point to a commit yet: use `checkout` into an empty directory instead.")
+        head_tree = self._read_object(head_sha).tree
+
+        index = self._get_index()
+        changes = list(self._diff_trees(head_tree, target.tree))
+        self._refuse_local_changes(index, changes, "switching")
+        self._apply_tree_changes(index, changes)
+        self._write_index(index)
+        self.refs.write("HEAD", f"ref: refs/heads/{branch}" if branch else commit)
+
+    def _refuse_local_changes(self, index, changes, action):
+        """
+        Raises if a path of `changes` ((path, HEAD's node, new node)) has changes of its own, staged or not, or if an
+        untracked file is in the way of one that HEAD doesn't have.
+        """
+        for path, old, new in changes:
+            entry = index.get(path)
+            if old is None:
+                if entry is not None or self._worktree_exists(path):
+                    raise Exception(f"{action.capitalize()} would overwrite {path}, which isn't in HEAD.")
+            elif entry is None or entry.sha != old.sha or not self._worktree_matches(entry):
+                raise Exception(f"{path} has local changes; commit or revert them before {action}.")
+
+    def _apply_tree_changes(self, index, changes):
+        """
+        Applies `changes` ((path, HEAD's node, new node) for blobs) to the working tree and to `index`, which the caller
+        writes.
+        """
+        # a file whose content stays and only gains or loses its executable bit is chmod'ed in place
+        chmods = []
+        if self.db.on_disk:
+            regular = ("100644", "100755")
+            chmods = [
+                (path, new) for path, old, new in changes
+                if old is not None and new is not None and old.sha == new.sha and old.mode in regular and new.mode in regular
+            ]
+        chmod_paths = {path for path, _ in chmods}
+
+        # deletions first (and the folders they empty): a file may make way for a folder, or the other way around
+        removed = [path for path, old, new in changes if old is not None and path not in chmod_paths]
+        for path in removed:
+            self._worktree_delete(path)
+        index.remove_many(removed)
+        for folder in sorted({f for path in removed for f in self._folders_above(path)}, reverse=True):
+            try:
+                if not self.db.list(os.path.join(self.worktree, folder)):
+                    self.db.delete(os.path.join(self.worktree, folder))
+            except Exception:
+                pass
+
+        for path, new in chmods:
+            abspath = os.path.join(self.db.main, self.worktree, path)
+            mode = os.stat(abspath).st_mode
+            # executable for whoever can read it, like a fresh 0o777 & ~umask file
+            os.chmod(abspath, mode | (mode & 0o444) >> 2 if new.mode == "100755" else mode & ~0o111)
+            entry = index.get(path)
+            stat = stat_metadata(os.lstat(abspath))
+            entry.mode_perms, entry.ctime = int(new.mode, 8) & 0o777, stat["ctime"]
+            index.invalidate(path)
+
+        to_write = []
+        for path, old, new in changes:
+            if new is None or path in chmod_paths:
+                continue
+            mode = new.mode if new.mode in ("100644", "100755", "120000", "160000") else "100644"
+            to_write.append((path, mode, new.sha))
+            for folder in self._folders_above(path):
+                self.db.set(os.path.join(self.worktree, folder), None)
+
+        for (path, mode, sha), stat in zip(to_write, self._write_checkout_files(self.worktree, to_write)):
+            index.add(GitIndexEntry(
+                ctime = stat["ctime"],
+                mtime = stat["mtime"],
+                dev = stat["dev"],
+                ino = stat["ino"],
+                mode_type = int(mode, 8) >> 12,
+                mode_perms = int(mode, 8) & 0o777,
+                uid = stat["uid"],
+                gid = stat["gid"],
+                fsize = stat["fsize"],
+                sha = sha,
+                flag_assume_valid = False,
+                flag_stage = 0,
+                name = path
+            ))
+
+    def _folders_above(self, path):
+        """
+        "a/b/c.txt" -> ["a", "a/b"]
+        """
+        parts = path.split("/")[:-1]
+        return ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+    def _worktree_exists(self, path):
+        if self.db.on_disk:
+            return os.path.lexists(os.path.join(self.db.main, self.worktree, path))
+        path = os.path.join(self.worktree, path)
+        try:
+            return self.db.is_file(path) or self.db.is_folder(path)
+        except Exception:
+            return False
+
+    def _worktree_matches(self, entry):
+        """
+        True if the working tree file of `entry` still has the content (and, on disk, the mode) the entry says.
+        """
+        abspath = os.path.join(self.db.main, self.worktree, entry.name) if self.db.on_disk else os.path.join(self.worktree, entry.name)
+        try:
+            stat = self.db.get_metadata(abspath)
+        except Exception:
+            stat = None
+        if stat is not None and self._stat_matches(entry, stat):
+            return True
+        if not self._worktree_exists(entry.name):
+            return False
+        if stat is not None and (stat["mode_type"], stat["mode_perms"]) != (entry.mode_type, entry.mode_perms) and self.db.on_disk:
+            return False
+        return self._hash_worktree_file(abspath) == entry.sha
+
+    def _worktree_delete(self, path):
+        folder = os.path.join(self.worktree, path)
+        if self.db.on_disk and os.path.islink(os.path.join(self.db.main, folder)):
+            os.unlink(os.path.join(self.db.main, folder))
+        else:
+            self.db.delete(folder)
+
+    def diff(self, old, new, detect_renames=False, rename_threshold=50, rename_limit=1000):
+        """
+        Yields a DiffEntry for every blob that was "added", "deleted" or "modified" between `old` and `new` (tree or
+        commit shas; None is the empty tree), in path order. Subtrees with the same sha on both sides are never read.
+
+        With `detect_renames`, a deleted and an added blob that are at least `rename_threshold` percent alike are
+        paired into one "renamed" entry instead. Identical contents pair up by sha; the rest are compared through
+        fingerprints of their lines, looked up through an index of the chunks they share, never pairwise in full.
+        Past `rename_limit` candidates on either side, only identical contents are paired (like git's renameLimit).
+        """
+        old_tree, new_tree = self._as_tree(old), self._as_tree(new)
+        entries = (
+            DiffEntry(
+                "added" if a is None else "deleted" if b is None else "modified",
+                None if a is None else TreeNode(a.mode, path, a.sha),
+                None if b is None else TreeNode(b.mode, path, b.sha),
+            )
+            for path, a, b in self._diff_trees(old_tree, new_tree)
+        )
+        if not detect_renames:
+            yield from entries
+            return
+
+        entries = list(entries)
+        renames = self._detect_renames(
+            [e.old for e in entries if e.change == "deleted"],
+            [e.new for e in entries if e.change == "added"],
+            rename_threshold, rename_limit
+        )
+        renamed_from = {old.path for old, _, _ in renames.values()}
+        for e in entries:
+            if e.change == "deleted" and e.old.path in renamed_from:
+                continue
+            if e.change == "added" and e.new.path in renames:
+                old_node, new_node, similarity = renames[e.new.path]
+                yield DiffEntry("renamed", old_node, new_node, similarity)
+                continue
+            yield e
+
+    def _as_tree(self, sha):
+        if sha is None:
+            return None
+        obj = self._read_object(sha)
+        if obj.fmt == "commit":
+            return obj.tree
+        if obj.fmt != "tree":
+            raise Exception(f"{sha} is a {obj.fmt}, not a tree or a commit.")
+        return sha
+
+    def _detect_renames(self, deleted, added, threshold, limit):
+        """
+        Pairs deleted nodes with added ones. Returns {new path: (old node, new node, similarity)}.
+        """
+        renames = {}
+
+        # identical contents first: no need to read anything
+        by_sha = {}
+        for node in deleted:
+            by_sha.setdefault(node.sha, []).append(node)
+        # every empty file is identical to every other one, which says nothing about where it came from
+        empty = by_sha.pop(EMPTY_BLOB_SHA, [])
+        unmatched_added = []
+        for node in added:
+            candidates = by_sha.get(node.sha)
+            if candidates:
+                renames[node.path] = (candidates.pop(0), node, 100)
             else:
-                self.db.set(dest, obj.data.decode(), no_encoding=True)
+                unmatched_added.append(node)
+        unmatched_deleted = [node for nodes in by_sha.values() for node in nodes] + empty
+
+        if not unmatched_added or not unmatched_deleted or max(len(unmatched_added), len(unmatched_deleted)) > limit:
+            return renames
+
+        # chunk hash -> [(index of a deleted blob, bytes of it in chunks with that hash)]
+        sources = []
+        shared_chunks = {}
+        for i, node in enumerate(unmatched_deleted):
+            content = self._read_object(node.sha).data
+            sources.append(len(content))
+            for chunk_hash, count in fingerprint(content).items():
+                shared_chunks.setdefault(chunk_hash, []).append((i, count))
+
+        scored = []
+        for node in unmatched_added:
+            content = self._read_object(node.sha).data
+            common = {}
+            for chunk_hash, count in fingerprint(content).items():
+                for i, source_count in shared_chunks.get(chunk_hash, ()):
+                    common[i] = common.get(i, 0) + min(count, source_count)
+            for i, shared in common.items():
+                similarity = shared * 100 // max(sources[i], len(content), 1)
+                if similarity >= threshold:
+                    scored.append((similarity, node.path, i, node))
+
+        # best pairs first, each side used at most once
+        used = set()
+        for similarity, path, i, node in sorted(scored, key=lambda s: (-s[0], s[1], s[2])):
+            if path in renames or i in used:
+                continue
+            used.add(i)
+            renames[path] = (unmatched_deleted[i], node, similarity)
+        return renames
+
+    def _diff_trees(self, old_tree, new_tree, prefix="", trees=None):
+        """
+        Yields (path, old TreeNode or None, new TreeNode or None) for every blob that differs between two trees, in
+        path order. Subtrees with the same sha are skipped without being read.
+
+        `trees` ({sha: [TreeNode]}) holds trees that were hashed but never written, like the index's: they are looked
+        up there before the object store.
+        """
+        if old_tree == new_tree:
+            return
+        old_entries = set() if old_tree is None else set(self._read_tree(old_tree, trees).entry_bytes())
+        new_entries = set() if new_tree is None else set(self._read_tree(new_tree, trees).entry_bytes())
+
+        # an entry both trees hold (same name, mode and sha) is unchanged: only the others are parsed
+        old_nodes = {n.path: n for _, n in map(read_tree_node, old_entries - new_entries)}
+        new_nodes = {n.path: n for _, n in map(read_tree_node, new_entries - old_entries)}
+
+        for name in sorted(old_nodes.keys() | new_nodes.keys()):
+            old, new = old_nodes.get(name), new_nodes.get(name)
+            yield from self._diff_nodes(os.path.join(prefix, name), old, new, trees)
 
+    def _diff_nodes(self, path, old, new, trees=None):
+        """
+        Like `_diff_trees`, for two nodes (blobs, trees or None) at `path`.
+        """
+        old_is_tree = old is not None and is_tree_mode(old.mode)
+        new_is_tree = new is not None and is_tree_mode(new.mode)
+        if old_is_tree or new_is_tree:
+            if old is not None and not old_is_tree:
+                yield path, old, None
+            yield from self._diff_trees(old.sha if old_is_tree else None, new.sha if new_is_tree else None, path, trees)
+            if new is not None and not new_is_tree:
+                yield path, None, new
+        else:
+            yield path, old, new
+
+    def _read_tree(self, sha, trees=None):
+        """
+        Returns the CompactTree of the tree `sha`, from `trees` ({sha: [TreeNode]}) if it's there.
+        """
+        nodes = trees.get(sha) if trees else None
+        if nodes is not None:
+            tree = GitTree()
+            tree.data = nodes
+            return CompactTree(tree.serialize())
+        tree = self._read_object(sha)
+        # a tree built in this session may still hold TreeNodes
+        return tree.data if isinstance(tree.data, CompactTree) else CompactTree(tree.serialize())
+
+    def _plan_checkout(self, tree_sha):
+        """
+        Reads every tree under `tree_sha`, breadth first, without touching a single blob.
+
+        Returns (folders, parents first; files as (path, mode, sha), in index order; the cached trees for the index).
+        """
+        folders = []
+        files = []
+        trees = {"": tree_sha}
+        unexpected = set()
+        level = [("", tree_sha)]
+        while level:
+            next_level = []
+            for folder, sha in level:
+                tree = self._read_object(sha)
+                if tree.fmt != "tree":
+                    # the parent said "tree", but it's a blob: a file after all
+                    del trees[folder]
+                    folders.remove(folder)
+                    files.append((folder, "100644", sha))
+                    unexpected.add(folder.rpartition("/")[0])
+                    continue
+
+                for node in tree.data:
+                    path = os.path.join(folder, node.path)
+                    if is_tree_mode(node.mode):
+                        folders.append(path)
+                        trees[path] = node.sha
+                        next_level.append((path, node.sha))
+                    elif node.mode == "160000":
+                        # a submodule: git leaves an empty folder for it
+                        folders.append(path)
+                        files.append((path, node.mode, node.sha))
+                    else:
+                        # git only knows regular, executable and symlink blobs
+                        mode = node.mode if node.mode in ("100644", "100755", "120000") else "100644"
+                        if mode != node.mode:
+                            unexpected.add(folder)
+                        files.append((path, mode, node.sha))
+            level = next_level
+
+        files.sort(key=lambda f: f[0])
+
+        counts = dict.fromkeys(trees, 0)
+        for path, _, _ in files:
+            folder = path
+            while folder:
+                folder = folder.rpartition("/")[0]
+                counts[folder] += 1
+
+        # a tree is only a valid cached tree if the index entries under it rebuild it exactly; a mode that had to be
+        # fixed up on the way changes the tree above it, and every tree above that
+        cache_tree = {folder: (counts[folder], sha) for folder, sha in trees.items()}
+        for folder in unexpected:
+            while True:
+                # kept as invalid (like `GitIndex.invalidate` does), so its valid subtrees still hang off it
+                cache_tree[folder] = (-1, None)
+                if not folder:
+                    break
+                folder = folder.rpartition("/")[0]
+        return folders, files, cache_tree
+
+    def _write_checkout_files(self, working_dir_path, files, batch_size=64):
+        """
+        Writes the blob of every (path, mode, sha) in `files` under `working_dir_path`, and returns their stat data
+        in the same order.
+        """
+        if not self.db.on_disk:
+            stats = []
+            for path, mode, sha in files:
+                dest = os.path.join(working_dir_path, path)
+                if mode != "160000":
+                    self.db.set(dest, self._read_object(sha).data, overwrite=True)
+                try:
+                    stats.append(self.db.get_metadata(self.db.abspath(dest)))
+                except Exception:
+                    # no stat data to be had: a size of 0 marks the entry as never to be trusted (see `_stat_matches`)
+                    stats.append(dict(ctime=(0, 0), mtime=(0, 0), dev=0, ino=0, uid=0, gid=0, fsize=0))
+            return stats
+
+        root = os.path.join(self.db.main, working_dir_path)
+
+        def write_batch(batch):
+            stats = []
+            for path, mode, sha in batch:
+                dest = os.path.join(root, path)
+                if mode == "120000":
+                    target = b"".join(self._open_object(sha)[2])
+                    os.symlink(target, dest)
+                elif mode != "160000":
+                    # raw bytes, streamed straight from the object into the file
+                    fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o777 if mode == "100755" else 0o666)
+                    with os.fdopen(fd, "wb") as f:
+                        for chunk in self._open_object(sha, chunk_size=HASH_CHUNK_SIZE)[2]:
+                            f.write(chunk)
+                stats.append(stat_metadata(os.lstat(dest)))
+            return stats
+
+        batches = [files[i:(i + batch_size)] for i in range(0, len(files), batch_size)]
+        if len(batches) == 1:
+            return write_batch(batches[0])
+
+        with ThreadPoolExecutor(max_workers=min(32, 4 * (os.cpu_count() or 1))) as executor:
+            return [stat for stats in executor.map(write_batch, batches) for stat in stats]
+
+    @in_session
     def create_ref(self, path, name, sha):
-        self.db.set(os.path.join(".git/refs", path), None)
-        self.db.set(os.path.join(".git/refs", path, name), sha.encode())
+        self.refs.write(os.path.join("refs", path, name), sha)
 
+    @in_session
     def create_tag(self, path, name, ref, create_tag_object=False):
         obj_sha = self._find_object(ref)
         if create_tag_object:
@@ -247,9 +1618,23 @@ class Git():
         else:
             self.create_ref(path, name, obj_sha)
 
+    @in_session
     def create_branch(self, name):
-        self.create_tag("heads", name, "main", create_tag_object=False)
+        # at HEAD's commit (`create_tag` would point it at the commit's tree)
+        head_sha = self._get_current_branch()
+        if not head_sha:
+            raise Exception("HEAD doesn't point to a commit yet.")
+        self.create_ref("heads", name, head_sha)
+
+    @in_session
+    def pack_refs(self, prune=True):
+        """
+        Moves every ref into .git/packed-refs, like `git pack-refs --all`: listing them is then one file read. With
+        `prune`, the loose refs are deleted.
+        """
+        self.refs.pack(prune)
 
+    @in_session
     def show_ref(self):
         ref_data = {}
         self._get_all_references(".git/refs", ref_data)
@@ -264,23 +1649,23 @@ class Git():
         candidates = [] # accumulate object hashes
         hash_regex = re.compile(r"^[0-9A-Fa-f]{4,40}$")
         if hash_regex.match(name):
-            head = name[:2]
-            tail = name[2:]
-            obj_candidates = self.db.get(f".git/objects/{head}")
-            for t in obj_candidates.keys():
-                if t.startswith(tail):
-                    candidates.append(head + t)
+            prefix = name.lower()
+            found = set(self.loose_index.find_prefix(prefix))
+            for pack in self._get_packs():
+                found.update(pack.index.find_prefix(prefix))
+
+            if not found:
+                # another process (or stock git) may have written objects our index doesn't know about yet
+                found.update(self.loose_index.rescan(prefix))
+            candidates.extend(sorted(found))
         else:
-            try:
-                tag_candidate = self._resolve_reference(".git/refs/tags", name)
-                if tag_candidate:
-                    candidates.append(tag_candidate)
-
-                commit_candidate = self._resolve_reference(".git/refs/heads", name)
-                if commit_candidate:
-                    candidates.append(commit_candidate)
-            except:
-                pass
+            for folder in (".git/refs/tags", ".git/refs/heads"):
+                try:
+                    candidate = self._resolve_reference(folder, name)
+                except Exception:
+                    continue
+                if candidate:
+                    candidates.append(candidate)
 
         return candidates
 
@@ -294,61 +1679,559 @@ class Git():
         found_hash = hashes[0]
         found_object = self._read_object(found_hash)
         if found_object.fmt == "tag":
-            return found_object.data["object"][0]
+            return found_object.object
         if found_object.fmt == "commit":
-            return found_object.data["tree"][0]
+            return found_object.tree
         if (fmt is None) or (found_object.fmt == fmt):
             return found_hash
     
 
-    def _read_object(self, sha):
+    def _resolve_commit(self, name):
+        """
+        Returns the sha of the commit `name` (a full or abbreviated sha, a branch or a tag) refers to.
+        """
+        hashes = self._find_hashes(name)
+        if not hashes:
+            raise Exception(f"No commit associated to {name} was found.")
+        if len(hashes) > 1:
+            raise Exception(f"{name} refers to multiple hashes: {hashes}")
+
+        sha = hashes[0]
+        fmt, _ = self._read_object_header(sha)
+        if fmt == "tag":
+            sha = self._read_object(sha).object
+            fmt, _ = self._read_object_header(sha)
+        if fmt != "commit":
+            raise Exception(f"{name} is a {fmt}, not a commit.")
+        return sha
+
+    def _resolve_object(self, name):
+        """
+        Returns the sha `name` (HEAD, a full or abbreviated sha, a branch or a tag) refers to, without peeling tags.
+        """
+        hashes = [self._get_current_branch()] if name == "HEAD" else self._find_hashes(name)
+        if not hashes or not hashes[0]:
+            raise Exception(f"No object associated to {name} was found.")
+        if len(hashes) > 1:
+            raise Exception(f"{name} refers to multiple hashes: {hashes}")
+        return hashes[0]
+
+    def _commit_key(self, graph, sha):
+        # commits the graph holds are walked by position, the others (only written this session, or before the graph
+        # was) by sha
+        pos = graph.find(sha)
+        return sha if pos is None else pos
+
+    def _read_commit(self, graph, key):
+        """
+        Returns (sha, tree, [parent keys], generation, commit time) of the commit `key` from `_commit_key`. Commits in
+        the graph are read from it without touching their objects; the others only have their header parsed.
+        """
+        if isinstance(key, int):
+            tree, parents, generation, commit_time = graph.entry(key)
+            return graph.sha(key), tree, parents, generation, commit_time
+
+        commit = self._new_commits.get(key)
+        if commit is None:
+            fmt, _, body = self._open_object(key)
+            if fmt != b"commit":
+                raise Exception(f"{key} is a {fmt.decode()}, not a commit.")
+            commit = read_commit_header(b"".join(body))
+        tree, parents, commit_time = commit
+        return key, tree, [self._commit_key(graph, parent) for parent in parents], GENERATION_INFINITY, commit_time
+
+    def _open_object(self, sha, chunk_size=64 * 1024):
+        """
+        Returns (fmt, size, body) without inflating the whole object: `body` is an iterator over the decompressed 
+        content in chunks of at most `chunk_size` bytes, so a large blob can be streamed instead of loaded.
+        """
+        cached = self.object_cache.get(sha)
+        if cached is not None:
+            fmt, content, _ = cached
+            body = (content[pos:(pos + chunk_size)] for pos in range(0, len(content), chunk_size))
+            return fmt, len(content), body
+        return self._open_stored_object(sha, chunk_size)
+
+    def _open_stored_object(self, sha, chunk_size=64 * 1024):
+        """
+        Like `_open_object`, straight from the loose objects and packs: the object cache isn't looked at, so its
+        hit/miss counts only see the callers that actually asked it.
+        """
         try:
             data = self.db.get(f".git/objects/{sha[:2]}/{sha[2:]}")
         except Exception as e:
-            raise Exception(f"Object {sha} not found in database.")
-    
-        fmt_sep = data.find(b" ")
-        fmt = data[:fmt_sep] # BYTES
+            packed = self._read_packed_object(sha)
+            if packed is None:
+                # another process may have repacked since the packs were listed, moving the object into a new pack:
+                # look again before giving up, like git's reprepare_packed_git
+                packed = self._read_packed_object(sha, rescan=True)
+            if packed is None:
+                raise Exception(f"Object {sha} not found in database.")
+
+            fmt, content = packed
+            body = (content[pos:(pos + chunk_size)] for pos in range(0, len(content), chunk_size))
+            return fmt.encode(), len(content), body
+
+        chunks = iter_inflate(data, chunk_size)
+        head = b""
+        for chunk in chunks:
+            head += chunk
+            if b"\x00" in head:
+                break
+
+        size_sep = head.find(b"\x00")
+        if size_sep == -1:
+            raise Exception(f"Object {sha} has a malformed header.")
+
+        fmt_sep = head.find(b" ")
+        fmt = head[:fmt_sep] # BYTES
+        size = int(head[fmt_sep:size_sep].decode("ascii"))
+
+        def body():
+            rest = head[size_sep+1:]
+            if rest:
+                yield rest
+            yield from chunks
+
+        return fmt, size, body()
+
+    def _read_object_header(self, sha):
+        # a git header is at most ~30 bytes, so only the first few bytes of the stream are ever inflated
+        fmt, size, _ = self._open_object(sha, chunk_size=64)
+        return fmt.decode(), size
+
+    def _read_object(self, sha):
+        """
+        The returned object may be shared with other callers through the object cache: treat it as read-only.
+        """
+        cached = self.object_cache.get(sha)
+        if cached is not None:
+            return cached[2]
 
-        size_sep = data.find(b"\x00", fmt_sep)
-        size = int(data[fmt_sep:size_sep].decode("ascii"))
+        fmt, size, body = self._open_stored_object(sha)
+        content = b"".join(body)
+        if len(content) != size:
+            raise Exception(f"Object {sha} is corrupt: expected {size} bytes, found {len(content)}.")
 
-        return self.obj_mapping[fmt](data[size_sep+1:])
+        obj = self.obj_mapping[fmt](content)
+        self._cache_object(sha, fmt, content, obj)
+        return obj
 
-    def _write_object(self, obj):
+    def _cache_object(self, sha, fmt, content, obj):
+        # a single huge blob shouldn't be able to flush every tree out of the cache
+        if len(content) <= self.object_cache.max_bytes // 8:
+            self.object_cache.put(sha, (fmt, content, obj), len(content))
+
+    def _hash_object(self, obj):
+        """
+        Returns (sha, header, content) for `obj`, without writing it.
+        """
         # encoding from UNICODE --> BYTES
         fmt = obj.fmt.encode()
         content = obj.serialize()
         size = str(len(content)).encode()
 
-        data_bytes = fmt + b' ' + size + b'\x00' + content
+        header = fmt + b' ' + size + b'\x00'
 
-        sha = hashlib.sha1(data_bytes).hexdigest()
+        sha = hashlib.sha1(header)
+        sha.update(content)
+        return sha.hexdigest(), header, content
+
+    @in_session
+    def _write_object(self, obj):
+        sha, header, content = self._hash_object(obj)
+
+        # loose objects are zlib-deflated exactly like git's, so either tool can read the other's objects
+        compressor = zlib.compressobj(self.compression_level)
+        data_bytes = compressor.compress(header) + compressor.compress(content) + compressor.flush()
 
         self.db.set(f".git/objects/{sha[:2]}/", None)
         self.db.set(f".git/objects/{sha[:2]}/{sha[2:]}", data_bytes)
+        self.loose_index.add(sha)
+        if obj.fmt == "commit":
+            try:
+                self._new_commits[sha] = read_commit_header(content)
+            except Exception:
+                # a malformed commit can't go in the commit-graph; walks parse it instead
+                pass
 
         return sha
 
-    def _resolve_reference(self, path, ref):
-        ref_path = os.path.join(path, ref)
-        if self.db.is_folder(ref_path):
+    def _get_packs(self, rescan=False):
+        # with `rescan`, the pack folder is listed again; packs read already are kept as they are
+        if self._packs is None or rescan:
+            known = {pack.name: pack for pack in self._packs or []}
+            packs = []
+            try:
+                names = self.db.list(".git/objects/pack")
+            except Exception:
+                names = []
+
+            for name in names:
+                if name.startswith("pack-") and name.endswith(".idx"):
+                    pack_name = name[:-len(".idx")]
+                    if pack_name in known:
+                        packs.append(known[pack_name])
+                        continue
+                    pack_data = self.db.get(f".git/objects/pack/{pack_name}.pack")
+                    idx_data = self.db.get(f".git/objects/pack/{name}")
+                    pack = Pack(pack_name, pack_data, idx_data)
+                    if f"{pack_name}.bitmap" in names:
+                        try:
+                            pack.bitmap = PackBitmap(self.db.get(f".git/objects/pack/{pack_name}.bitmap"), pack.checksum)
+                        except Exception:
+                            # bitmaps are only a cache: without them, walks read the objects
+                            pass
+                    packs.append(pack)
+            self._packs = packs
+        return self._packs
+
+    def _get_commit_graph(self):
+        if self._commit_graph is None:
+            try:
+                chain = self.db.get(CHAIN_PATH).decode().split()
+                self._commit_graph = CommitGraph([self.db.get(f"{LAYERS_PATH}/graph-{c}.graph") for c in chain])
+            except Exception:
+                # no graph yet, or a broken one: the next layer written rebuilds it from scratch
+                self._commit_graph = CommitGraph()
+        return self._commit_graph
+
+    def _flush_commit_graph(self):
+        """
+        Writes the commits of the session into a new commit-graph layer, along with any ancestor of theirs the graph
+        doesn't hold yet (one written before the graph existed, say), since a graph must hold every parent of its
+        commits. The new layer absorbs the layers below it for as long as it is at least half as large as they are,
+        so a commit usually rewrites a small layer and the chain stays O(log n) layers long.
+        """
+        if not self._new_commits:
+            return
+        new_commits, self._new_commits = self._new_commits, {}
+
+        graph = self._get_commit_graph()
+        commits = {sha: commit for sha, commit in new_commits.items() if graph.find(sha) is None}
+        missing = [parent for _, parents, _ in commits.values() for parent in parents]
+        while missing:
+            sha = missing.pop()
+            if sha in commits or graph.find(sha) is not None:
+                continue
+            try:
+                fmt, _, body = self._open_object(sha)
+                if fmt != b"commit":
+                    raise Exception(f"{sha} is a parent of a commit, but it is a {fmt.decode()}.")
+                commits[sha] = read_commit_header(b"".join(body))
+            except Exception:
+                # history we can't read or parse can't go in the graph, and neither can anything on top of it. The graph
+                # is only a cache: walks parse these commits instead
+                return
+            missing.extend(commits[sha][1])
+        if not commits:
+            return
+
+        layers = list(graph.layers)
+        while layers and 2 * len(commits) >= layers[-1].count:
+            commits.update(graph.commits([layers.pop()]))
+        base = CommitGraph(layers)
+
+        data, checksum = write_graph_layer(commits, base)
+        self.db.set(LAYERS_PATH, None)
+        self.db.set(f"{LAYERS_PATH}/graph-{checksum}.graph", data, overwrite=True)
+        chain = [layer.checksum.hex() for layer in layers] + [checksum]
+        self.db.set(CHAIN_PATH, "".join(f"{c}\n" for c in chain).encode(), overwrite=True)
+
+        for layer in graph.layers[len(layers):]:
+            self.db.delete(f"{LAYERS_PATH}/graph-{layer.checksum.hex()}.graph")
+        self._commit_graph = CommitGraph(layers + [data])
+
+    def _read_packed_object(self, sha, rescan=False):
+        for pack in self._get_packs(rescan):
+            packed = pack.read(sha)
+            if packed is not None:
+                return packed
+        return None
+
+    def _loose_object_shas(self):
+        shas = []
+        for fanout in self.db.list(".git/objects"):
+            if re.match(r"^[0-9a-f]{2}$", fanout):
+                shas.extend(fanout + tail for tail in self.db.list(f".git/objects/{fanout}"))
+        return shas
+
+    @in_session
+    def repack(self, window=10, depth=50, ofs_delta=True, prune=True, bitmap=False):
+        """
+        Moves every object (loose or already packed) into one new packfile, storing similar objects as deltas.
+
+        With `prune`, the loose objects and the old packs are deleted afterwards. With `bitmap`, the pack gets
+        reachability bitmaps (a .bitmap) for the commits refs point to and every BITMAP_INTERVAL-th other commit, as
+        long as every object those commits reach is in it.
+        """
+        return self._repack(window, depth, ofs_delta, prune, bitmap)
+
+    @in_session
+    def gc(self, window=10, depth=50, ofs_delta=True, expire=14 * 24 * 60 * 60):
+        """
+        Repacks only the objects reachable from a ref, HEAD, MERGE_HEAD or the index into one pack with bitmaps, and
+        deletes everything else. Once there are bitmaps, finding what's reachable is mostly OR'ing the bitmaps of the
+        commits refs point to. Refs get packed too.
+
+        Like git's gc.pruneExpire, unreachable loose objects written less than `expire` seconds ago (two weeks by
+        default) are left loose: another process may be about to point a ref at them.
+        """
+        index = self._get_index()
+        tips = self._ref_tips() + [sha for count, sha in index.cache_tree.values() if count >= 0]
+        pack, bits, others = self._reachable(tips)
+        keep = others | {entry.sha for entry in index}
+        if pack is not None:
+            keep.update(pack.shas_of(bits))
+
+        cutoff = time.time() - expire
+        recent = {
+            sha for sha in self._loose_object_shas()
+            if sha not in keep and self.db.get_metadata(self.db.abspath(f".git/objects/{sha[:2]}/{sha[2:]}"))["mtime"][0] > cutoff
+        }
+
+        pack_sha = self._repack(window, depth, ofs_delta, prune=True, bitmap=True, keep=keep, leave_loose=recent)
+        self.refs.pack()
+
+        # a commit-graph must only hold commits that exist: start it over from what's left
+        graph = self._get_commit_graph()
+        commits = graph.commits()
+        if any(sha not in keep for sha in commits):
+            for layer in graph.layers:
+                self.db.delete(f"{LAYERS_PATH}/graph-{layer.checksum.hex()}.graph")
+            self.db.delete(CHAIN_PATH)
+            self._commit_graph = CommitGraph()
+            self._new_commits.update((sha, commit) for sha, commit in commits.items() if sha in keep)
+        return pack_sha
+
+    def _repack(self, window, depth, ofs_delta, prune, bitmap, keep=None, leave_loose=()):
+        objects = {}
+        old_packs = self._get_packs()
+        for pack in old_packs:
+            for sha in pack.index.shas():
+                if keep is None or sha in keep:
+                    objects[sha] = pack.read(sha)
+
+        loose_shas = self._loose_object_shas()
+        for sha in loose_shas:
+            if keep is None or sha in keep:
+                fmt, _, body = self._open_object(sha)
+                objects[sha] = (fmt.decode(), b"".join(body))
+
+        if not objects:
             return None
-        
-        data = self.db.get(ref_path).strip().decode()
-        if data.startswith("ref: "):
-            return self._resolve_reference(".git", data[5:])
-        else:
-            return data
-        
-    def _get_all_references(self, path, acc):
-        refs = self.db.get(path)
-        for ref in refs:
-            ref_path = os.path.join(path, ref)
-            if self.db.is_folder(ref_path):
-                self._get_all_references(ref_path, acc=acc)
+
+        pack_data, idx_data, pack_sha = write_pack(
+            ((sha, fmt, content) for sha, (fmt, content) in objects.items()),
+            window=window, depth=depth, ofs_delta=ofs_delta
+        )
+
+        pack_name = f"pack-{pack_sha}"
+        bitmap_data = None
+        if bitmap:
+            try:
+                bitmap_data = self._write_bitmap(Pack(pack_name, pack_data, idx_data), objects)
+            except Exception as e:
+                # history with missing (or malformed) objects can't be bitmapped; the pack is fine without. Anything
+                # else is a bug in the bitmap writer
+                if not re.search(r"not found in database|malformed|is corrupt|reaches objects outside", str(e), re.I):
+                    raise
+
+        # the .idx goes in last: a pack only becomes visible once its index exists
+        self.db.set(f".git/objects/pack/{pack_name}.pack", pack_data, overwrite=True)
+        if bitmap_data is not None:
+            self.db.set(f".git/objects/pack/{pack_name}.bitmap", bitmap_data, overwrite=True)
+        self.db.set(f".git/objects/pack/{pack_name}.idx", idx_data, overwrite=True)
+
+        if prune:
+            pack_files = self.db.list(".git/objects/pack")
+            for pack in old_packs:
+                if pack.name != pack_name:
+                    self.db.delete(f".git/objects/pack/{pack.name}.idx")
+                    self.db.delete(f".git/objects/pack/{pack.name}.pack")
+                    if f"{pack.name}.bitmap" in pack_files:
+                        self.db.delete(f".git/objects/pack/{pack.name}.bitmap")
+
+            for sha in loose_shas:
+                if sha not in leave_loose:
+                    self.db.delete(f".git/objects/{sha[:2]}/{sha[2:]}")
+            for fanout in {sha[:2] for sha in loose_shas}:
+                fanout_path = f".git/objects/{fanout}"
+                if self.db.is_folder(fanout_path) and not self.db.list(fanout_path):
+                    self.db.delete(fanout_path)
+            self.loose_index.rebuild()
+            if keep is not None:
+                # what was dropped mustn't be served from the cache either
+                self.object_cache.clear()
+
+        self._packs = None
+        return pack_sha
+
+    def _write_bitmap(self, pack, objects):
+        """
+        Returns the .bitmap of `pack`, which holds `objects` ({sha: (fmt, content)}).
+
+        Commits get their bitmap oldest first, so the walk for each one stops at the bitmaps of the commits below it
+        and only reads what changed since them.
+        """
+        commit_times = {sha: read_commit_header(content)[2] for sha, (fmt, content) in objects.items() if fmt == "commit"}
+        tips = []
+        for sha in self._ref_tips():
+            while sha in objects and objects[sha][0] == "tag":
+                sha = self._read_object(sha).object
+            if sha in commit_times:
+                tips.append(sha)
+        newest_first = sorted(commit_times, key=lambda sha: commit_times[sha], reverse=True)
+        selected = set(tips) | set(newest_first[::BITMAP_INTERVAL])
+
+        bitmaps = {}
+        for sha in sorted(selected, key=lambda sha: commit_times[sha]):
+            bits, others = self._walk_reachable([sha], pack, bitmaps)
+            if others:
+                raise Exception(f"Commit {sha} reaches objects outside the pack.")
+            bitmaps[pack.positions(sha)[0]] = bits
+
+        types = {fmt: bytearray((pack.index.count + 7) // 8) for fmt in TYPE_ORDER}
+        for sha, (fmt, _) in objects.items():
+            pos = pack.positions(sha)[1]
+            types[fmt][pos >> 3] |= 1 << (pos & 7)
+        types = {fmt: int.from_bytes(bits, "little") for fmt, bits in types.items()}
+        return write_bitmap(pack.checksum, types, list(bitmaps.items()))
+
+    def rev_list_objects(self, include, exclude=()):
+        """
+        Returns the shas of every object reachable from `include` but not from `exclude` (lists of shas, branches or
+        tags), like `git rev-list --objects include ^exclude`: what a repository that has `exclude` is missing.
+        """
+        pack, bits, others = self._reachable_difference(include, exclude)
+        shas = set(others)
+        if pack is not None:
+            shas.update(pack.shas_of(bits))
+        return shas
+
+    def count_objects(self, include, exclude=()):
+        """
+        Returns how many objects are reachable from `include` but not from `exclude`, like `rev_list_objects`, without
+        ever turning bitmaps into shas.
+        """
+        _, bits, others = self._reachable_difference(include, exclude)
+        return bits.bit_count() + len(others)
+
+    def _reachable_difference(self, include, exclude):
+        pack, bits, others = self._reachable([self._resolve_object(name) for name in include])
+        if exclude:
+            _, excluded_bits, excluded_others = self._reachable([self._resolve_object(name) for name in exclude])
+            bits &= ~excluded_bits
+            others -= excluded_others
+        return pack, bits, others
+
+    def _reachable(self, tips):
+        """
+        Returns (pack, bits, others) for the objects reachable from the shas `tips`, using the bitmaps of the first
+        pack that has some: `bits` are the positions of those in `pack` (None if no pack has bitmaps), and `others`
+        the shas of the rest.
+        """
+        pack = next((pack for pack in self._get_packs() if pack.bitmap is not None), None)
+        bits, others = self._walk_reachable(tips, pack, pack.bitmap if pack is not None else {})
+        return pack, bits, others
+
+    def _walk_reachable(self, tips, pack, bitmaps):
+        """
+        Returns (bits, others) for the objects reachable from the shas `tips`: `bits` has the positions (in pack order)
+        of those in `pack` set, and `others` holds the shas of the rest.
+
+        A commit with one of `bitmaps` ({position in the index: bits}) isn't walked: its bitmap is OR'ed in instead.
+        Commits come off a heap newest first, so the bitmaps usually land before the commits below them are popped,
+        and only the trees of the commits actually walked are read, skipping any tree marked already (along with
+        everything under it). Parents come from the commit-graph; blobs are never read.
+        """
+        graph = self._get_commit_graph()
+        seen = bytearray((pack.index.count + 7) // 8 if pack is not None else 0)
+        others = set()
+
+        def mark(sha):
+            # False if `sha` was marked already
+            found = pack.positions(sha) if pack is not None else None
+            if found is None:
+                if sha in others:
+                    return False
+                others.add(sha)
+                return True
+            byte, bit = found[1] >> 3, 1 << (found[1] & 7)
+            if seen[byte] & bit:
+                return False
+            seen[byte] |= bit
+            return True
+
+        heap = []
+        order = itertools.count()
+        queued = set()
+        def push(key):
+            if key not in queued:
+                queued.add(key)
+                sha, tree, parents, _, commit_time = self._read_commit(graph, key)
+                heapq.heappush(heap, (-commit_time, next(order), sha, tree, parents))
+
+        trees = []
+        for sha in tips:
+            fmt = "commit" if graph.find(sha) is not None else self._read_object_header(sha)[0]
+            while fmt == "tag":
+                mark(sha)
+                sha = self._read_object(sha).object
+                fmt = self._read_object_header(sha)[0]
+            if fmt == "commit":
+                push(self._commit_key(graph, sha))
+            elif fmt == "tree":
+                trees.append(sha)
             else:
-                acc[ref_path] = self._resolve_reference(path, ref)
+                mark(sha)
+
+        while heap:
+            _, _, sha, tree, parents = heapq.heappop(heap)
+            found = pack.positions(sha) if pack is not None else None
+            bitmap = bitmaps.get(found[0]) if found is not None else None
+            if bitmap is not None:
+                seen[:] = (int.from_bytes(seen, "little") | bitmap).to_bytes(len(seen), "little")
+                continue
+            if not mark(sha):
+                continue
+            trees.append(tree)
+            for parent in parents:
+                push(parent)
+
+        while trees:
+            sha = trees.pop()
+            if not mark(sha):
+                continue
+            for mode, _, entry_sha in self._read_tree(sha).entries():
+                if mode.startswith(b"4") or mode.startswith(b"04"):
+                    trees.append(entry_sha.hex())
+                elif not mode.startswith(b"16"):
+                    # a submodule's commit lives in another repository
+                    mark(entry_sha.hex())
+
+        return int.from_bytes(seen, "little"), others
+
+    def _ref_tips(self):
+        """
+        The shas refs, HEAD and MERGE_HEAD point to.
+        """
+        refs = {}
+        try:
+            self._get_all_references(".git/refs", refs)
+        except Exception:
+            pass
+        tips = list(refs.values()) + [self._get_current_branch(), self._get_merge_head()]
+        return list(dict.fromkeys(sha for sha in tips if sha))
+
+    def _resolve_reference(self, path, ref):
+        return self.refs.resolve(os.path.relpath(os.path.join(path, ref), ".git"))
+
+    def _get_all_references(self, path, acc):
+        prefix = os.path.relpath(path, ".git")
+        for name, value in self.refs.all().items():
+            if name.startswith(prefix + "/"):
+                acc[os.path.join(".git", name)] = self.refs.resolve(name) if value.startswith("ref: ") else value
 
     def _get_current_branch(self):
         try:
@@ -359,14 +2242,286 @@ class Git():
         
 
 
+class LooseObjectIndex():
+    """
+    A persistent, sorted list of the SHAs of every loose object, so that abbreviated hashes resolve by bisection
+    instead of listing (or worse, reading) a whole fan-out folder.
+
+    On disk it is split in two, so that a session only rewrites what it added:
+        .git/objects/info/loose-index      BASE: "TLIX", VERSION (4 bytes), then sorted 20-byte SHAs
+        .git/objects/info/loose-index-new  SHAs added since the base was last written, same layout
+
+    The recent part is folded into the base once it grows past an eighth of it.
+    """
+    base_path = ".git/objects/info/loose-index"
+    recent_path = ".git/objects/info/loose-index-new"
+
+    def __init__(self, git):
+        self.git = git
+        self.reset()
+
+    def reset(self):
+        self._shas = None # sorted 20-byte SHAs, base and recent together
+        self._pending = set() # SHAs added since `_shas` was last merged
+        self._recent = [] # SHAs missing from the base file; None means the base itself must be rewritten
+        self._dirty = False
+
+    def _parse(self, data):
+        if data[:4] != b"TLIX":
+            raise Exception("Not a loose object index: bad signature.")
+        version = struct.unpack_from(">I", data, 4)[0]
+        if version != 1:
+            raise Exception(f"tig only supports loose object index version 1. This index is version {version}.")
+        return [data[pos:(pos + 20)] for pos in range(8, len(data), 20)]
+
+    def _serialize(self, shas):
+        return b"TLIX" + struct.pack(">I", 1) + b"".join(shas)
+
+    def _load(self):
+        if self._shas is not None:
+            return self._shas
+
+        try:
+            self._shas = self._parse(self.git.db.get(self.base_path))
+        except Exception:
+            self.rebuild()
+            return self._shas
+
+        try:
+            recent = self._parse(self.git.db.get(self.recent_path))
+        except Exception:
+            recent = []
+        self._pending = {sha for sha in recent if not self._contains(sha)}
+        self._merge()
+        self._recent = recent
+        return self._shas
+
+    def _contains(self, sha_bytes):
+        if sha_bytes in self._pending:
+            return True
+        i = bisect.bisect_left(self._shas, sha_bytes)
+        return i < len(self._shas) and self._shas[i] == sha_bytes
+
+    def _merge(self):
+        # one linear pass over two sorted runs, rather than an O(n) list insert per added sha
+        if self._pending:
+            self._shas = list(heapq.merge(self._shas, sorted(self._pending)))
+            self._pending = set()
+        return self._shas
+
+    def rebuild(self):
+        self._shas = sorted(bytes.fromhex(sha) for sha in self.git._loose_object_shas())
+        self._pending = set()
+        self._recent = None
+        self._dirty = True
+
+    def add(self, sha):
+        self._load()
+        sha_bytes = bytes.fromhex(sha)
+        if not self._contains(sha_bytes):
+            self._pending.add(sha_bytes)
+            if self._recent is not None:
+                self._recent.append(sha_bytes)
+            self._dirty = True
+
+    def find_prefix(self, prefix):
+        self._load()
+        shas = self._merge()
+        lo = bisect.bisect_left(shas, bytes.fromhex(prefix.ljust(40, "0")))
+        hi = bisect.bisect_right(shas, bytes.fromhex(prefix.ljust(40, "f")))
+        return [sha.hex() for sha in shas[lo:hi]]
+
+    def rescan(self, prefix):
+        """
+        Lists the fan-out folder for `prefix` and indexes whatever it finds there.
+        """
+        try:
+            tails = self.git.db.list(f".git/objects/{prefix[:2]}")
+        except Exception:
+            return []
+
+        found = [prefix[:2] + tail for tail in tails if (prefix[:2] + tail).startswith(prefix)]
+        for sha in found:
+            self.add(sha)
+        return found
+
+    def flush(self):
+        if not self._dirty:
+            return
+
+        self._merge()
+        db = self.git.db
+        db.set(".git/objects/info", None)
+        if self._recent is None or len(self._recent) > max(1024, len(self._shas) // 8):
+            db.set(self.base_path, self._serialize(self._shas), overwrite=True)
+            db.delete(self.recent_path)
+            self._recent = []
+        else:
+            db.set(self.recent_path, self._serialize(sorted(self._recent)), overwrite=True)
+        self._dirty = False
+
+
+class RefStore():
+    """
+    Refs are loose (a file under .git holding a sha, or "ref: <another ref>") or packed: .git/packed-refs holds many
+    of them in one file sorted by name, as `git pack-refs` writes it:
+        # pack-refs with: sorted
+        <sha> refs/heads/main
+        <sha> refs/tags/v1.0
+        ^<sha the tag above peels to> (git writes these; tig leaves them out and ignores them)
+    A loose ref overrides the packed one with the same name.
+
+    What was read is kept in memory for as long as the stat data (mtime, inode, size) of its file doesn't change, so
+    following HEAD to its branch or listing every ref reads each file once.
+    """
+    packed_path = ".git/packed-refs"
+
+    def __init__(self, git):
+        self.git = git
+        self.reset()
+
+    def reset(self):
+        self._files = {} # path -> (stat data, parsed content)
+
+    def _stat(self, path):
+        try:
+            stat = self.git.db.get_metadata(self.git.db.abspath(path))
+        except Exception:
+            # no stat data (or no file): never cached
+            return None
+        return tuple(stat["mtime"]), stat.get("ino"), stat.get("fsize")
+
+    def _get(self, path, parse):
+        """
+        Returns `parse` of the content of the file `path`, or None if there's no such file.
+        """
+        stat = self._stat(path)
+        cached = self._files.get(path)
+        if stat is not None and cached is not None and cached[0] == stat:
+            return cached[1]
+
+        try:
+            parsed = None if self.git.db.is_folder(path) else parse(self.git.db.get(path))
+        except Exception:
+            parsed = None
+
+        if stat is not None and parsed is not None and time.time() - stat[0][0] - stat[0][1] / 1e9 > REF_CACHE_RACY_SECONDS:
+            self._files[path] = (stat, parsed)
+        else:
+            self._files.pop(path, None)
+        return parsed
+
+    def _parse_packed(self, data):
+        refs = {}
+        for line in data.decode().split("\n"):
+            if line and line[0] not in "#^":
+                sha, _, name = line.partition(" ")
+                refs[name] = sha
+        return refs
+
+    def packed(self):
+        return self._get(self.packed_path, self._parse_packed) or {}
+
+    def read(self, name):
+        """
+        Returns what the ref `name` (like "HEAD" or "refs/heads/main") holds: a sha, "ref: <another ref>", or None.
+        """
+        value = self._get(f".git/{name}", lambda data: data.decode().strip())
+        return value if value is not None else self.packed().get(name)
+
+    def resolve(self, name):
+        """
+        Returns the sha `name` leads to through symbolic refs, or None if a ref on the way doesn't exist.
+        """
+        chain = [name]
+        value = self.read(name)
+        while value is not None and value.startswith("ref: "):
+            name = value[5:]
+            if name in chain:
+                raise Exception(f"Symbolic refs go round in circles: {' -> '.join(chain + [name])}")
+            chain.append(name)
+            if len(chain) > MAX_SYMREF_DEPTH + 1:
+                raise Exception(f"Symbolic refs go more than {MAX_SYMREF_DEPTH} levels deep: {' -> '.join(chain)}")
+            value = self.read(name)
+        return value
+
+    def all(self):
+        """
+        Returns {name: value} for every ref under refs/, sorted by name.
+        """
+        db = self.git.db
+        refs = dict(self.packed())
+        folders = ["refs"]
+        while folders:
+            folder = folders.pop()
+            try:
+                names = db.list(f".git/{folder}")
+            except Exception:
+                continue
+            for name in names:
+                name = f"{folder}/{name}"
+                if db.is_folder(f".git/{name}"):
+                    folders.append(name)
+                else:
+                    value = self._get(f".git/{name}", lambda data: data.decode().strip())
+                    if value is not None:
+                        refs[name] = value
+        return dict(sorted(refs.items()))
+
+    def write(self, name, value):
+        folder = ".git"
+        for part in os.path.dirname(name).split("/"):
+            if part:
+                folder = f"{folder}/{part}"
+                self.git.db.set(folder, None)
+        self.git.db.set(f".git/{name}", value.encode(), overwrite=True)
+        self._files.pop(f".git/{name}", None)
+
+    def pack(self, prune=True):
+        refs = {name: value for name, value in self.all().items() if not value.startswith("ref: ")}
+        lines = "".join(f"{sha} {name}\n" for name, sha in sorted(refs.items(), key=lambda ref: ref[0].encode()))
+        self.git.db.set(self.packed_path, f"# pack-refs with: sorted \n{lines}".encode(), overwrite=True)
+        self._files.pop(self.packed_path, None)
+        if not prune:
+            return
+
+        db = self.git.db
+        folders = set()
+        for name in refs:
+            if db.is_file(f".git/{name}"):
+                db.delete(f".git/{name}")
+                self._files.pop(f".git/{name}", None)
+                folders.add(os.path.dirname(name))
+        # like git, refs/heads and refs/tags stay even when empty
+        for folder in sorted(folders, key=lambda folder: -folder.count("/")):
+            while folder not in ("refs", "refs/heads", "refs/tags") and db.is_folder(f".git/{folder}") and not db.list(f".git/{folder}"):
+                db.delete(f".git/{folder}")
+                folder = os.path.dirname(folder)
+
+
 class GitObject():
-    def __init__(self, data=None):
-        # FIXME
-        # actually i don't like this because it doesn't make it explicit what is happening when you initialize the data
-        # it might be annoying, but at least it's explicit when you call deserialize that you're setting self.data to something
+    """
+    Objects keep the raw content they were read from (a memoryview, so nothing is copied) and only parse it the first
+    time `data` is asked for. Objects are shared through the object cache: treat what they hold as read-only.
+    """
+    __slots__ = ("_raw", "_data")
 
-        # like, why even have the deserialize be public if the user is never goign to call it anyway..? 
-        self.data = self.deserialize(data)
+    def __init__(self, data=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._raw = None if data is None else memoryview(data)
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.deserialize(None if self._raw is None else bytes(self._raw))
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._raw = None
 
     def serialize(self):
         raise Exception("Not implemented")
@@ -376,30 +2531,89 @@ class GitObject():
 
 
 class GitCommit(GitObject):
+    """
+    `tree`, `parents` and `message` only parse the header (or the message), never the whole object.
+    """
+    __slots__ = ("_header", "_message_start")
+    fmt = "commit"
+
     def __init__(self, data=None):
         super().__init__(data)
-        self.fmt = "commit"
+        self._header = None
+
+    @GitObject.data.setter
+    def data(self, data):
+        GitObject.data.fset(self, data)
+        self._header = None
 
     def serialize(self):
+        if self._data is None and self._raw is not None:
+            return bytes(self._raw)
         return kvlm_write(self.data)
 
     def deserialize(self, data):
         if data is None:
             return {}
         return kvlm_read(data)
-    
+
+    def _values(self, key):
+        if self._data is not None or self._raw is None:
+            # built (or already parsed) from a dict, whose values may be lists or not
+            values = self.data.get(key, [])
+            return values if isinstance(values, list) else [values]
+        if self._header is None:
+            self._header, self._message_start = read_kvlm_header(self._raw)
+        return self._header.get(key, [])
+
+    def _tree_and_parents(self):
+        # git always starts a commit with these, so they can be picked off the front without reading the rest
+        if self._data is None and self._raw is not None:
+            found = COMMIT_START.match(self._raw)
+            if found:
+                parents = found.group(2)
+                return found.group(1).decode(), [parents[pos + 7:pos + 47].decode() for pos in range(0, len(parents), 48)]
+        values = self._values("tree")
+        return values[0] if values else None, self._values("parent")
+
+    @property
+    def tree(self):
+        return self._tree_and_parents()[0]
+
+    @property
+    def parents(self):
+        return self._tree_and_parents()[1]
+
+    @property
+    def message(self):
+        # without the newline git ends messages with; `data[None]` keeps it
+        if self._data is not None or self._raw is None:
+            message = self.data.get(None, "")
+        else:
+            if self._header is None:
+                self._header, self._message_start = read_kvlm_header(self._raw)
+            message = bytes(self._raw[self._message_start:]).decode("utf-8")
+        return message[:-1] if message.endswith("\n") else message
+
+
 class GitTree(GitObject):
-    def __init__(self, data=None):
-        super().__init__(data)
-        self.fmt = "tree"
+    """
+    Read trees are CompactTrees. `data` can also be set to a list of TreeNodes, in any order.
+    """
+    __slots__ = ()
+    fmt = "tree"
 
     def serialize(self):
+        if self._data is None and self._raw is not None:
+            return bytes(self._raw)
+        if isinstance(self._data, CompactTree):
+            return self._data.serialize()
         ordered_tree = sorted(self.data, key=tree_order_fn)
         flattened_tree = []
         for node in ordered_tree:
-            mode_str = node.mode.encode()
+            # git writes tree modes without the leading zero
+            mode_str = node.mode.lstrip("0").encode()
             path_str = node.path.encode()
-            sha_str = int(node.sha, 16).to_bytes(20, byteorder="big")
+            sha_str = bytes.fromhex(node.sha)
             byte_str = mode_str + b' ' + path_str + b'\x00' + sha_str
             flattened_tree.append(byte_str)
 
@@ -409,20 +2623,31 @@ class GitTree(GitObject):
     def deserialize(self, data):
         if data is None:
             return []
-        return read_tree(data)
+        return CompactTree(data)
 
 class GitTag(GitCommit):
-    def __init__(self, data=None):
-        super().__init__(data)
-        self.fmt = "tag"
+    """
+    `object` is what the tag points to.
+    """
+    __slots__ = ()
+    fmt = "tag"
+
+    @property
+    def object(self):
+        values = self._values("object")
+        return values[0] if values else None
 
 class GitBlob(GitObject):
+    __slots__ = ()
+    fmt = "blob"
+
     def __init__(self, data):
-        super().__init__(data)
-        self.fmt = "blob"
+        super().__init__()
+        # a blob is its content: nothing to parse
+        self._data = data
 
     def serialize(self):
-        return self.data.encode()
+        return self.data if isinstance(self.data, bytes) else self.data.encode()
 
     def deserialize(self, data):
         return data
@@ -439,11 +2664,23 @@ class GitIndexEntry():
     EXTENSIONS
 
     HASH CHECKSUM
+
+    From version 3 on, an entry with the 'extended' flag carries 16 more bits of flags (skip-worktree, intent-to-add).
+    In version 4, entries aren't padded and each name is stored as the number of bytes to drop from the end of the
+    previous name, followed by the NUL-terminated suffix to append to what's left.
     """
+    __slots__ = ("ctime", "mtime", "dev", "ino", "mode_type", "mode_perms", "uid", "gid", "fsize", "sha",
+                 "flag_assume_valid", "flag_stage", "name", "extended_flags")
+
+    @property
+    def stage(self):
+        # `flag_stage` holds the stage bits in place (0x1000, 0x2000, 0x3000)
+        return (self.flag_stage or 0) >> 12
+
     def __init__(self, 
                  ctime=None, mtime=None, dev=None, ino=None, mode_type=None, 
                  mode_perms=None, uid=None, gid=None, fsize=None, sha=None, 
-                 flag_assume_valid=None, flag_stage=None, name=None):
+                 flag_assume_valid=None, flag_stage=None, name=None, extended_flags=0):
         self.ctime = ctime
         self.mtime = mtime
         self.dev = dev 
@@ -457,169 +2694,317 @@ class GitIndexEntry():
         self.flag_assume_valid = flag_assume_valid
         self.flag_stage = flag_stage
         self.name = name
+        self.extended_flags = extended_flags
 
-    def write(self):
-        entry = b""
-        entry += self.ctime[0].to_bytes(4, "big")
-        entry += self.ctime[1].to_bytes(4, "big")
-        entry += self.mtime[0].to_bytes(4, "big")
-        entry += self.mtime[1].to_bytes(4, "big")
-        entry += self.dev.to_bytes(4, "big")
-        entry += self.ino.to_bytes(4, "big")
-
-        mode = (self.mode_type << 12) | self.mode_perms
-        entry += mode.to_bytes(4, "big")
-        entry += self.uid.to_bytes(4, "big")
-        entry += self.gid.to_bytes(4, "big")
-        entry += self.fsize.to_bytes(4, "big")
-        entry += int(self.sha, 16).to_bytes(20, "big")
-
-        flag_assume_valid = 0x1 << 15 if self.flag_assume_valid else 0x0 << 15
+    def write(self, version=2, previous_name=b""):
+        # like git, stat fields that don't fit in 32 bits (e.g. the size of a >4GB file) are truncated
         name_bytes = self.name.encode("utf8")
-        bytes_len = len(name_bytes)
-
-        if bytes_len >= 0xFFF:
-            name_length = 0xFFF
-        else:
-            name_length = bytes_len
-
-        entry += (flag_assume_valid | self.flag_stage | name_length).to_bytes(2, "big")
-        entry += name_bytes
-        entry += ((0).to_bytes(1, "big"))
-
-        if 62 + len(name_bytes) + 1 % 8 != 0:
-            pad = 8 - ((62 + len(name_bytes) + 1) % 8)
-            entry += ((0).to_bytes(pad, "big"))
-
-        return entry
+        flags = (0x8000 if self.flag_assume_valid else 0) | (0x4000 if self.extended_flags else 0) | self.flag_stage | min(len(name_bytes), 0xFFF)
+        fields = INDEX_ENTRY.pack(
+            self.ctime[0] & 0xFFFFFFFF, self.ctime[1],
+            self.mtime[0] & 0xFFFFFFFF, self.mtime[1],
+            self.dev & 0xFFFFFFFF, self.ino & 0xFFFFFFFF,
+            (self.mode_type << 12) | self.mode_perms,
+            self.uid & 0xFFFFFFFF, self.gid & 0xFFFFFFFF, self.fsize & 0xFFFFFFFF,
+            bytes.fromhex(self.sha), flags
+        )
+        if self.extended_flags:
+            fields += struct.pack(">H", self.extended_flags)
+
+        if version == 4:
+            common = len(os.path.commonprefix((previous_name, name_bytes)))
+            return b"".join((fields, encode_offset(len(previous_name) - common), name_bytes[common:], b"\x00"))
+
+        # 1-8 NUL bytes: terminate the name and pad the entry to a multiple of 8 bytes
+        return b"".join((fields, name_bytes, NUL_PADDING[8 - (len(fields) + len(name_bytes)) % 8]))
 
 class GitIndex():
     """
     The paths in the index should be RELATIVE paths.
 
     That way, when we do `git checkout`, git can just place the files into the working directory that we specify.
+
+    Entries are keyed by (name, stage), and the keys are kept sorted in the order the file format requires
+    (byte order of the name, then stage). Lookups are dict lookups, single adds and removes are a bisection, and the
+    bulk `update`/`remove_many` do one merge or one filtering pass over the whole index instead of one per path.
+
+    `cache_tree` is git's TREE extension: {directory: (entry count, tree sha)} for the directories whose tree is known
+    to be written already, with "" being the root. Changing an entry invalidates (count -1, sha None) every directory
+    on its path, so writing a tree only has to rehash the directories that changed.
     """
+    # past this many paths, one pass over the whole index beats bisecting for each of them
+    BULK_THRESHOLD = 64
+
     def __init__(self, entries=[]):
         self.entries = entries
         self.version = 2
+        self.timestamp = None # mtime of the index file this was read from
 
-    def write(self):
-        index_entry = b"DIRC"
-        index_entry += self.version.to_bytes(4, "big")
-        index_entry += len(self.entries).to_bytes(4, "big")
+    @property
+    def entries(self):
+        return [self._entries[k] for k in self._keys]
 
-        for e in self.entries:
-            index_entry += e.write()
+    @entries.setter
+    def entries(self, entries):
+        self._entries = {(e.name, e.stage): e for e in entries}
+        self._keys = sorted(self._entries)
+        self.cache_tree = {}
+        self.fsmonitor_token = None
+        self.fsmonitor_dirty = set()
 
-        return index_entry
+    def __len__(self):
+        return len(self._keys)
 
-    def read(self, data):
-        if not isinstance(data, bytes):
-            raise Exception("index data must be in bytes")
-        
-        curr_pos = 0
+    def __iter__(self):
+        return (self._entries[k] for k in self._keys)
 
-        header = data[(curr_pos):(curr_pos + 12)]
-        curr_pos += 12
+    def __contains__(self, name):
+        lo, hi = self._stages(name)
+        return lo < hi
 
-        signature = header[:4]
-        version = int.from_bytes(header[4:8], "big")
-        num_index_entries = int.from_bytes(header[8:], "big")
+    def get(self, name, stage=0):
+        return self._entries.get((name, stage))
 
-        if signature != b"DIRC":
-            raise Exception(f"Signature must be \"DIRC\". Instead, it's {signature.decode()}")
-        if version != 2:
-            raise Exception(f"tig only supports version 2. This is an index file of version {version.decode()}")
-        
+    def _stages(self, name):
+        # every stage of a name sorts between (name, 0) and (name, 3)
+        lo = bisect.bisect_left(self._keys, (name, 0))
+        hi = bisect.bisect_right(self._keys, (name, 3))
+        return lo, hi
 
-        entries = []
-        for _ in range(num_index_entries):
-            ctime_s = int.from_bytes(data[(curr_pos):(curr_pos + 4)], "big")
-            curr_pos += 4
+    def invalidate(self, name):
+        """
+        Invalidates the cached tree of every directory above `name`.
+        """
+        cache_tree = self.cache_tree
+        directory = name
+        while directory:
+            directory = directory.rpartition("/")[0]
+            if directory in cache_tree:
+                cache_tree[directory] = (-1, None)
+
+    def add(self, entry):
+        """
+        Adds `entry`, replacing the entry with the same name and stage.
+        """
+        self.invalidate(entry.name)
+        key = (entry.name, entry.stage)
+        if key not in self._entries:
+            bisect.insort(self._keys, key)
+        self._entries[key] = entry
 
-            ctime_ns = int.from_bytes(data[(curr_pos):(curr_pos + 4)], "big")
-            curr_pos += 4
+    def remove(self, name):
+        """
+        Removes every stage of `name`.
+        """
+        self.invalidate(name)
+        lo, hi = self._stages(name)
+        for key in self._keys[lo:hi]:
+            del self._entries[key]
+        del self._keys[lo:hi]
+
+    def update(self, entries):
+        new_keys = []
+        for e in entries:
+            self.invalidate(e.name)
+            key = (e.name, e.stage)
+            if key not in self._entries:
+                new_keys.append(key)
+            self._entries[key] = e
+
+        if len(new_keys) < self.BULK_THRESHOLD:
+            for key in new_keys:
+                bisect.insort(self._keys, key)
+        else:
+            self._keys = list(heapq.merge(self._keys, sorted(set(new_keys))))
+
+    def remove_many(self, names):
+        names = set(names)
+        if len(names) < self.BULK_THRESHOLD:
+            for name in names:
+                self.remove(name)
+            return
+
+        for name in names:
+            self.invalidate(name)
+
+        kept = []
+        for key in self._keys:
+            if key[0] in names:
+                del self._entries[key]
+            else:
+                kept.append(key)
+        self._keys = kept
 
-            mtime_s = int.from_bytes(data[(curr_pos):(curr_pos + 4)], "big")
-            curr_pos += 4
+    def write(self):
+        version = self.version
+        if version == 2 and any(e.extended_flags for e in self):
+            # version 2 has no room for extended flags
+            version = 3
+
+        chunks = [INDEX_HEADER.pack(b"DIRC", version, len(self._keys))]
+        previous_name = b""
+        for e in self:
+            chunks.append(e.write(version, previous_name))
+            if version == 4:
+                previous_name = e.name.encode("utf8")
+
+        if self.cache_tree:
+            tree_extension = self._write_cache_tree()
+            chunks.append(b"TREE" + struct.pack(">I", len(tree_extension)) + tree_extension)
+        if self.fsmonitor_token is not None:
+            # tig's own (optional, so git skips it): the monitor token, then the paths that were dirty as of it
+            monitor_extension = b"".join(p.encode("utf8") + b"\x00" for p in [self.fsmonitor_token, *sorted(self.fsmonitor_dirty)])
+            chunks.append(b"TGFM" + struct.pack(">I", len(monitor_extension)) + monitor_extension)
+
+        body = b"".join(chunks)
+        return body + hashlib.sha1(body).digest()
 
-            mtime_ns = int.from_bytes(data[(curr_pos):(curr_pos + 4)], "big")
-            curr_pos += 4
+    def read(self, data):
+        if not isinstance(data, bytes):
+            raise Exception("index data must be in bytes")
 
-            dev = int.from_bytes(data[(curr_pos):(curr_pos + 4)], "big")
-            curr_pos += 4
+        view = memoryview(data)
+        signature, version, num_index_entries = INDEX_HEADER.unpack_from(view, 0)
+        curr_pos = INDEX_HEADER.size
 
-            ino = int.from_bytes(data[(curr_pos):(curr_pos + 4)], "big")
-            curr_pos += 4
+        if signature != b"DIRC":
+            raise Exception(f"Signature must be \"DIRC\". Instead, it's {signature.decode()}")
+        if version not in (2, 3, 4):
+            raise Exception(f"tig only supports versions 2, 3 and 4. This is an index file of version {version}")
+        self.version = version
 
-            unused_space = int.from_bytes(data[(curr_pos):(curr_pos + 2)], "big")
-            curr_pos += 2
+        entries = []
+        unpack_entry = INDEX_ENTRY.unpack_from
+        entry_size = INDEX_ENTRY.size
+        previous_name = b""
+        for _ in range(num_index_entries):
+            (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode, uid, gid, size, sha, flags) = unpack_entry(view, curr_pos)
 
-            if unused_space != 0:
-                raise Exception(f"In the \"mode\" section, the unused bits are not equal to zero; it's equal to {unused_space}")
-            
-            mode = int.from_bytes(data[(curr_pos):(curr_pos + 2)], "big") # total: 16 bits = 2 bytes
-            curr_pos += 2
+            if mode >> 16:
+                raise Exception(f"In the \"mode\" section, the unused bits are not equal to zero; it's equal to {mode >> 16}")
 
             mode_type = mode >> 12 # get the first 4 bits
             if mode_type not in [0b1000, 0b1010, 0b1110]:
                 raise Exception(f"The mode type of this index entry must be '0b1000', '0b1010', or '0b1110'. The given mode type is {bin(mode_type)}")
             mode_perms = mode & 0b0000000111111111
 
-            uid = int.from_bytes(data[(curr_pos):(curr_pos + 4)], "big")
-            curr_pos += 4
-
-            gid = int.from_bytes(data[(curr_pos):(curr_pos + 4)], "big")
-            curr_pos += 4
-
-            size = int.from_bytes(data[(curr_pos):(curr_pos + 4)], "big")
-            curr_pos += 4
-
-            sha = format(int.from_bytes(data[(curr_pos):(curr_pos + 20)], "big"), "040x")
-            curr_pos += 20
-
-            flags = int.from_bytes(data[(curr_pos):(curr_pos + 2)], "big")
-            curr_pos += 2
-
             flag_assume_valid = (flags & 0b1000000000000000) != 0 # get the first bit
             flag_extended = (flags & 0b0100000000000000) != 0 # get the second bit
-            if flag_extended:
-                raise Exception(f"In version 2, the 'extended' flag must be false.")
             flag_stage = (flags & 0b0011000000000000) # get the third and fourth bits
             flag_name_length = (flags & 0b0000111111111111) # get the last 12 bits
 
-
-            if flag_name_length < 0xFFF:
-                if data[(curr_pos + flag_name_length)] != 0x00: # entry path name should be null terminated
-                    raise Exception("The last byte of the entry path name must be null.")
-                entry_path_name = data[(curr_pos):(curr_pos + flag_name_length)]
-                curr_pos += flag_name_length + 1 # 1 extra byte to account for the null terminator at pos `curr_pos + flag_name_length`
+            name_start = curr_pos + entry_size
+            extended_flags = 0
+            if flag_extended:
+                if version == 2:
+                    raise Exception(f"In version 2, the 'extended' flag must be false.")
+                extended_flags = struct.unpack_from(">H", view, name_start)[0]
+                name_start += 2
+
+            if version == 4:
+                strip, suffix_start = decode_offset(view, name_start)
+                name_end = data.find(b"\x00", suffix_start)
+                if strip > len(previous_name) or name_end == -1:
+                    raise Exception("Corrupt version 4 index entry name.")
+                name_bytes = previous_name[:len(previous_name) - strip] + data[suffix_start:name_end]
+                previous_name = name_bytes
+                name = name_bytes.decode("utf8")
+                curr_pos = name_end + 1
             else:
-                null_pos = data.find(b"\x00", curr_pos + 0xFFF)
-                entry_path_name = data[(curr_pos):(null_pos)]
-                curr_pos = null_pos + 1 # 1 extra byte to account for the null terminator
-
-            name = entry_path_name.decode("utf8")
-            step_through_offset = 8 * math.ceil(curr_pos / 8) # however many bytes to skip to get to the next multiple of 8 bytes
-
-            curr_pos += step_through_offset
-
-            index_entry = GitIndexEntry(
-                ctime = (ctime_s, ctime_ns),
-                mtime = (mtime_s, mtime_ns),
-                dev = dev,
-                ino = ino,
-                mode_type = mode_type,
-                mode_perms = mode_perms,
-                uid = uid,
-                gid = gid,
-                fsize = size,
-                sha = sha,
-                flag_assume_valid = flag_assume_valid,
-                flag_stage = flag_stage,
-                name = name
-            )
-            entries.append(index_entry)
+                if flag_name_length < 0xFFF:
+                    name_end = name_start + flag_name_length
+                    if data[name_end] != 0x00: # entry path name should be null terminated
+                        raise Exception("The last byte of the entry path name must be null.")
+                else:
+                    name_end = data.find(b"\x00", name_start + 0xFFF)
+                name = str(view[name_start:name_end], "utf8")
+
+                # entries are padded with 1-8 NUL bytes to a multiple of 8 bytes, counted from the start of the entry
+                curr_pos += ((name_end - curr_pos) + 8) & ~7
+
+            entries.append(GitIndexEntry(
+                (ctime_s, ctime_ns), (mtime_s, mtime_ns), dev, ino, mode_type, mode_perms, uid, gid, size, sha.hex(),
+                flag_assume_valid, flag_stage, name, extended_flags
+            ))
+
+        # indexes written by older versions of tig end right after the entries, without a checksum
+        if curr_pos < len(data):
+            if len(data) - curr_pos < 20:
+                raise Exception("The index is truncated: it has no room for its checksum.")
+            if hashlib.sha1(view[:-20]).digest() != data[-20:]:
+                raise Exception("The index checksum doesn't match its contents.")
 
         self.entries = entries
 
+        # extensions sit between the entries and the checksum
+        extensions_end = len(data) - 20
+        while curr_pos < extensions_end:
+            extension_signature = data[curr_pos:curr_pos + 4]
+            (extension_size,) = struct.unpack_from(">I", view, curr_pos + 4)
+            extension_start = curr_pos + 8
+            curr_pos = extension_start + extension_size
+            if curr_pos > extensions_end:
+                raise Exception(f"The index extension {extension_signature} runs past the end of the index.")
+
+            if extension_signature == b"TREE":
+                self._read_cache_tree(data[extension_start:curr_pos])
+            elif extension_signature == b"TGFM":
+                token, *dirty = data[extension_start:curr_pos - 1].decode("utf8").split("\x00")
+                self.fsmonitor_token, self.fsmonitor_dirty = token, set(dirty)
+            elif not extension_signature[:1].isupper():
+                # extensions starting with a capital letter are optional and can be skipped; the others can't be
+                raise Exception(f"tig doesn't understand the required index extension {extension_signature}")
+
+    def _write_cache_tree(self):
+        # a directory the cache has nothing for, the root included, is written as invalid (-1 entries), as git does
+        children = {}
+        for directory in self.cache_tree:
+            while directory:
+                parent, _, name = directory.rpartition("/")
+                siblings = children.setdefault(parent, set())
+                if name in siblings:
+                    break
+                siblings.add(name)
+                directory = parent
+
+        # pre-order, with each directory's subtrees sorted by length and then by name like git does
+        chunks = []
+        stack = [("", "")]
+        while stack:
+            directory, name = stack.pop()
+            count, sha = self.cache_tree.get(directory, (-1, None))
+            subtrees = sorted(children.get(directory, []), key=lambda n: (len(n.encode("utf8")), n.encode("utf8")))
+            chunks.append(f"{name}\0{count} {len(subtrees)}\n".encode("utf8"))
+            if count >= 0:
+                chunks.append(bytes.fromhex(sha))
+            stack.extend((os.path.join(directory, subtree), subtree) for subtree in reversed(subtrees))
+        return b"".join(chunks)
+
+    def _read_cache_tree(self, data):
+        cache_tree = {}
+        pos = 0
+        # (directory, number of its subtrees still to read)
+        stack = []
+        while pos < len(data):
+            name_end = data.index(b"\0", pos)
+            line_end = data.index(b"\n", name_end)
+            name = data[pos:name_end].decode("utf8")
+            count, subtree_count = (int(n) for n in data[name_end + 1:line_end].split(b" "))
+            pos = line_end + 1
+
+            sha = None
+            if count >= 0:
+                sha = data[pos:pos + 20].hex()
+                pos += 20
+
+            while stack and stack[-1][1] == 0:
+                stack.pop()
+            if stack:
+                parent, remaining = stack[-1]
+                stack[-1] = (parent, remaining - 1)
+                directory = os.path.join(parent, name)
+            else:
+                directory = name
+            cache_tree[directory] = (count, sha)
+            stack.append((directory, subtree_count))
+        self.cache_tree = cache_tree
@@ -1,57 +1,259 @@
+import re
+import zlib
+import time
+import threading
+import difflib
+from array import array
 from collections import OrderedDict, namedtuple
 
 TreeNode = namedtuple("TreeNode", "mode path sha")
 
+# one change between two trees: `old`/`new` are TreeNodes holding full paths (None when added/deleted), and
+# `similarity` is the percentage of content a rename kept
+DiffEntry = namedtuple("DiffEntry", "change old new similarity", defaults=(None,))
+
+# one commit of a history walk: its parents (shas) and commit time come from the commit-graph or the commit's header
+LogEntry = namedtuple("LogEntry", "sha tree parents commit_time")
+
+class LRUCache():
+    """
+    A least-recently-used cache bounded by the total size (in bytes) of the values it holds, rather than by their count.
+    Safe to share between threads.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _ = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= self._items.pop(key)[1]
+
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+def fingerprint(content):
+    """
+    Git's rename fingerprint (diffcore-delta): {hash of a chunk: bytes in chunks with that hash}, the chunks being
+    lines, cut every 64 bytes when longer. How much two contents have in common is then a matter of comparing counts.
+    """
+    counts = {}
+    pos = 0
+    size = len(content)
+    while pos < size:
+        end = content.find(b"\n", pos, pos + 64)
+        end = min(pos + 64, size) if end == -1 else end + 1
+        chunk_hash = hash(content[pos:end])
+        counts[chunk_hash] = counts.get(chunk_hash, 0) + (end - pos)
+        pos = end
+    return counts
+
+def merge_lines(base, ours, theirs, ours_label="ours", theirs_label="theirs"):
+    """
+    Three-way merge of the lines of `ours` and `theirs` against their common ancestor `base` (diff3): a hunk changed
+    on one side only takes that side, and a hunk changed differently on both becomes a conflict between git's
+    markers, trimmed of the lines both sides agree on at its ends. Returns (merged bytes, number of conflicts).
+    """
+    base, ours, theirs = (content.splitlines(keepends=True) for content in (base, ours, theirs))
+
+    # the stretches of base that both sides kept, as (base start, base end, ours start, ours end, theirs start, ...)
+    ours_blocks = difflib.SequenceMatcher(None, base, ours, autojunk=False).get_matching_blocks()
+    theirs_blocks = difflib.SequenceMatcher(None, base, theirs, autojunk=False).get_matching_blocks()
+    stable = []
+    i = j = 0
+    while i < len(ours_blocks) and j < len(theirs_blocks):
+        ours_base, ours_start, ours_size = ours_blocks[i]
+        theirs_base, theirs_start, theirs_size = theirs_blocks[j]
+        start, end = max(ours_base, theirs_base), min(ours_base + ours_size, theirs_base + theirs_size)
+        if start < end:
+            o, t = ours_start + start - ours_base, theirs_start + start - theirs_base
+            stable.append((start, end, o, o + end - start, t, t + end - start))
+        if ours_base + ours_size < theirs_base + theirs_size:
+            i += 1
+        else:
+            j += 1
+    stable.append((len(base), len(base), len(ours), len(ours), len(theirs), len(theirs)))
+
+    merged = []
+    conflicts = 0
+    base_pos = ours_pos = theirs_pos = 0
+    for base_start, base_end, ours_start, ours_end, theirs_start, theirs_end in stable:
+        base_hunk = base[base_pos:base_start]
+        ours_hunk = ours[ours_pos:ours_start]
+        theirs_hunk = theirs[theirs_pos:theirs_start]
+        if ours_hunk == theirs_hunk or theirs_hunk == base_hunk:
+            merged.extend(ours_hunk)
+        elif ours_hunk == base_hunk:
+            merged.extend(theirs_hunk)
+        else:
+            head = 0
+            while head < min(len(ours_hunk), len(theirs_hunk)) and ours_hunk[head] == theirs_hunk[head]:
+                head += 1
+            tail = 0
+            while tail < min(len(ours_hunk), len(theirs_hunk)) - head and ours_hunk[-1 - tail] == theirs_hunk[-1 - tail]:
+                tail += 1
+            conflicts += 1
+            merged.extend(ours_hunk[:head])
+            merged.append(f"<<<<<<< {ours_label}\n".encode())
+            merged.extend(_ending_with_newline(ours_hunk[head:len(ours_hunk) - tail]))
+            merged.append(b"=======\n")
+            merged.extend(_ending_with_newline(theirs_hunk[head:len(theirs_hunk) - tail]))
+            merged.append(f">>>>>>> {theirs_label}\n".encode())
+            merged.extend(ours_hunk[len(ours_hunk) - tail:])
+        merged.extend(ours[ours_start:ours_end])
+        base_pos, ours_pos, theirs_pos = base_end, ours_end, theirs_end
+
+    return b"".join(merged), conflicts
+
+def _ending_with_newline(lines):
+    # a last line without its newline would run into the marker after it
+    if lines and not lines[-1].endswith(b"\n"):
+        return lines[:-1] + [lines[-1] + b"\n"]
+    return lines
+
+def encode_offset(n):
+    """
+    Git's variable-length integer for OFS_DELTA base offsets and index v4 name prefixes: big-endian groups of
+    7 bits, MSB set on every byte but the last, and each continuation adds one (so there's exactly one encoding).
+    """
+    out = bytearray([n & 0x7F])
+    n >>= 7
+    while n:
+        n -= 1
+        out.insert(0, 0x80 | (n & 0x7F))
+        n >>= 7
+    return bytes(out)
+
+def decode_offset(data, pos):
+    byte = data[pos]
+    pos += 1
+    n = byte & 0x7F
+    while byte & 0x80:
+        byte = data[pos]
+        pos += 1
+        n = ((n + 1) << 7) | (byte & 0x7F)
+    return n, pos
+
+# the blank line between the header of a commit (or tag) and its message; `re` searches memoryviews without copying
+HEADER_END = re.compile(rb"\n\n")
+
+def read_kvlm_header(data):
+    """
+    Returns ({key: [values]}, position of the message) for the header of a commit or tag, `data` being bytes or a
+    memoryview: only the header is copied and decoded. A line starting with a space continues the value above it
+    (like a signature), and a key can repeat (like the parents of a merge).
+    """
+    if data[:1] == b"\n":
+        # no header at all, only the blank line before the message
+        header_end, message_start = 0, 1
+    else:
+        found = HEADER_END.search(data)
+        header_end, message_start = (found.start(), found.end()) if found else (len(data), len(data))
+
+    header = OrderedDict()
+    parts = None
+    for line in bytes(data[:header_end]).decode("utf-8").split("\n"):
+        if line.startswith(" "):
+            if parts is None:
+                raise Exception("Parsing error: a continuation line comes before any key.")
+            parts.append(line[1:])
+        elif line:
+            key, _, value = line.partition(" ")
+            parts = [value]
+            header.setdefault(key, []).append(parts)
+    # joined once at the end: growing the value line by line would be quadratic in the length of a signature
+    return OrderedDict((key, ["\n".join(parts) for parts in values]) for key, values in header.items()), message_start
+
 def kvlm_read(kvlm):
-    if isinstance(kvlm, bytes):
-        kvlm = kvlm.decode("utf-8")
-    if not kvlm: 
+    if isinstance(kvlm, str):
+        kvlm = kvlm.encode("utf-8")
+    if not kvlm:
         return {}
-    
-    parsed_kvlm = OrderedDict()
-    lines = kvlm.split("\n")
-    if not lines[0]:
-        lines = lines[1:]
-    if not lines[-1]:
-        lines = lines[:-1]
-
-    # iterate through until you hit an empty string
-    split_lines = []
-    line_num = 0
-    while lines[line_num]:
-        split_lines.append(lines[line_num].split(" ", 1))
-        line_num += 1
-
-    # add the kvlm information 
-    try:
-        key_to_add = ""
-        for key, value in split_lines:
-            if key:
-                key_to_add = key
-            parsed_kvlm[key_to_add] = parsed_kvlm.get(key_to_add, []) + [value]
-    except Exception as e:
-        raise Exception(f"Parsing error: {e}")
-
-    # iterate through until you hit a non-empty string
-    while not lines[line_num]:
-        line_num += 1
-
-    # this non-empty string is the message
-    parsed_kvlm[None] = lines[line_num] 
 
-    
+    parsed_kvlm, message_start = read_kvlm_header(kvlm)
+    # kept exactly as stored (trailing newline included), so that `kvlm_write` gives back the same bytes
+    parsed_kvlm[None] = kvlm[message_start:].decode("utf-8")
     return parsed_kvlm
-        
+
 
 def kvlm_write(kv):
     named_fields = {k: v for k, v in kv.items() if k is not None}
     msg = kv[None]
     named_fields.update({k: [v] for k, v in named_fields.items() if not isinstance(v, list)})
-    stringified = {k: "\n ".join(v) for k, v in named_fields.items()}
-    stringified_list = [f"{k} {v}" for k, v in stringified.items()]
-    stringified_kvlm = "\n".join(stringified_list) + "\n\n" + msg.strip()
+    # a list is a repeated key (like the parents of a merge); a value spanning several lines continues on lines
+    # starting with a space
+    stringified_list = [f"{k} {value}".replace("\n", "\n ") + "\n" for k, v in named_fields.items() for value in v]
+    stringified_kvlm = "".join(stringified_list) + "\n" + msg
     return stringified_kvlm.encode()
 
+def read_commit_header(content):
+    """
+    Returns (tree, [parents], commit time) of a raw commit, reading only the header lines it needs.
+    """
+    tree, parents, commit_time = None, [], 0
+    pos = 0
+    while pos < len(content):
+        end = content.find(b"\n", pos)
+        if end == -1:
+            end = len(content)
+        if end == pos:
+            # the blank line before the message
+            break
+        line = content[pos:end]
+        if line.startswith(b"tree "):
+            tree = line[5:].decode()
+        elif line.startswith(b"parent "):
+            parents.append(line[7:].decode())
+        elif line.startswith(b"committer "):
+            # "committer name <email> timestamp +hhmm"
+            commit_time = int(line.rsplit(b" ", 2)[-2])
+        pos = end + 1
+
+    for sha in [tree] + parents:
+        if sha is None or len(sha) != 40 or not all(c in "0123456789abcdef" for c in sha):
+            raise Exception(f"Malformed commit: {sha} is not a sha.")
+    return tree, parents, commit_time
+
+def format_signature(signature):
+    """
+    Splits an author/committer value ("name <email> timestamp +hhmm") into ("name <email>", git's default date).
+    """
+    identity, timestamp, tz = signature.rsplit(" ", 2)
+    offset = (1 if tz[0] == "+" else -1) * (int(tz[1:3]) * 60 + int(tz[3:5])) * 60
+    t = time.gmtime(int(timestamp) + offset)
+    return identity, f"{time.strftime('%a %b', t)} {t.tm_mday} {time.strftime('%H:%M:%S %Y', t)} {tz}"
+
 def read_tree_node(data, start=0):
     mode_sep_pos = data.find(b' ', start)
     if mode_sep_pos - start < 5:
@@ -59,32 +261,140 @@ def read_tree_node(data, start=0):
     elif mode_sep_pos - start > 6:
         raise Exception(f"Mode must be shorter than 6 bytes. Your mode is {mode_sep_pos} bytes long.")
     
+    # git writes tree modes as "40000"; pad them back so every mode is 6 characters long
     _mode = data[start:mode_sep_pos]
-    mode = b" " + _mode if mode_sep_pos == 5 else _mode
+    mode = b"0" + _mode if mode_sep_pos - start == 5 else _mode
 
     path_sep_pos = data.find(b'\x00', mode_sep_pos)
     path = data[(mode_sep_pos + 1):path_sep_pos]
 
     sha_1_length = 20
-    sha = int.from_bytes(data[(path_sep_pos + 1):(path_sep_pos + sha_1_length + 1)], "big")
+    sha = data[(path_sep_pos + 1):(path_sep_pos + sha_1_length + 1)]
 
     end_of_node = path_sep_pos + sha_1_length + 1
-    return end_of_node, TreeNode(mode.decode(), path.decode(), format(sha, "040x"))
+    return end_of_node, TreeNode(mode.decode(), path.decode(), sha.hex())
 
 def read_tree(data):
-    curr_pos = 0
-    tree = []
+    return list(CompactTree(data))
+
+
+class CompactTree():
+    """
+    A tree as git stores it: every entry ("<mode> <name>\\0<20-byte sha>") in one buffer, and where each entry starts
+    and where its name ends in two arrays. Nothing is converted up front: entries only become TreeNodes (6-character
+    mode, decoded path, hex sha) as they are iterated, `entries()` and `entry_bytes()` hand them out as bytes, and the
+    tree serializes as the buffer it was read from.
+    """
+    __slots__ = ("raw", "_starts", "_nuls")
+
+    def __init__(self, data=b""):
+        self.raw = bytes(data)
+        self._starts = array("I")
+        self._nuls = array("I")
+
+        raw = self.raw
+        end = len(raw)
+        pos = 0
+        while pos < end:
+            mode_sep_pos = raw.find(b" ", pos)
+            if mode_sep_pos - pos < 5:
+                raise Exception(f"Mode must be longer than 5 bytes. Your mode is only {mode_sep_pos - pos} bytes long.")
+            elif mode_sep_pos - pos > 6:
+                raise Exception(f"Mode must be shorter than 6 bytes. Your mode is {mode_sep_pos - pos} bytes long.")
+            path_sep_pos = raw.find(b"\x00", mode_sep_pos)
+            if path_sep_pos == -1 or path_sep_pos + 21 > end:
+                raise Exception("The tree is truncated.")
+            self._starts.append(pos)
+            self._nuls.append(path_sep_pos)
+            pos = path_sep_pos + 21
+
+    def __len__(self):
+        return len(self._starts)
+
+    def entry(self, i):
+        """
+        Returns (mode, name, sha) of the `i`th entry, as they are stored: mode as written (b"40000" for a tree), sha as
+        20 bytes.
+        """
+        raw, start, nul = self.raw, self._starts[i], self._nuls[i]
+        mode_sep_pos = start + 5 if raw[start + 5] == 32 else start + 6
+        return raw[start:mode_sep_pos], raw[(mode_sep_pos + 1):nul], raw[(nul + 1):(nul + 21)]
+
+    def entries(self):
+        raw = self.raw
+        for start, nul in zip(self._starts, self._nuls):
+            mode_sep_pos = start + 5 if raw[start + 5] == 32 else start + 6
+            yield raw[start:mode_sep_pos], raw[(mode_sep_pos + 1):nul], raw[(nul + 1):(nul + 21)]
+
+    def entry_bytes(self):
+        """
+        Yields every entry whole. Two trees share an entry if and only if they hold the same name, with the same mode
+        and sha.
+        """
+        raw = self.raw
+        for start, nul in zip(self._starts, self._nuls):
+            yield raw[start:(nul + 21)]
 
-    while curr_pos < len(data):
-        new_pos, tree_node = read_tree_node(data, start=curr_pos)
-        curr_pos = new_pos
-        tree.append(tree_node)
+    def node(self, i):
+        mode, name, sha = self.entry(i)
+        return TreeNode(mode.decode().rjust(6, "0"), name.decode(), sha.hex())
 
-    return tree
+    def __getitem__(self, i):
+        return self.node(range(len(self))[i])
+
+    def __iter__(self):
+        for mode, name, sha in self.entries():
+            yield TreeNode(mode.decode().rjust(6, "0"), name.decode(), sha.hex())
+
+    def __eq__(self, other):
+        if isinstance(other, CompactTree):
+            return self.raw == other.raw
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"CompactTree({list(self)!r})"
+
+    def serialize(self):
+        return self.raw
+
+def is_tree_mode(mode):
+    return mode.lstrip("0").startswith("4")
 
 def tree_order_fn(node: TreeNode):
-    if node.mode.startswith("10"):
-        return node.path
-    else:
-        return node.path if not node.path.endswith("/") else node.path + "/"
+    # git sorts subtrees as if their name ended with a "/"
+    if is_tree_mode(node.mode):
+        return node.path + "/"
+    return node.path
     
+
+
+def iter_inflate(data, chunk_size=64 * 1024):
+    """
+    Lazily inflates a zlib stream, yielding decompressed chunks of at most `chunk_size` bytes.
+    Only as much of the stream is inflated as the caller actually consumes.
+
+    Objects written by older versions of tig were stored uncompressed; they are passed through in chunks as well.
+    A zlib stream always starts with 0x78 ("x"), which no object header ("blob", "commit", ...) does.
+    """
+    view = memoryview(data)
+    if view[:1] != b"x":
+        for pos in range(0, len(view), chunk_size):
+            yield bytes(view[pos:(pos + chunk_size)])
+        return
+
+    decompressor = zlib.decompressobj()
+    pending = b""
+    pos = 0
+    while not decompressor.eof:
+        if not pending:
+            if pos >= len(view):
+                raise Exception("Compressed object is truncated.")
+            pending = view[pos:(pos + chunk_size)]
+            pos += chunk_size
+
+        chunk = decompressor.decompress(pending, chunk_size)
+        pending = decompressor.unconsumed_tail
+        if chunk:
+            yield chunk